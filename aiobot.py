@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+asyncio runtime of the bot, used instead of python-telegram-bot's Updater
+when token.ini says
+
+    [Bot]
+    runtime = asyncio
+
+It gets updates by long polling or, with mode = webhook in the same section,
+as webhooks:
+
+    [Webhook]
+    url = https://example.com     (public base url Telegram posts to)
+    listen = 0.0.0.0              (optional)
+    port = 8443                   (optional)
+
+AsyncBot talks to the Bot API over one aiohttp session whose connections
+are kept alive and shared by all requests, and returns the same
+python-telegram-bot objects as telegram.Bot. Updates are fetched by long
+polling and each one is handled in its own task. The handlers of bot.py
+don't send anything themselves, they queue jobs on the outbox (an
+outbox.AsyncOutbox in this runtime), and with AsyncBot a job returns a
+coroutine. So everything runs on one thread and the number of sends in
+flight is only bounded by the rate limits and the connection pool.
+"""
+import asyncio
+import inspect
+import json
+import logging
+import signal
+import time
+
+import aiohttp
+from aiohttp import web
+from telegram import Message, StickerSet, Update, User
+from telegram.error import (TelegramError, Unauthorized, BadRequest,
+                            RetryAfter)
+
+import metrics
+
+API_URL = 'https://api.telegram.org/bot'
+
+# Connections kept open to the Bot API
+CONNECTIONS = 100
+
+# Seconds a getUpdates call waits for updates
+POLL_TIMEOUT = 30
+
+# Seconds to wait after a failed getUpdates
+POLL_BACKOFF = 3
+
+# Updates the webhook server holds before it makes Telegram wait, how long
+# it makes it wait before refusing an update (Telegram sends it again
+# later) and how many connections Telegram may open to it
+WEBHOOK_QUEUE = 1000
+WEBHOOK_WAIT = 5
+WEBHOOK_CONNECTIONS = 40
+
+logger = logging.getLogger(__name__)
+
+API_SECONDS = metrics.Histogram('bot_api_seconds',
+                                'Time Bot API calls took, by method',
+                                ['method'])
+API_ERRORS = metrics.Counter('bot_api_errors_total',
+                             'Bot API calls that failed, by method and type '
+                             'of error', ['method', 'type'])
+
+
+class AsyncBot(object):
+    """ The part of telegram.Bot the bot uses, as coroutines """
+
+    def __init__(self, token, base_url=API_URL, connections=CONNECTIONS):
+        self.token = token
+        self.base_url = base_url + token
+        self.connections = connections
+        self.session = None
+        self.user = None
+
+    async def start(self):
+        """ Opens the session and finds out who the bot is """
+        connector = aiohttp.TCPConnector(limit=self.connections,
+                                         keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.user = User.de_json(await self.call('getMe'), self)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    @property
+    def id(self):
+        return self.user.id
+
+    @property
+    def username(self):
+        return self.user.username
+
+    @property
+    def name(self):
+        return '@' + self.user.username
+
+    async def call(self, method, data=None, files=None, timeout=None):
+        """ Calls a Bot API method and returns its result """
+        start = time.perf_counter()
+        try:
+            return await self._call(method, data, files, timeout)
+        except Exception as e:
+            API_ERRORS.inc(method=method, type=type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, method=method)
+
+    async def _call(self, method, data, files, timeout):
+        data = {k: v for k, v in (data or {}).items() if v is not None}
+        if files:
+            form = aiohttp.FormData()
+            for key, value in data.items():
+                form.add_field(key, value if isinstance(value, str)
+                               else json.dumps(value))
+            for key, f in files.items():
+                form.add_field(key, f, filename=getattr(f, 'name', key))
+            kwargs = {'data': form}
+        else:
+            kwargs = {'json': data}
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+
+        async with self.session.post('%s/%s' % (self.base_url, method),
+                                     **kwargs) as response:
+            try:
+                result = await response.json(content_type=None)
+            except ValueError:
+                raise TelegramError('Invalid server response (%d)'
+                                    % response.status)
+        if result.get('ok'):
+            return result['result']
+
+        description = result.get('description', 'Unknown error')
+        parameters = result.get('parameters') or {}
+        if 'retry_after' in parameters:
+            raise RetryAfter(parameters['retry_after'])
+        if response.status in (401, 403):
+            raise Unauthorized(description)
+        if response.status == 400:
+            raise BadRequest(description)
+        raise TelegramError(description)
+
+    async def get_updates(self, offset=None, timeout=POLL_TIMEOUT):
+        result = await self.call('getUpdates',
+                                 {'offset': offset, 'timeout': timeout},
+                                 timeout=timeout + 10)
+        return [Update.de_json(u, self) for u in result]
+
+    async def send_message(self, chat_id, text, **kwargs):
+        kwargs.update(chat_id=chat_id, text=text)
+        return Message.de_json(await self.call('sendMessage', kwargs), self)
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        kwargs.update(chat_id=chat_id, caption=caption)
+        if isinstance(photo, str):
+            kwargs['photo'] = photo
+            result = await self.call('sendPhoto', kwargs)
+        else:
+            result = await self.call('sendPhoto', kwargs, {'photo': photo})
+        return Message.de_json(result, self)
+
+    async def send_sticker(self, chat_id, sticker, **kwargs):
+        kwargs.update(chat_id=chat_id,
+                      sticker=getattr(sticker, 'file_id', sticker))
+        return Message.de_json(await self.call('sendSticker', kwargs), self)
+
+    async def set_webhook(self, url, max_connections=WEBHOOK_CONNECTIONS):
+        return await self.call('setWebhook', {
+            'url': url, 'max_connections': max_connections})
+
+    async def delete_webhook(self):
+        return await self.call('deleteWebhook')
+
+    async def get_sticker_set(self, name):
+        return StickerSet.de_json(await self.call('getStickerSet',
+                                                  {'name': name}), self)
+
+
+# Filters for messages, like the ones in telegram.ext.Filters
+
+def status_update(message):
+    return bool(message.new_chat_members or message.left_chat_member
+                or message.new_chat_title or message.new_chat_photo
+                or message.delete_chat_photo or message.group_chat_created
+                or message.supergroup_chat_created
+                or message.channel_chat_created or message.migrate_to_chat_id
+                or message.migrate_from_chat_id or message.pinned_message)
+
+
+def group(message):
+    return message.chat.type in ('group', 'supergroup')
+
+
+class Dispatcher(object):
+    """
+    Hands updates to the handlers of bot.py: commands as in
+    bot.COMMANDS, then the first of messages, a list of (filter, handler),
+    whose filter accepts the message. error(bot, update, error) is called
+    when a handler raises. Handlers may be coroutine functions.
+    """
+
+    def __init__(self, bot, commands, messages, error):
+        self.bot = bot
+        self.commands = {command: (callback, pass_args)
+                         for command, callback, pass_args in commands}
+        self.messages = messages
+        self.error = error
+        self.tasks = set()
+        # Queues of updates that weren't dispatched yet, see Webhook
+        self.queues = []
+
+    def handler(self, message):
+        """ Returns the handler and its extra arguments for a message """
+        text = message.text
+        if text and text.startswith('/'):
+            words = text.split()
+            command, _, username = words[0][1:].partition('@')
+            if not username or username.lower() == \
+                    self.bot.username.lower():
+                callback, pass_args = self.commands.get(command.lower(),
+                                                        (None, False))
+                if callback is not None:
+                    return callback, {'args': words[1:]} if pass_args else {}
+        for accepts, callback in self.messages:
+            if accepts(message):
+                return callback, {}
+        return None, {}
+
+    async def dispatch(self, update):
+        if update.message is None:
+            return
+        callback, kwargs = self.handler(update.message)
+        if callback is None:
+            return
+        try:
+            result = callback(self.bot, update, **kwargs)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            self.error(self.bot, update, e)
+
+    async def poll(self, timeout=POLL_TIMEOUT):
+        """ Fetches updates and dispatches each in its own task, forever """
+        offset = None
+        loop = asyncio.get_event_loop()
+        # getUpdates doesn't work while a webhook is set
+        await self.bot.delete_webhook()
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset, timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error('Could not get updates: %s', e)
+                await asyncio.sleep(POLL_BACKOFF)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                task = loop.create_task(self.dispatch(update))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def read(self, pipe):
+        """
+        Dispatches the updates read from pipe, a file with one json update
+        per line, one after the other until the file is closed
+        """
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader(limit=2 ** 20)
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            await self.dispatch(Update.de_json(json.loads(line.decode()),
+                                               self.bot))
+
+    def depth(self):
+        """ Returns the number of updates received but not handled yet """
+        return len(self.tasks) + sum(q.qsize() for q in self.queues)
+
+    async def drain(self):
+        """ Waits for the updates being handled """
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+
+class Webhook(object):
+    """
+    HTTP server Telegram posts updates to. Updates are answered as soon as
+    they are queued and handed to the dispatcher by workers tasks. When
+    queue_size updates are waiting, a post is held until there is room
+    again, which also holds up Telegram as it only opens a few connections;
+    after wait seconds it is refused with a 503 and Telegram retries it
+    later.
+    """
+
+    def __init__(self, dispatcher, path, queue_size=WEBHOOK_QUEUE,
+                 wait=WEBHOOK_WAIT, workers=4):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.wait = wait
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        dispatcher.queues.append(self.queue)
+        self.received = 0
+        self.refused = 0
+
+    async def receive(self, request):
+        try:
+            update = Update.de_json(await request.json(), self.dispatcher.bot)
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(update), self.wait)
+            except asyncio.TimeoutError:
+                self.refused += 1
+                return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def work(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dispatcher.dispatch(update)
+            finally:
+                self.queue.task_done()
+
+    async def serve(self, listen='0.0.0.0', port=8443, url=None):
+        """
+        Serves until cancelled, then handles what's still queued. Registers
+        the webhook with Telegram if url is given.
+        """
+        app = web.Application()
+        app.router.add_post(self.path, self.receive)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        workers = [asyncio.ensure_future(self.work())
+                   for _ in range(self.workers)]
+        try:
+            await web.TCPSite(runner, listen, port).start()
+            if url is not None:
+                await self.dispatcher.bot.set_webhook(url + self.path)
+            logger.info('Listening for webhooks on %s:%d', listen, port)
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await self.queue.join()
+            for worker in workers:
+                worker.cancel()
+            logger.info('Webhook received %d updates, refused %d',
+                        self.received, self.refused)
+
+
+def run(dispatcher, start, stop, webhook=None, pipe=None):
+    """
+    Runs the bot until interrupted. start(bot) is called once the bot is
+    connected and stop() once the last update is handled, with the loop
+    stopped; either may return an awaitable. Updates come by long polling,
+    by webhook if webhook is a dict with the url, listen and port to serve
+    it on, or from pipe (see Dispatcher.read()) until it is closed.
+    """
+    loop = asyncio.get_event_loop()
+    bot = dispatcher.bot
+    loop.run_until_complete(bot.start())
+    _complete(loop, start(bot))
+    if pipe is not None:
+        main = loop.create_task(dispatcher.read(pipe))
+    elif webhook is None:
+        main = loop.create_task(dispatcher.poll())
+    else:
+        # The token in the path keeps others from posting updates
+        main = loop.create_task(Webhook(dispatcher, '/' + bot.token)
+                                .serve(**webhook))
+    # Like Updater.idle(). Reading a pipe, the end of the pipe is the signal
+    # to stop, so nothing that was written to it is lost.
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, main.cancel if pipe is None
+                                else lambda: None)
+    try:
+        loop.run_until_complete(main)
+    except asyncio.CancelledError:
+        logger.info('Stopping')
+    finally:
+        main.cancel()
+        loop.run_until_complete(asyncio.gather(main, return_exceptions=True))
+        loop.run_until_complete(dispatcher.drain())
+        _complete(loop, stop())
+        loop.run_until_complete(bot.close())
+
+
+def _complete(loop, result):
+    if inspect.isawaitable(result):
+        loop.run_until_complete(result)
@@ -0,0 +1,1299 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the bot and its pickledb storage. Nothing here talks to
+Telegram. Run one with
+
+    python3 bench.py <benchmark> [options]
+
+and see python3 bench.py -h for the list.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from functools import partial
+from types import SimpleNamespace
+
+import python3pickledb as pickledb
+
+
+def percentile(samples, p):
+    """ Returns the p-th percentile of a list of numbers """
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def report(name, samples):
+    """ Prints latency stats of a list of durations in seconds """
+    print('%-14s n=%-6d p50=%8.1fus  p99=%8.1fus  max=%8.1fus'
+          % (name, len(samples), percentile(samples, 50) * 1e6,
+             percentile(samples, 99) * 1e6, max(samples) * 1e6))
+
+
+def fill(db, keys):
+    """ Fills a db with keys chats shaped like the ones bot.py stores """
+    for i in range(keys):
+        db.db[str(-1000000000 - i)] = {
+            'welcome': 'Hello $username! Welcome to $title',
+            'goodbye': None, 'admin': 100000 + i, 'locked': True,
+            'quiet': False}
+    db.db['chats'] = set(-1000000000 - i for i in range(keys))
+
+
+def bench_set(args):
+    """ Latency of db.set for each persistence mode """
+    modes = [
+        ('sync dump', {}, True),
+        ('snapshot', {}, False),
+        ('write-behind', {'flush_interval': 5, 'flush_ops': 100}, False),
+        ('journal', {'journal': True}, False),
+    ]
+    for name, kwargs, dump in modes:
+        tmp = tempfile.mkdtemp()
+        try:
+            db = pickledb.load(os.path.join(tmp, 'bench.db'), True, **kwargs)
+            fill(db, args.keys)
+            db.dump()
+            samples = []
+            for i in range(args.ops):
+                start = time.perf_counter()
+                chat = str(-1000000000 - i % args.keys)
+                db.set(chat, dict(db.get(chat), welcome='Hi $username'))
+                if dump:
+                    # What every set cost before snapshots moved off-thread
+                    db.dump()
+                samples.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            db.close()
+            report(name, samples)
+            print('%-14s close took %.1fms' % ('', (time.perf_counter() -
+                                                    start) * 1e3))
+        finally:
+            shutil.rmtree(tmp)
+
+
+def bench_batch(args):
+    """ Writes per logical operation of db.set vs mset vs db.batch() """
+    modes = [('snapshot', 'bench.db', {}),
+             ('journal', 'bench.db', {'journal': True}),
+             ('sqlite', 'bench.sqlite', {'backend': 'sqlite'})]
+    for mode, name, kwargs in modes:
+        for how in ('set', 'mset', 'batch'):
+            tmp = tempfile.mkdtemp()
+            try:
+                path = os.path.join(tmp, name)
+                db = pickledb.load(path, False, **kwargs)
+                db.mset({str(-1000000000 - i): {'welcome': 'Hello $username'}
+                         for i in range(args.keys)})
+                db.close()
+
+                db = pickledb.load(path, True, **kwargs)
+                chats = [str(-1000000000 - i) for i in range(args.ops)]
+                start = time.perf_counter()
+                if how == 'set':
+                    for chat in chats:
+                        db.set(chat, {'welcome': 'Hi $username'})
+                        time.sleep(args.spread)
+                elif how == 'mset':
+                    db.mset({chat: {'welcome': 'Hi $username'}
+                             for chat in chats})
+                else:
+                    with db.batch():
+                        for chat in chats:
+                            db.set(chat, {'welcome': 'Hi $username'})
+                            time.sleep(args.spread)
+                db.close()
+                elapsed = time.perf_counter() - start
+                stats = db.write_stats()
+                print('%-8s %-5s %6d sets  %6d writes  %5.2f writes/set  '
+                      '%8.1fms' % (mode, how, args.ops, stats['writes'],
+                                   stats['writes'] / float(args.ops),
+                                   elapsed * 1e3))
+            finally:
+                shutil.rmtree(tmp)
+
+
+def bench_backends(args):
+    """ Startup time, durable write latency and size of json vs sqlite """
+    for size in args.sizes:
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'bench.db')
+            db = pickledb.load(path, False)
+            fill(db, size)
+            db.dump()
+            db.close()
+            pickledb.convert(path, os.path.join(tmp, 'bench.sqlite'))
+            for backend, name in (('json', 'bench.db'),
+                                  ('sqlite', 'bench.sqlite')):
+                location = os.path.join(tmp, name)
+                start = time.perf_counter()
+                db = pickledb.load(location, True, backend=backend)
+                loaded = time.perf_counter() - start
+                samples = []
+                for i in range(args.ops):
+                    chat = str(-1000000000 - i % size)
+                    start = time.perf_counter()
+                    db.set(chat, dict(db.get(chat), welcome='Hi $username'))
+                    db.dump()
+                    samples.append(time.perf_counter() - start)
+                db.close()
+                print('%8d keys %-6s load=%9.1fms  size=%7.1fMB'
+                      % (size, backend, loaded * 1e3,
+                         os.path.getsize(location) / 1e6))
+                report('  durable set', samples)
+        finally:
+            shutil.rmtree(tmp)
+
+
+def startup_child(path, lazy):
+    """ Loads a db, reads one chat and prints the time and memory it took """
+    start = time.perf_counter()
+    db = pickledb.load(path, False, lazy=lazy)
+    db.get('-1000000000')
+    seconds = time.perf_counter() - start
+    # ru_maxrss survives exec on Linux, so it would include our parent
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    rss = int(line.split()[1])
+    print(json.dumps({'seconds': seconds, 'rss': rss}))
+
+
+def bench_startup(args):
+    """ Load time and peak memory of an eager vs a lazy (mmap) load, with
+    and without a saved key index """
+    for size in args.sizes:
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'bench.db')
+            db = pickledb.load(path, False)
+            fill(db, size)
+            for i in range(size):
+                db.db[str(-1000000000 - i)]['welcome'] = 'x' * args.message
+            db.dump()
+            db.close()
+            for mode in ('eager', 'scan', 'index'):
+                if mode == 'index':
+                    # A lazy db writes the key index along with snapshots
+                    db = pickledb.load(path, False, lazy=True)
+                    db.dump()
+                    db.close()
+                out = subprocess.check_output(
+                    [sys.executable, __file__, 'startup', '--child', path] +
+                    (['--lazy'] if mode != 'eager' else []))
+                result = json.loads(out)
+                print('%8d chats %-5s load=%8.1fms  peak rss=%7.1fMB  '
+                      'file=%7.1fMB' % (size, mode, result['seconds'] * 1e3,
+                                        result['rss'] / 1024.0,
+                                        os.path.getsize(path) / 1e6))
+        finally:
+            shutil.rmtree(tmp)
+
+
+def bench_codec(args):
+    """ Encode and decode time and file size of the snapshot codecs """
+    codecs = [('json', pickledb.JSONCodec(accelerated=False))]
+    if pickledb.orjson is not None:
+        codecs.append(('orjson', pickledb.JSONCodec()))
+    codecs.append(('binary', pickledb.BinaryCodec()))
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'bench.db')
+        source = pickledb.load(path, False)
+        fill(source, args.chats)
+        # What snapshots cost when they were encoded as one string
+        start = time.perf_counter()
+        pickledb._dumps(source.db)
+        encoded = time.perf_counter() - start
+        tracemalloc.start()
+        pickledb._dumps(source.db)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%8d chats %-10s encode=%7.1fms  peak=%6.1fMB'
+              % (args.chats, 'one string', encoded * 1e3, peak / 1e6))
+        for name, codec in codecs:
+            db = pickledb.load(path, False, codec=codec)
+            db.db = source.db
+            samples = []
+            for i in range(args.rounds):
+                start = time.perf_counter()
+                db.dump()
+                samples.append(time.perf_counter() - start)
+            tracemalloc.start()
+            db.dump()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            loads = []
+            for i in range(args.rounds):
+                start = time.perf_counter()
+                loaded = pickledb.load(path, False, codec=codec)
+                loads.append(time.perf_counter() - start)
+                loaded.close()
+            if loaded.db != source.db:
+                print('%s: loaded db differs from the one dumped' % name)
+                return False
+            db.close()
+            print('%8d chats %-10s encode=%7.1fms  peak=%6.1fMB  '
+                  'decode=%7.1fms  size=%6.1fMB'
+                  % (args.chats, name, percentile(samples, 50) * 1e3,
+                     peak / 1e6, percentile(loads, 50) * 1e3,
+                     os.path.getsize(path) / 1e6))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def cascade(bot, update, msg):
+    """ The if ... in msg chain bis_bald and at_handler used to run """
+    if bot.name.lower() in msg and bot.name.lower() != msg:
+        if bot.name.lower() in msg and "coffee" in msg:
+            return 'coffee'
+        if bot.name.lower() in msg and ("days till" in msg or "days until" in msg) and (
+                "druck" in msg or "season 5" in msg):
+            return 'days until druck'
+        if bot.name.lower() in msg and "shakshuka" in msg:
+            return 'shakshuka'
+        if bot.name.lower() in msg and "sandwich" in msg:
+            return 'sandwich'
+        if bot.name.lower() in msg and "pancake" in msg:
+            return 'pancake'
+        if bot.name.lower() in msg and " cake" in msg:
+            return 'cake'
+        if bot.name.lower() in msg and "muffin" in msg:
+            return 'muffin'
+        return 'mention'
+    if "bis" in msg and "bald" in msg:
+        return 'bis bald'
+    if "family" in msg and "chat" in msg:
+        return 'family chat'
+    if "lonely" in msg:
+        return 'lonely'
+    if "hollandaise" in msg and "pizza" in msg:
+        return 'hollandaise pizza'
+    if "pineapple pizza" in msg or "mint chocolate" in msg or "toast hawaii" in msg:
+        return 'food debate'
+    if "hawaii toast" in msg or "hawaii sandwich" in msg:
+        return 'hawaii toast'
+    if "food discussion" in msg or "food debate" in msg or "here we go again" in msg:
+        return 'here we go again'
+    if "daddy" in msg:
+        return 'daddy'
+    if "bjorn" in msg or "bj*rn" in msg or "björn" in msg:
+        return 'bjorn'
+    if "missing" in msg and "hours" in msg:
+        return 'missing hours'
+    if ("rentier" in msg and not bot.name.lower() in msg) or (msg == bot.name.lower()):
+        return 'rentier'
+    if "reindeer" == msg:
+        return 'reindeer'
+    if "superior" in msg:
+        return 'superior'
+    if update.message.reply_to_message is not None:
+        if update.message.reply_to_message.from_user.id == bot.id:
+            if "coffee" in update.message.reply_to_message.text.lower():
+                return 'coffee reply'
+    if "constantin" in msg:
+        return 'constantin'
+    return None
+
+
+def trigger_texts(name):
+    """ Messages that set off each trigger of triggers.py for a bot called
+    name, and some that don't """
+    return ['bis bald!', 'the family chat is great', 'so lonely',
+            'hollandaise on pizza', 'pineapple pizza is fine',
+            'hawaii toast anyone', 'no food debate please', 'daddy',
+            'bj*rn again', 'missing you for 3 hours', 'rentier?', name,
+            'reindeer', 'superior', 'constantin said hi',
+            name + ' coffee', name + ' days until season 5',
+            name + ' shakshuka', name + ' sandwich', name + ' pancake',
+            name + ' a cake', name + ' muffin', name + ' hello',
+            'just some ordinary chatter in a group about nothing much',
+            'hi', 'what are we doing tonight? anyone up for a movie?']
+
+
+# Messages that set off no trigger, most of what a group sends
+SMALL_TALK = ['hi', 'ok', 'lol', 'good morning everyone!', 'see you at 8',
+              'what are we doing tonight? anyone up for a movie?',
+              'did anyone watch the game yesterday? it was unreal',
+              'i will be a bit late, the train is delayed again',
+              'haha yes', 'thanks :)', 'where are you guys?',
+              'can someone send me the address please']
+
+
+def bench_triggers(args):
+    """ Trigger matching: compiled trigger table vs the old if cascade """
+    from triggers import BANTER, AT_BANTER, Handler
+
+    bot = SimpleNamespace(name='@RentierWelcomeBot', id=1)
+    name = bot.name.lower()
+    texts = trigger_texts(name)
+    updates = [SimpleNamespace(message=SimpleNamespace(
+        reply_to_message=None, from_user=SimpleNamespace(id=2)))] * len(texts)
+    texts.append('yes please')
+    updates.append(SimpleNamespace(message=SimpleNamespace(
+        reply_to_message=SimpleNamespace(from_user=bot, text='coffee?'),
+        from_user=SimpleNamespace(id=2))))
+
+    banter = BANTER.compile(name)
+    at_banter = AT_BANTER.compile(name)
+
+    def compiled(bot, update, msg):
+        trigger = banter.match(bot, update, msg)
+        if trigger is not None and isinstance(trigger.response, Handler) \
+                and trigger.response.name == 'at_handler':
+            trigger = at_banter.match(bot, update, msg) or trigger
+        return trigger.name if trigger is not None else None
+
+    for text, update in zip(texts, updates):
+        expected, got = cascade(bot, update, text), compiled(bot, update, text)
+        if expected != got:
+            print('mismatch for %r: cascade %r, compiled %r'
+                  % (text, expected, got))
+            return False
+
+    chatter = [(text, updates[0]) for text in SMALL_TALK]
+    for text, update in chatter:
+        if compiled(bot, update, text) is not None:
+            print('%r sets off a trigger' % text)
+            return False
+
+    for kind, messages in (('triggers', list(zip(texts, updates))),
+                           ('chatter', chatter)):
+        for name, match in (('cascade', cascade), ('compiled', compiled)):
+            samples = []
+            for _ in range(args.rounds):
+                for text, update in messages:
+                    start = time.perf_counter()
+                    match(bot, update, text)
+                    samples.append(time.perf_counter() - start)
+            report('%s %s' % (name, kind), samples)
+
+
+# Persistence modes bench_crash kills writers in. The small compact_size
+# has journal mode compact every couple of seconds.
+CRASH_MODES = {
+    'snapshot': {},
+    'binary': {'codec': 'binary'},
+    'journal': {'journal': True, 'compact_size': 256 * 1024},
+}
+
+
+def crash_child(path, keys, mode):
+    """ Writes to the db at path until it gets killed """
+    db = pickledb.load(path, True, **CRASH_MODES[mode])
+    fill(db, keys)
+    db.dump()
+    i = 0
+    while True:
+        db.set(str(i % keys), 'x' * (i % 1000))
+        i += 1
+        if not i % 100:
+            # Let the compactor thread in, like the pauses between updates
+            time.sleep(0)
+
+
+def bench_crash(args):
+    """ Kills a writer at random points and checks the db still loads, with
+    all its keys, in each persistence mode """
+    filled = set(str(-1000000000 - i) for i in range(args.keys))
+    filled.add('chats')
+    ok = True
+    for mode in args.mode or sorted(CRASH_MODES):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'bench.db')
+        survived = 0
+        try:
+            for _ in range(args.rounds):
+                child = subprocess.Popen([sys.executable, __file__, 'crash',
+                                          '--child', path, '--mode', mode,
+                                          '--keys', str(args.keys)])
+                time.sleep(random.uniform(0.2, 1.0))
+                child.send_signal(signal.SIGKILL)
+                child.wait()
+                try:
+                    db = pickledb.load(path, False, **CRASH_MODES[mode])
+                    try:
+                        keys = set(db.getall())
+                    finally:
+                        db.close()
+                except Exception as e:
+                    print('%s: corrupt db after kill: %r' % (mode, e))
+                    continue
+                # What fill() wrote, unless killed before the first dump
+                lost = keys and filled - keys
+                if lost:
+                    print('%s: %d keys lost after kill' % (mode, len(lost)))
+                    continue
+                survived += 1
+            print('%s: db loaded fine after %d/%d kills'
+                  % (mode, survived, args.rounds))
+        finally:
+            shutil.rmtree(tmp)
+        ok = ok and survived == args.rounds
+    return ok
+
+
+# Messages for synthetic updates: some banter, mostly chatter
+CHATTER = ['bis bald!', 'so lonely', 'pineapple pizza is fine', 'daddy',
+           'just some ordinary chatter in a group about nothing much',
+           'hi', 'what are we doing tonight? anyone up for a movie?',
+           'ok', 'lol', 'see you tomorrow']
+
+
+def synthetic_update(update_id, chats):
+    """ Returns a group text message update as Telegram would post it """
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()),
+        'chat': {'id': -1000000000 - random.randrange(chats),
+                 'type': 'supergroup', 'title': 'Bench'},
+        'from': {'id': 100000 + random.randrange(1000), 'is_bot': False,
+                 'first_name': 'Bench'},
+        'text': random.choice(CHATTER)}}
+
+
+def webhook_child(port, args):
+    """ Serves aiobot's webhook with the trigger table as the only handler """
+    import asyncio
+    import aiobot
+    from triggers import BANTER
+
+    bot = SimpleNamespace(id=1, username='RentierWelcomeBot',
+                          name='@RentierWelcomeBot')
+    banter = BANTER.compile(bot.name.lower())
+    handled = [0]
+
+    async def handler(bot, update):
+        banter.match(bot, update, update.message.text.lower())
+        if args.delay:
+            await asyncio.sleep(args.delay)
+        handled[0] += 1
+
+    dispatcher = aiobot.Dispatcher(bot, [], [(aiobot.group, handler)],
+                                   lambda bot, update, error: print(error))
+    webhook = aiobot.Webhook(dispatcher, '/bench', queue_size=args.queue,
+                             wait=args.wait)
+    loop = asyncio.get_event_loop()
+    serve = loop.create_task(webhook.serve('127.0.0.1', port))
+    loop.add_signal_handler(signal.SIGTERM, serve.cancel)
+    loop.run_until_complete(asyncio.gather(serve, return_exceptions=True))
+    print(json.dumps({'received': webhook.received,
+                      'refused': webhook.refused, 'handled': handled[0]}))
+
+
+def bench_webhook(args):
+    """ Posts synthetic updates to the webhook server, like Telegram would """
+    import asyncio
+    import aiohttp
+    import socket
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    child = subprocess.Popen([sys.executable, __file__, 'webhook',
+                              '--child', str(port), '--queue', str(args.queue),
+                              '--wait', str(args.wait),
+                              '--delay', str(args.delay)],
+                             stdout=subprocess.PIPE)
+    url = 'http://127.0.0.1:%d/bench' % port
+    samples = []
+    statuses = {}
+
+    async def post(session, updates):
+        for update in updates:
+            start = time.perf_counter()
+            async with session.post(url, json=update) as response:
+                await response.read()
+            samples.append(time.perf_counter() - start)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    async def load():
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Wait for the server, it only answers GETs with a 405
+            for _ in range(100):
+                try:
+                    async with session.get(url):
+                        break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.1)
+            updates = [synthetic_update(i, args.chats)
+                       for i in range(args.updates)]
+            start = time.perf_counter()
+            await asyncio.gather(*(post(session, updates[i::args.concurrency])
+                                   for i in range(args.concurrency)))
+            return time.perf_counter() - start
+
+    try:
+        elapsed = asyncio.get_event_loop().run_until_complete(load())
+    finally:
+        child.send_signal(signal.SIGTERM)
+        out, _ = child.communicate()
+    served = json.loads(out.decode().strip().split('\n')[-1])
+    report('post', samples)
+    print('%d updates in %.2fs (%.0f/s) over %d connections, statuses %s'
+          % (args.updates, elapsed, args.updates / elapsed, args.concurrency,
+             statuses))
+    print('server received %(received)d, refused %(refused)d, '
+          'handled %(handled)d' % served)
+
+
+class FakeBotAPI(object):
+    """
+    Bot API server on a free local port, run in a thread of its own. Hands
+    out the updates it was given through getUpdates and records what the
+    bot sends in sent, as (time, method, params). Sending to one of the
+    chats in gone fails like for a chat that removed the bot, those are
+    recorded in refused.
+    """
+
+    BOT = {'id': 1, 'is_bot': True, 'first_name': 'Rentier',
+           'username': 'RentierWelcomeBot'}
+
+    def __init__(self, updates=(), gone=()):
+        self.updates = list(updates)
+        self.gone = set(gone)
+        self.sent = []
+        self.refused = []
+        self.message_id = 0
+
+    async def handle(self, request):
+        import asyncio
+        from aiohttp import web
+
+        method = request.match_info['method']
+        if request.method == 'GET':
+            # python-telegram-bot's Bot gets getMe
+            params = dict(request.query)
+        elif request.content_type.startswith('multipart/'):
+            params = {k: v if isinstance(v, str) else 'upload'
+                      for k, v in (await request.post()).items()}
+        else:
+            params = await request.json() if request.can_read_body else {}
+
+        if method == 'getMe':
+            result = self.BOT
+        elif method in ('setWebhook', 'deleteWebhook'):
+            result = True
+        elif method == 'getUpdates':
+            offset = params.get('offset') or 0
+            result = [u for u in self.updates
+                      if u['update_id'] >= offset][:100]
+            if not result:
+                await asyncio.sleep(0.2)
+        elif method == 'getStickerSet':
+            result = {'name': params['name'], 'title': params['name'],
+                      'is_animated': False, 'contains_masks': False,
+                      'stickers': [{'file_id': '%s-%d' % (params['name'], i),
+                                    'width': 512, 'height': 512,
+                                    'is_animated': False}
+                                   for i in range(20)]}
+        elif method.startswith('send') \
+                and int(params['chat_id']) in self.gone:
+            self.refused.append((time.monotonic(), method, params))
+            # Both ways Telegram says the bot can't post there anymore
+            if int(params['chat_id']) % 2:
+                status, description = 403, 'Forbidden: bot was kicked ' \
+                                           'from the supergroup chat'
+            else:
+                status, description = 400, 'Bad Request: PEER_ID_INVALID'
+            return web.json_response({'ok': False, 'error_code': status,
+                                      'description': description},
+                                     status=status)
+        elif method.startswith('send'):
+            self.sent.append((time.monotonic(), method, params))
+            self.message_id += 1
+            result = {'message_id': self.message_id, 'date': int(time.time()),
+                      'chat': {'id': int(params['chat_id']),
+                               'type': 'supergroup'}}
+            if method == 'sendPhoto':
+                result['photo'] = [{'file_id': 'photo-%d' % self.message_id,
+                                    'width': 800, 'height': 600}]
+        else:
+            return web.json_response({'ok': False, 'error_code': 400,
+                                      'description': 'Bad Request: unknown '
+                                                     'method ' + method},
+                                     status=400)
+        return web.json_response({'ok': True, 'result': result})
+
+    def start(self):
+        """ Starts serving, returns the url to use as BOT_API_URL """
+        import asyncio
+        import socket
+        import threading
+        from aiohttp import web
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        ready = threading.Event()
+
+        def serve():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            app = web.Application()
+            app.router.add_route('*', '/bot{token}/{method}', self.handle)
+            runner = web.AppRunner(app, access_log=None)
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(
+                web.TCPSite(runner, '127.0.0.1', port).start())
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=serve, name='fake-bot-api',
+                         daemon=True).start()
+        ready.wait()
+        return 'http://127.0.0.1:%d/bot' % port
+
+
+def message_update(update_id, chat_id, user, **fields):
+    """ Returns an update with a message from user in a group chat """
+    message = {'message_id': update_id, 'date': int(time.time()),
+               'chat': {'id': chat_id, 'type': 'supergroup',
+                        'title': 'Chat %d' % chat_id},
+               'from': user}
+    message.update(fields)
+    return {'update_id': update_id, 'message': message}
+
+
+def bench_shards(args):
+    """ Runs shards.py against a fake Bot API and checks chat ownership """
+    from shards import shard_of, shard_path
+
+    updates = []
+
+    def add(chat, user, **fields):
+        updates.append(message_update(len(updates) + 1, chat, user, **fields))
+
+    def user(i):
+        return {'id': 100000 + i, 'is_bot': False, 'first_name': 'U%d' % i}
+
+    # The admin adds the bot, then sets the welcome message again and again,
+    # each time followed by someone joining
+    chats = [-1000000000 - i for i in range(args.chats)]
+    for chat in chats:
+        add(chat, user(0), new_chat_members=[FakeBotAPI.BOT])
+    for r in range(1, args.rounds + 1):
+        for chat in chats:
+            add(chat, user(0), text='/welcome v%d $username' % r)
+            add(chat, user(r), new_chat_members=[user(r)])
+
+    api = FakeBotAPI(updates)
+    env = dict(os.environ, BOT_API_URL=api.start())
+    tmp = tempfile.mkdtemp()
+    ok = True
+    try:
+        start = time.monotonic()
+        child = subprocess.Popen([sys.executable,
+                                  os.path.join(os.path.dirname(
+                                      os.path.realpath(__file__)),
+                                      'shards.py'),
+                                  '--shards', str(args.shards)],
+                                 cwd=tmp, env=env)
+        # Every chat gets an introduction and a "Got it!" per round, the
+        # joins may be welcomed together
+        expected = len(chats) * (2 + args.rounds)
+        while time.monotonic() - start < args.timeout:
+            welcomed = set(int(p['chat_id']) for _, m, p in api.sent
+                           if p.get('text', '').startswith('v%d ' % args.rounds))
+            if len(api.sent) >= expected and len(welcomed) == len(chats):
+                break
+            time.sleep(0.2)
+        elapsed = time.monotonic() - start
+        child.send_signal(signal.SIGTERM)
+        child.wait()
+
+        print('%d updates over %d shards, %d messages sent in %.1fs'
+              % (len(updates), args.shards, len(api.sent), elapsed))
+        if len(welcomed) != len(chats):
+            print('%d chats never got the last welcome message'
+                  % (len(chats) - len(welcomed)))
+            ok = False
+
+        # Each chat's settings must be in its own shard only, with the
+        # last /welcome
+        dbs = [pickledb.load(shard_path(os.path.join(tmp, 'bot.db'), k),
+                             False) for k in range(args.shards)]
+        for chat in chats:
+            owner = shard_of(chat, args.shards)
+            for k, db in enumerate(dbs):
+                record = db.get(str(chat))
+                if k != owner and record is not None:
+                    print('chat %d found in shard %d, owned by %d'
+                          % (chat, k, owner))
+                    ok = False
+                elif k == owner and (record or {}).get('welcome') != \
+                        'v%d $username' % args.rounds:
+                    print('chat %d has welcome %r' % (chat, record))
+                    ok = False
+        for db in dbs:
+            db.close()
+        print('ownership and last-write checks %s' % ('passed' if ok
+                                                      else 'FAILED'))
+    finally:
+        shutil.rmtree(tmp)
+    return ok
+
+
+def replay_updates(chats, rounds):
+    """
+    Returns (kind, update) pairs of a day in the life of chats groups: the
+    bot is added, then each round the admin sets the messages and asks for
+    help, users join alone and together and leave, and every trigger,
+    the sticker and the coffee reply are set off. The admin ends each
+    round with /mychats in a private chat.
+    """
+    updates = []
+    bot = FakeBotAPI.BOT
+    name = '@' + bot['username']
+
+    def add(kind, chat_id, user, **fields):
+        updates.append((kind, message_update(len(updates) + 1, chat_id, user,
+                                             **fields)))
+
+    def command(chat_id, text, **fields):
+        add('command', chat_id, user(0), text=text, entities=[{
+            'type': 'bot_command', 'offset': 0,
+            'length': len(text.split()[0])}], **fields)
+
+    def user(i):
+        return {'id': 100000 + i, 'is_bot': False, 'first_name': 'U<%d>' % i}
+
+    chat_ids = [-1000000000 - i for i in range(chats)]
+    for chat in chat_ids:
+        add('introduce', chat, user(0), new_chat_members=[bot])
+    for r in range(rounds):
+        for chat in chat_ids:
+            command(chat, '/welcome Hi $username, you are $count of $title!')
+            command(chat, '/goodbye Bye $username')
+            command(chat, '/help')
+            add('join', chat, user(1), new_chat_members=[user(1)])
+            add('join', chat, user(2),
+                new_chat_members=[user(2), user(3), user(4)])
+            add('leave', chat, user(0), left_chat_member=user(1))
+            for text in trigger_texts(name):
+                add('text', chat, user(5), text=text)
+            add('sticker', chat, user(5), sticker={
+                'file_id': 'sweety', 'width': 512, 'height': 512,
+                'is_animated': False, 'set_name': 'SweetyBee',
+                'emoji': '\U0001f60f'})
+            add('text', chat, user(5), text='yes please', reply_to_message={
+                'message_id': 1, 'date': int(time.time()),
+                'chat': {'id': chat, 'type': 'supergroup'},
+                'from': bot, 'text': 'Coffee?'})
+        admin = user(0)
+        command(admin['id'], '/mychats', chat={
+            'id': admin['id'], 'type': 'private',
+            'first_name': admin['first_name']})
+    return updates
+
+
+def replay_child(path, args):
+    """
+    Feeds the updates in the json file at path to bot.py's handlers, as
+    registered with the runtime in BOT_RUNTIME, and prints how long each
+    took and what was written to the db
+    """
+    import asyncio
+    import bot
+    from outbox import TokenBucket
+    from telegram import Update
+
+    with open(path) as f:
+        updates = json.load(f)
+    if not args.limits:
+        # The fake API doesn't mind floods, don't wait for the outbox
+        bot.outbox.bucket = TokenBucket(1e9, 1e9, time.monotonic())
+        bot.outbox.chat_rate = bot.outbox.chat_burst = 1e9
+
+    samples = {}
+    if os.environ['BOT_RUNTIME'] == 'asyncio':
+        import aiobot
+        loop = asyncio.get_event_loop()
+        api = aiobot.AsyncBot(bot.TOKEN, bot.API_URL)
+        dispatcher = bot.async_dispatcher(api)
+        loop.run_until_complete(api.start())
+        bot.start(api)
+
+        async def replay():
+            for kind, update in updates:
+                update = Update.de_json(update, api)
+                start = time.perf_counter()
+                await dispatcher.dispatch(update)
+                samples.setdefault(kind, []).append(
+                    time.perf_counter() - start)
+
+        start = time.perf_counter()
+        loop.run_until_complete(replay())
+    else:
+        from telegram.ext import Updater
+        updater = Updater(bot.TOKEN, base_url=bot.API_URL, workers=4)
+        bot.add_handlers(updater.dispatcher)
+        bot.start(updater.bot)
+        # Updates come as fast as they can be queued, which would have most
+        # of the banter shed
+        bot.updates.key_limit = bot.updates.limit = len(updates)
+        start = time.perf_counter()
+        for kind, update in updates:
+            update = Update.de_json(update, updater.bot)
+            begin = time.perf_counter()
+            updater.dispatcher.process_update(update)
+            samples.setdefault(kind, []).append(time.perf_counter() - begin)
+        # The handlers run on bot.updates, see keyed.py
+        bot.updates.drain()
+    handled = time.perf_counter() - start
+    bot.stop()
+    drained = time.perf_counter() - start
+    if os.environ['BOT_RUNTIME'] == 'asyncio':
+        loop.run_until_complete(api.close())
+    print(json.dumps({'samples': samples, 'handled': handled,
+                      'drained': drained, 'db': bot.db.write_stats(),
+                      'size': os.path.getsize(bot.DB_FILE)}))
+
+
+def bench_replay(args):
+    """ Replays synthetic updates through bot.py against a fake Bot API """
+    updates = replay_updates(args.chats, args.rounds)
+    api = FakeBotAPI()
+    env = dict(os.environ, BOT_API_URL=api.start(),
+               BOT_RUNTIME=args.runtime)
+    env.pop('BOT_SHARD', None)
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'updates.json')
+        with open(path, 'w') as f:
+            json.dump(updates, f)
+        out = subprocess.check_output(
+            [sys.executable, os.path.realpath(__file__), 'replay', '--child',
+             path] + (['--limits'] if args.limits else []), cwd=tmp, env=env)
+        result = json.loads(out.decode().strip().split('\n')[-1])
+        with open(os.path.join(tmp, 'example.log')) as f:
+            errors = [line for line in f if ' - ERROR - ' in line]
+    finally:
+        shutil.rmtree(tmp)
+
+    everything = []
+    for kind, samples in sorted(result['samples'].items()):
+        report(kind, samples)
+        everything.extend(samples)
+    report('all', everything)
+    print('%d updates handled in %.2fs (%.0f/s) on the %s runtime, '
+          '%d messages sent by %.2fs'
+          % (len(updates), result['handled'],
+             len(updates) / result['handled'], args.runtime, len(api.sent),
+             result['drained']))
+    db = result['db']
+    print('db: %d mutations, %d writes, %s bytes written, file %d bytes'
+          % (db['mutations'], db['writes'], db.get('bytes_written', '?'),
+             result['size']))
+    for line in errors[:10]:
+        print(line.rstrip())
+    if errors:
+        print('%d errors logged' % len(errors))
+        return False
+
+
+BROADCAST_TEXT = 'Hello everyone, this is a broadcast'
+
+
+def broadcast_child(path, args):
+    """
+    Runs bot.py until its broadcast is done: the one the last run left in
+    bot.db, or else the one started by the update in the json file at path
+    """
+    import asyncio
+    import bot
+    from outbox import TokenBucket
+    from telegram import Update
+
+    with open(path) as f:
+        update = json.load(f)
+    if not args.limits:
+        bot.outbox.bucket = TokenBucket(1e9, 1e9, time.monotonic())
+        bot.outbox.chat_rate = bot.outbox.chat_burst = 1e9
+
+    if os.environ['BOT_RUNTIME'] == 'asyncio':
+        import aiobot
+        loop = asyncio.get_event_loop()
+        api = aiobot.AsyncBot(bot.TOKEN, bot.API_URL)
+        dispatcher = bot.async_dispatcher(api)
+        loop.run_until_complete(api.start())
+        bot.start(api)
+        if bot.broadcaster is None:
+            loop.run_until_complete(
+                dispatcher.dispatch(Update.de_json(update, api)))
+
+        async def done():
+            while not bot.broadcaster.done:
+                await asyncio.sleep(0.05)
+
+        loop.run_until_complete(done())
+    else:
+        from telegram.ext import Updater
+        updater = Updater(bot.TOKEN, base_url=bot.API_URL, workers=4)
+        bot.add_handlers(updater.dispatcher)
+        bot.start(updater.bot)
+        if bot.broadcaster is None:
+            updater.dispatcher.process_update(
+                Update.de_json(update, updater.bot))
+            bot.updates.drain()
+        while not bot.broadcaster.done:
+            time.sleep(0.05)
+    status = bot.broadcaster.status()
+    bot.stop()
+    if os.environ['BOT_RUNTIME'] == 'asyncio':
+        loop.run_until_complete(api.close())
+    print(json.dumps({'status': status}))
+
+
+def bench_broadcast(args):
+    """ /broadcast to many chats against a fake Bot API, killed part way
+    and resumed from its checkpoint """
+    owner = 100000
+    chats = [-1000000000 - i for i in range(args.chats)]
+    gone = set(random.Random(1).sample(chats, int(args.chats * args.gone)))
+    api = FakeBotAPI(gone=gone)
+    env = dict(os.environ, BOT_API_URL=api.start(), BOT_OWNER=str(owner),
+               BOT_RUNTIME=args.runtime)
+    env.pop('BOT_SHARD', None)
+    user = {'id': owner, 'is_bot': False, 'first_name': 'Owner'}
+    text = '/broadcast ' + BROADCAST_TEXT
+    update = message_update(1, owner, user, text=text, entities=[{
+        'type': 'bot_command', 'offset': 0, 'length': len('/broadcast')}],
+        chat={'id': owner, 'type': 'private', 'first_name': 'Owner'})
+
+    def broadcasts():
+        return [entry for entry in api.sent + api.refused
+                if entry[2].get('text') == BROADCAST_TEXT]
+
+    tmp = tempfile.mkdtemp()
+    try:
+        db = pickledb.load(os.path.join(tmp, 'bot.db'), False)
+        db.set('chats', set(chats))
+        db.dump()
+        db.close()
+        path = os.path.join(tmp, 'update.json')
+        with open(path, 'w') as f:
+            json.dump(update, f)
+        command = [sys.executable, os.path.realpath(__file__), 'broadcast',
+                   '--child', path] + (['--limits'] if args.limits else [])
+
+        runs = []
+        if args.kill:
+            child = subprocess.Popen(command, cwd=tmp, env=env,
+                                     stdout=subprocess.DEVNULL)
+            while len(broadcasts()) < args.chats * args.kill:
+                if child.poll() is not None:
+                    print('bot exited with %d before it was killed'
+                          % child.returncode)
+                    return False
+                time.sleep(0.01)
+            child.kill()
+            child.wait()
+            runs.append(('killed', broadcasts()))
+        killed = len(broadcasts())
+        out = subprocess.check_output(command, cwd=tmp, env=env)
+        runs.append(('resumed' if args.kill else 'run',
+                     broadcasts()[killed:]))
+        status = json.loads(out.decode().strip().split('\n')[-1])['status']
+
+        db = pickledb.load(os.path.join(tmp, 'bot.db'), False)
+        left = db.get('chats')
+        checkpoint = db.get('broadcast')
+        db.close()
+        with open(os.path.join(tmp, 'example.log')) as f:
+            errors = [line for line in f if ' - ERROR - ' in line]
+    finally:
+        shutil.rmtree(tmp)
+
+    for name, sends in runs:
+        seconds = sends[-1][0] - sends[0][0] if len(sends) > 1 else 0
+        print('%-8s %6d messages in %6.2fs (%6.0f/s)'
+              % (name, len(sends), seconds, len(sends) / max(seconds, 1e-3)))
+    print('bot says: %s' % status)
+    received = {}
+    for entry in broadcasts():
+        chat = int(entry[2]['chat_id'])
+        received[chat] = received.get(chat, 0) + 1
+    live = set(chats) - gone
+    missing = live - set(received)
+    repeated = sum(n - 1 for n in received.values())
+    reports = [entry for entry in api.sent
+               if int(entry[2]['chat_id']) == owner]
+    print('%d chats, %d gone: %d missed, %d sent twice (killed mid-flight), '
+          '%d left in the registry, %d reports to the owner'
+          % (len(chats), len(gone), len(missing), repeated, len(left),
+             len(reports)))
+    failed = []
+    if missing:
+        failed.append('chats missed')
+    if left != live:
+        failed.append('registry not pruned to the live chats')
+    if checkpoint is not None:
+        failed.append('checkpoint left behind')
+    if not any(entry[2]['text'].startswith('Broadcast done')
+               for entry in reports):
+        failed.append('owner not told')
+    for line in errors[:10]:
+        print(line.rstrip())
+    if errors:
+        failed.append('%d errors logged' % len(errors))
+    if failed:
+        print('FAILED: ' + ', '.join(failed))
+        return False
+    print('all live chats reached, gone ones pruned')
+
+
+def keyed_load(args):
+    """
+    Returns synthetic updates as (arrival time, chat, banter, seconds to
+    handle) for args.seconds at args.rate per second: one hot chat sends
+    args.hot of them, the others are spread over args.chats chats. args.banter
+    of them are banter, args.slow take SLOW_UPDATE seconds (an upload)
+    instead of args.work.
+    """
+    rand = random.Random(1)
+    updates = []
+    for i in range(int(args.seconds * args.rate)):
+        chat = 0 if rand.random() < args.hot else rand.randint(1, args.chats)
+        updates.append((i / args.rate, chat, rand.random() < args.banter,
+                        SLOW_UPDATE if rand.random() < args.slow
+                        else args.work))
+    return updates
+
+
+# Seconds the slow updates of bench_keyed take
+SLOW_UPDATE = 0.2
+
+
+def run_keyed(updates, submit):
+    """
+    Submits updates at their arrival times with submit(chat, job, banter)
+    and runs them. Returns, for each update that ran, (chat, index, wait
+    since arrival) in the order they started, and the number of times two
+    updates of a chat ran at once.
+    """
+    started = []
+    running = {}
+    overlaps = [0]
+    lock = threading.Lock()
+    begin = time.perf_counter()
+
+    def job(index, arrival, chat, seconds):
+        wait = time.perf_counter() - begin - arrival
+        with lock:
+            started.append((chat, index, wait))
+            running[chat] = running.get(chat, 0) + 1
+            if running[chat] > 1:
+                overlaps[0] += 1
+        time.sleep(seconds)
+        with lock:
+            running[chat] -= 1
+
+    for index, (arrival, chat, banter, seconds) in enumerate(updates):
+        delay = arrival - (time.perf_counter() - begin)
+        if delay > 0:
+            time.sleep(delay)
+        submit(chat, partial(job, index, arrival, chat, seconds), banter)
+    return started, overlaps
+
+
+def bench_keyed(args):
+    """ Ordering, fairness and load shedding of the handler executor
+    (keyed.py) under a skewed synthetic load """
+    from concurrent.futures import ThreadPoolExecutor
+    from keyed import KeyedExecutor
+
+    updates = keyed_load(args)
+    print('%d updates in %.0fs, %.0f%% from one chat, %.0f%% banter, '
+          '%d workers' % (len(updates), args.seconds, args.hot * 100,
+                          args.banter * 100, args.workers))
+    failed = []
+    for name in ('thread pool', 'keyed'):
+        if name == 'keyed':
+            executor = KeyedExecutor(workers=args.workers)
+            executor.start()
+            started, overlaps = run_keyed(
+                updates, lambda chat, job, banter:
+                executor.submit(chat, job, shed=banter))
+            executor.stop()
+        else:
+            # What python-telegram-bot's run_async does
+            pool = ThreadPoolExecutor(args.workers)
+            started, overlaps = run_keyed(
+                updates, lambda chat, job, banter: pool.submit(job))
+            pool.shutdown()
+
+        last = {}
+        reordered = 0
+        for chat, index, _ in started:
+            if last.get(chat, -1) > index:
+                reordered += 1
+            last[chat] = index
+        ran = set(index for _, index, _ in started)
+        lost = sum(1 for index, update in enumerate(updates)
+                   if not update[2] and index not in ran)
+        shed = len(updates) - len(ran)
+        hot = [wait for chat, _, wait in started if chat == 0]
+        cold = [wait for chat, _, wait in started if chat != 0]
+        print('%s: %d out of order, %d ran alongside another of their chat, '
+              '%d banter shed, %d others lost'
+              % (name, reordered, overlaps[0], shed, lost))
+        report('  hot chat', hot)
+        report('  other chats', cold)
+        if name != 'keyed':
+            continue
+        if reordered or overlaps[0]:
+            failed.append('updates of a chat out of order or at once')
+        if lost:
+            failed.append('%d updates that aren\'t banter lost' % lost)
+        if percentile(cold, 99) > args.fair:
+            failed.append('other chats waited %.0fms (p99) for the hot one'
+                          % (percentile(cold, 99) * 1e3))
+    if failed:
+        print('FAILED: ' + ', '.join(failed))
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    sub = parser.add_subparsers(dest='benchmark')
+    sub.required = True
+
+    p = sub.add_parser('set', help=bench_set.__doc__.strip())
+    p.add_argument('--keys', type=int, default=10000)
+    p.add_argument('--ops', type=int, default=2000)
+    p.set_defaults(func=bench_set)
+
+    p = sub.add_parser('batch', help=bench_batch.__doc__.strip())
+    p.add_argument('--keys', type=int, default=10000)
+    p.add_argument('--ops', type=int, default=500)
+    p.add_argument('--spread', type=float, default=0,
+                   help='seconds between sets, the snapshot flusher merges '
+                        'back to back ones')
+    p.set_defaults(func=bench_batch)
+
+    p = sub.add_parser('backends', help=bench_backends.__doc__.strip())
+    p.add_argument('--sizes', type=int, nargs='+',
+                   default=[1000, 100000, 1000000])
+    p.add_argument('--ops', type=int, default=20)
+    p.set_defaults(func=bench_backends)
+
+    p = sub.add_parser('startup', help=bench_startup.__doc__.strip())
+    p.add_argument('--sizes', type=int, nargs='+',
+                   default=[1000, 10000, 100000])
+    p.add_argument('--message', type=int, default=500,
+                   help='length of each chat\'s welcome message')
+    p.add_argument('--lazy', action='store_true', help=argparse.SUPPRESS)
+    p.add_argument('--child', help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('codec', help=bench_codec.__doc__.strip())
+    p.add_argument('--chats', type=int, default=100000)
+    p.add_argument('--rounds', type=int, default=5)
+    p.set_defaults(func=bench_codec)
+
+    p = sub.add_parser('triggers', help=bench_triggers.__doc__.strip())
+    p.add_argument('--rounds', type=int, default=2000)
+    p.set_defaults(func=bench_triggers)
+
+    p = sub.add_parser('crash', help=bench_crash.__doc__.strip())
+    p.add_argument('--keys', type=int, default=10000)
+    p.add_argument('--mode', action='append', choices=sorted(CRASH_MODES),
+                   help='persistence mode to check, all of them by default')
+    p.add_argument('--rounds', type=int, default=20)
+    p.add_argument('--child', help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_crash)
+
+    p = sub.add_parser('webhook', help=bench_webhook.__doc__.strip())
+    p.add_argument('--updates', type=int, default=20000)
+    p.add_argument('--concurrency', type=int, default=40,
+                   help='connections, Telegram opens up to 40')
+    p.add_argument('--chats', type=int, default=1000)
+    p.add_argument('--queue', type=int, default=1000,
+                   help='updates the server holds before making posts wait')
+    p.add_argument('--wait', type=float, default=5,
+                   help='seconds a post waits for room before a 503')
+    p.add_argument('--delay', type=float, default=0,
+                   help='seconds each update takes to handle')
+    p.add_argument('--child', help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_webhook)
+
+    p = sub.add_parser('shards', help=bench_shards.__doc__.strip())
+    p.add_argument('--shards', type=int, default=4)
+    p.add_argument('--chats', type=int, default=50)
+    p.add_argument('--rounds', type=int, default=3)
+    p.add_argument('--timeout', type=float, default=120)
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser('replay', help=bench_replay.__doc__.strip())
+    p.add_argument('--chats', type=int, default=100)
+    p.add_argument('--rounds', type=int, default=5)
+    p.add_argument('--runtime', choices=['threads', 'asyncio'],
+                   default='asyncio')
+    p.add_argument('--limits', action='store_true',
+                   help='keep Telegram\'s rate limits, sending takes longer')
+    p.add_argument('--child', help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_replay)
+
+    p = sub.add_parser('broadcast', help=bench_broadcast.__doc__.strip())
+    p.add_argument('--chats', type=int, default=50000)
+    p.add_argument('--gone', type=float, default=0.05,
+                   help='share of chats that removed the bot')
+    p.add_argument('--kill', type=float, default=0.5,
+                   help='kill the bot once this share of chats got the '
+                        'message, 0 for never')
+    p.add_argument('--runtime', choices=['threads', 'asyncio'],
+                   default='asyncio')
+    p.add_argument('--limits', action='store_true',
+                   help='keep Telegram\'s rate limits, 50k chats take half '
+                        'an hour')
+    p.add_argument('--child', help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_broadcast)
+
+    p = sub.add_parser('keyed', help=bench_keyed.__doc__.strip())
+    p.add_argument('--seconds', type=float, default=5)
+    p.add_argument('--rate', type=float, default=5000,
+                   help='updates per second')
+    p.add_argument('--chats', type=int, default=1000)
+    p.add_argument('--hot', type=float, default=0.5,
+                   help='share of the updates sent by one chat')
+    p.add_argument('--banter', type=float, default=0.9,
+                   help='share of the updates that may be shed')
+    p.add_argument('--slow', type=float, default=0.002,
+                   help='share of the updates that take %ss' % SLOW_UPDATE)
+    p.add_argument('--work', type=float, default=0.002,
+                   help='seconds the other updates take')
+    p.add_argument('--workers', type=int, default=10)
+    p.add_argument('--fair', type=float, default=0.1,
+                   help='fail if other chats wait longer than this (p99)')
+    p.set_defaults(func=bench_keyed)
+
+    args = parser.parse_args()
+    if getattr(args, 'child', None):
+        if args.benchmark == 'startup':
+            return startup_child(args.child, args.lazy)
+        if args.benchmark == 'webhook':
+            return webhook_child(int(args.child), args)
+        if args.benchmark == 'replay':
+            return replay_child(args.child, args)
+        if args.benchmark == 'broadcast':
+            return broadcast_child(args.child, args)
+        return crash_child(args.child, args.keys, args.mode[0])
+    if args.func(args) is False:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,28 +6,63 @@ from datetime import timezone, tzinfo, datetime, timedelta
 from os.path import dirname, realpath, join
 from time import sleep
 import traceback
+import os
 import sys
-from html import escape
+from functools import partial
 
 from telegram import ParseMode, TelegramError, Update, MessageEntity
+from telegram.error import Unauthorized
 from telegram.ext import Updater, MessageHandler, CommandHandler, Filters
-from telegram.ext.dispatcher import run_async
 from emoji import emojize
 #from telegram.contrib.botan import Botan
 
+import logs
+import metrics
 import python3pickledb as pickledb
+from broadcast import Broadcast
+from chatsettings import SettingsStore, migrate
+from keyed import KeyedExecutor
+from media import MediaCache, StickerSets
+from outbox import (Outbox, AsyncOutbox, WELCOME, REPLY, CHATTER,
+                    GLOBAL_RATE, GLOBAL_BURST)
+from triggers import BANTER, AT_BANTER, Echo, Photo, Sticker, Handler
+import templates
 
 # Configuration
 
-def get_settings(block, name):
+def get_settings(block, name, **kwargs):
     rootdir = dirname(realpath(__file__))
     settings = configparser.ConfigParser()
     settings.read(join(rootdir, 'token.ini'))
-    return settings.get(block, name)
+    return settings.get(block, name, **kwargs)
 
 
 BOTNAME = get_settings("Bot", "name")
 TOKEN = get_settings("Bot", "token")
+# 'polling' gets updates with getUpdates, 'webhook' has Telegram post them
+# to the url in the [Webhook] section, see aiobot.py
+MODE = get_settings("Bot", "mode", fallback="polling")
+# 'threads' runs on python-telegram-bot's Updater, 'asyncio' on aiobot.py.
+# Webhooks are only served by the asyncio runtime.
+RUNTIME = os.environ.get("BOT_RUNTIME") or get_settings(
+    "Bot", "runtime", fallback="asyncio" if MODE == "webhook" else "threads")
+# Bot API server to talk to
+API_URL = os.environ.get("BOT_API_URL") or get_settings(
+    "Bot", "api_url", fallback="https://api.telegram.org/bot")
+
+# Set by shards.py for its worker processes, each of which owns the chats of
+# one shard and gets their updates from the ingestion process, see there
+SHARD = os.environ.get("BOT_SHARD")
+SHARDS = int(os.environ.get("BOT_SHARDS", "1"))
+if SHARD is not None:
+    RUNTIME = "asyncio"
+# Port of the /metrics endpoint on localhost, none if empty, see metrics.py.
+# Shard workers serve theirs on the ports after it.
+METRICS_PORT = get_settings("Bot", "metrics_port", fallback="")
+# User ids, separated by commas, that may use /broadcast
+OWNERS = {int(owner) for owner in (
+    os.environ.get("BOT_OWNER") or
+    get_settings("Bot", "owner", fallback="")).split(",") if owner.strip()}
 BOTAN_TOKEN = 'BOTANTOKEN'
 
 REQUEST_KWARGS={
@@ -49,41 +84,118 @@ help_text = 'Welcomes everyone that enters a group chat that this bot is a ' \
             '/quiet - Disable "Sorry, only the person who..." ' \
             '& help messages\n' \
             '/unquiet - Enable "Sorry, only the person who..." ' \
-            '& help messages\n\n' \
-            'You can use _$username_ and _$title_ as placeholders when setting' \
-            ' messages. [HTML formatting]' \
+            '& help messages\n' \
+            '/mychats - List the chats you invited me to (in a private ' \
+            'chat with me)\n\n' \
+            'You can use _$username_, _$mention_, _$title_, _$count_ and ' \
+            '_$id_ as placeholders when setting messages. [HTML formatting]' \
             '(https://core.telegram.org/bots/api#formatting-options) ' \
             'is also supported.\n'
 '''
 Create database object
 Database schema:
-<chat_id> -> welcome message
-<chat_id>_bye -> goodbye message
-<chat_id>_adm -> user id of the user who invited the bot
-<chat_id>_lck -> boolean if the bot is locked or unlocked
-<chat_id>_quiet -> boolean if the bot is quieted
+<chat_id> -> settings record of the chat, see chatsettings.py
+              (indexed by admin, see db.lookup())
 
-chats -> list of chat ids where the bot has received messages in.
+chats -> set of chat ids where the bot has received messages in.
+schema -> version of this layout, see chatsettings.SCHEMA_VERSION
+broadcast -> progress of the running broadcast, see broadcast.py
+media -> file_ids of uploaded photos, see media.py
 '''
-# Create database object
-db = pickledb.load('bot.db', True)
-
-if not db.get('chats'):
-    db.set('chats', [])
-
-# Set up logging
-root = logging.getLogger()
-root.setLevel(logging.INFO)
-
-logging.basicConfig(level=logging.INFO, filename='example.log',
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Create database object. Writes are batched by a background flusher: at most
+# every DB_FLUSH_INTERVAL seconds or after DB_FLUSH_OPS changes.
+# DB_BACKEND is 'json' (bot.db) or 'sqlite' (bot.sqlite). Convert an existing
+# bot.db with: python3 python3pickledb.py bot.db bot.sqlite
+DB_BACKEND = 'json'
+DB_FILE = 'bot.sqlite' if DB_BACKEND == 'sqlite' else 'bot.db'
+if SHARD is not None:
+    from shards import shard_path
+    DB_FILE = shard_path(DB_FILE, int(SHARD))
+DB_FLUSH_INTERVAL = 5
+DB_FLUSH_OPS = 100
+# Only index bot.db on startup and decode chats as they show up (json only).
+# The admin index is then built on the first /mychats.
+DB_LAZY = False
+# Format of bot.db snapshots, 'json' or the smaller and faster to load
+# 'binary' (json backend without DB_LAZY only). Either is read on startup.
+DB_CODEC = 'json'
+
+db = pickledb.load(DB_FILE, True, backend=DB_BACKEND,
+                   flush_interval=DB_FLUSH_INTERVAL, flush_ops=DB_FLUSH_OPS,
+                   indexes={'admin': pickledb.Index(field='admin')},
+                   **({'lazy': True} if DB_LAZY else
+                      {'codec': DB_CODEC} if DB_BACKEND == 'json' else {}))
+
+# Older versions kept the chat ids in a list
+if not isinstance(db.get('chats'), set):
+    db.set('chats', set(db.get('chats') or []))
+
+migrate(db)
+settings = SettingsStore(db)
+photos = MediaCache(db)
+sticker_sets = StickerSets()
+
+# Chats listed by /mychats at most
+MYCHATS_LIMIT = 50
+
+# Sticker sets the bot replies with, fetched on startup
+STICKER_SETS = {"covid2019byhro"} | {
+    t.response.set_name for t in BANTER.triggers
+    if isinstance(t.response, Sticker)}
+
+# Set up logging. Records are written by a background thread and the file
+# is rotated at LOG_MAX_BYTES, see logs.py. Lines logged for every message
+# are DEBUG, 1 in LOG_SAMPLE of them is kept: all of them with 1, as before
+# they were sampled, none with 0.
+LOG_FILE = 'example.log'
+if SHARD is not None:
+    LOG_FILE = shard_path(LOG_FILE, int(SHARD))
+LOG_MAX_BYTES = logs.MAX_BYTES
+LOG_BACKUPS = logs.BACKUPS
+LOG_SAMPLE = 1
+
+log_listener = logs.setup(LOG_FILE, sample=LOG_SAMPLE, sampled=[__name__],
+                          max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS)
 
 logger = logging.getLogger(__name__)
 
-
-@run_async
-def send_async(bot, *args, **kwargs):
-    bot.sendMessage(*args, **kwargs)
+HANDLER_SECONDS = metrics.Histogram('bot_handler_seconds',
+                                    'Time handlers took, by handler',
+                                    ['handler'])
+HANDLER_ERRORS = metrics.Counter('bot_handler_errors_total',
+                                 'Handlers that raised, by handler and type '
+                                 'of error', ['handler', 'type'])
+TRIGGER_HITS = metrics.Counter('bot_trigger_hits_total',
+                               'Messages that set off a trigger, see '
+                               'triggers.py', ['trigger'])
+metrics.Gauge('bot_db_file_bytes', 'Size of the db file',
+              lambda: os.path.getsize(DB_FILE)
+              if os.path.exists(DB_FILE) else 0)
+# Running counts kept by the db, see write_stats() in python3pickledb.py
+for _stat, _help in (
+        ('mutations', 'Changes made to the db'),
+        ('writes', 'Snapshots, journal records or commits written'),
+        ('bytes_written', 'Bytes written to the db file (json only)'),
+        ('write_seconds', 'Seconds spent writing the db')):
+    metrics.Gauge('bot_db_%s_total' % _stat, _help,
+                  partial(lambda stat: db.write_stats().get(stat, 0), _stat),
+                  kind='counter')
+del _stat, _help
+metrics.Gauge('bot_sticker_sets', 'Sticker set cache counters, see media.py',
+              lambda: {(k,): v for k, v in sticker_sets.stats().items()},
+              labels=['stat'])
+
+# Messages of chats that didn't set their own, see templates.py
+DEFAULT_WELCOME = templates.compile(
+    'Hello $username! Welcome to $title %s'
+    % emojize(":grinning_face_with_smiling_eyes:"))
+DEFAULT_GOODBYE = templates.compile('Goodbye, $username!')
+
+
+def send_async(bot, chat_id, priority=REPLY, **kwargs):
+    """ Queues a message for sending, see outbox.py """
+    outbox.submit(chat_id, partial(bot.send_message, chat_id=chat_id,
+                                   **kwargs), priority)
 
 
 def check(bot, update, override_lock=None):
@@ -93,18 +205,17 @@ def check(bot, update, override_lock=None):
     """
 
     chat_id = update.message.chat_id
-    chat_str = str(chat_id)
 
     if chat_id > 0:
         send_async(bot, chat_id=chat_id,
                    text='Please add me to a group first!')
         return False
 
-    locked = override_lock if override_lock is not None \
-        else db.get(chat_str + '_lck')
+    chat = settings.get(chat_id)
+    locked = override_lock if override_lock is not None else chat.locked
 
-    if locked and db.get(chat_str + '_adm') != update.message.from_user.id:
-        if not db.get(chat_str + '_quiet'):
+    if locked and chat.admin != update.message.from_user.id:
+        if not chat.quiet:
             send_async(bot, chat_id=chat_id, text='Sorry, only the person who '
                                                   'invited me can do that.')
         return False
@@ -114,28 +225,38 @@ def check(bot, update, override_lock=None):
 
 # Welcome a user to the chat
 def welcome(bot, update):
-    """ Welcomes a user to the chat """
+    """
+    Welcomes users to the chat. The first to join is welcomed right away,
+    everyone who joins within a couple of seconds after that
+    (COALESCE_WINDOW in outbox.py) in one more message.
+    """
 
     message = update.message
     chat_id = message.chat.id
-    logger.info('%s joined to chat %d (%s)'
-                 % (escape(message.new_chat_members[0].first_name),
-                    chat_id,
-                    escape(message.chat.title)))
+    members = []
+    for member in message.new_chat_members:
+        if member.username == BOTNAME:
+            continue
+        logger.info('%s joined to chat %d (%s)',
+                    member.first_name, chat_id, message.chat.title)
+        members.append(member)
+    if members:
+        outbox.coalesce(chat_id, ('welcome', chat_id), members,
+                        partial(send_welcome, bot, message.chat))
+
+
+def send_welcome(bot, chat, members):
+    """ Sends one welcome message for members, run by the outbox """
 
     # Pull the custom message for this chat from the database
-    text = db.get(str(chat_id))
+    text = settings.get(chat.id).welcome
 
     # Use default message if there's no custom one set
-    if text is None:
-        text = 'Hello $username! Welcome to $title %s' \
-                  % emojize(":grinning_face_with_smiling_eyes:")
+    template = DEFAULT_WELCOME if text is None else templates.compile(text)
 
     # Replace placeholders and send message
-    text = text.replace('$username','<a href="tg://user?id={}">{}</a>'.format(
-                        message.new_chat_members[0].id,message.new_chat_members[0].first_name))\
-        .replace('$title', message.chat.title)
-    send_async(bot, chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+    text = template.render(chat, members)
+    return bot.send_message(chat_id=chat.id, text=text, parse_mode=ParseMode.HTML)
 
 
 # Welcome a user to the chat
@@ -144,27 +265,23 @@ def goodbye(bot, update):
 
     message = update.message
     chat_id = message.chat.id
-    logger.info('%s left chat %d (%s)'
-                 % (escape(message.left_chat_member.first_name),
-                    chat_id,
-                    escape(message.chat.title)))
+    logger.info('%s left chat %d (%s)', message.left_chat_member.first_name,
+                chat_id, message.chat.title)
 
     # Pull the custom message for this chat from the database
-    text = db.get(str(chat_id) + '_bye')
+    text = settings.get(chat_id).goodbye
 
     # Goodbye was disabled
     if text is False:
         return
 
     # Use default message if there's no custom one set
-    if text is None:
-        text = 'Goodbye, $username!'
+    template = DEFAULT_GOODBYE if text is None else templates.compile(text)
 
     # Replace placeholders and send message
-    text = text.replace('$username',
-                        message.left_chat_member.first_name)\
-        .replace('$title', message.chat.title)
-    send_async(bot, chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+    text = template.render(message.chat, [message.left_chat_member])
+    send_async(bot, chat_id=chat_id, text=text, parse_mode=ParseMode.HTML,
+               priority=WELCOME)
 
 
 # Introduce the bot to a chat its been added to
@@ -177,17 +294,16 @@ def introduce(bot, update):
     chat_id = update.message.chat.id
     invited = update.message.from_user.id
 
-    logger.info('Invited by %s to chat %d (%s)'
-                % (invited, chat_id, update.message.chat.title))
+    logger.info('Invited by %s to chat %d (%s)',
+                invited, chat_id, update.message.chat.title)
 
-    db.set(str(chat_id) + '_adm', invited)
-    db.set(str(chat_id) + '_lck', True)
+    settings.update(chat_id, admin=invited, locked=True)
 
     text = 'Hello %s! I will now greet anyone who joins this chat with a' \
            ' nice message %s \nCheck the /help command for more info!'\
            % (update.message.chat.title,
               emojize(":grinning_face_with_smiling_eyes:"))
-    send_async(bot, chat_id=chat_id, text=text)
+    send_async(bot, chat_id=chat_id, text=text, priority=WELCOME)
 
 
 # Print help text
@@ -195,9 +311,8 @@ def help(bot, update):
     """ Prints help text """
 
     chat_id = update.message.chat.id
-    chat_str = str(chat_id)
-    if (not db.get(chat_str + '_quiet') or db.get(chat_str + '_adm') ==
-            update.message.from_user.id):
+    chat = settings.get(chat_id)
+    if not chat.quiet or chat.admin == update.message.from_user.id:
         send_async(bot, chat_id=chat_id,
                    text=help_text,
                    parse_mode=ParseMode.MARKDOWN,
@@ -226,8 +341,9 @@ def set_welcome(bot, update, args):
                    parse_mode=ParseMode.HTML)
         return
 
-    # Put message into database
-    db.set(str(chat_id), message)
+    # Put message into database, compiled once here for the next join
+    templates.compile(message)
+    settings.update(chat_id, welcome=message)
 
     send_async(bot, chat_id=chat_id, text='Got it!')
 
@@ -253,8 +369,9 @@ def set_goodbye(bot, update, args):
                    parse_mode=ParseMode.HTML)
         return
 
-    # Put message into database
-    db.set(str(chat_id) + '_bye', message)
+    # Put message into database, compiled once here for the next leave
+    templates.compile(message)
+    settings.update(chat_id, goodbye=message)
 
     send_async(bot, chat_id=chat_id, text='Got it!')
 
@@ -269,13 +386,13 @@ def disable_goodbye(bot, update):
         return
 
     # Disable goodbye message
-    db.set(str(chat_id) + '_bye', False)
+    settings.update(chat_id, goodbye=False)
 
     send_async(bot, chat_id=chat_id, text='Got it!')
 
 
 def enable_goodbye(bot, update):
-    """ Disables the goodbye message """
+    """ Enables the default goodbye message """
 
     chat_id = update.message.chat.id
 
@@ -283,8 +400,8 @@ def enable_goodbye(bot, update):
     if not check(bot, update):
         return
 
-    # Disable goodbye message
-    db.set(str(chat_id) + '_bye', True)
+    # Enable goodbye message
+    settings.update(chat_id, goodbye=None)
 
     send_async(bot, chat_id=chat_id, text='Got it!')
 
@@ -299,7 +416,7 @@ def lock(bot, update):
         return
 
     # Lock the bot for this chat
-    db.set(str(chat_id) + '_lck', True)
+    settings.update(chat_id, locked=True)
 
     send_async(bot, chat_id=chat_id, text='Got it!')
 
@@ -314,7 +431,7 @@ def quiet(bot, update):
         return
 
     # Lock the bot for this chat
-    db.set(str(chat_id) + '_quiet', True)
+    settings.update(chat_id, quiet=True)
 
     send_async(bot, chat_id=chat_id, text='Got it!')
 
@@ -329,7 +446,7 @@ def unquiet(bot, update):
         return
 
     # Lock the bot for this chat
-    db.set(str(chat_id) + '_quiet', False)
+    settings.update(chat_id, quiet=False)
 
     send_async(bot, chat_id=chat_id, text='Got it!')
 
@@ -344,11 +461,46 @@ def unlock(bot, update):
         return
 
     # Unlock the bot for this chat
-    db.set(str(chat_id) + '_lck', False)
+    settings.update(chat_id, locked=False)
 
     send_async(bot, chat_id=chat_id, text='Got it!')
 
 
+def my_chats(bot, update):
+    """
+    Lists the chats the user invited the bot to. Only in a private chat, so
+    a group doesn't learn about the user's other chats. With shards, only
+    the chats of the shard that owns the private chat are known.
+    """
+
+    chat_id = update.message.chat.id
+
+    if chat_id < 0:
+        if not settings.get(chat_id).quiet:
+            send_async(bot, chat_id=chat_id,
+                       text='Send me /mychats in a private chat.')
+        return
+
+    chats = sorted(db.lookup('admin', update.message.from_user.id), key=int)
+    if not chats:
+        send_async(bot, chat_id=chat_id,
+                   text='You haven\'t invited me to any chats yet.')
+        return
+
+    lines = ['You invited me to %d chat%s:' % (len(chats),
+                                              's' if len(chats) > 1 else '')]
+    for chat in chats[:MYCHATS_LIMIT]:
+        record = settings.get(int(chat))
+        flags = [name for name, on in (('locked', record.locked),
+                                       ('quiet', record.quiet),
+                                       ('goodbye disabled',
+                                        record.goodbye is False)) if on]
+        lines.append('%s %s' % (chat, ', '.join(flags)) if flags else chat)
+    if len(chats) > MYCHATS_LIMIT:
+        lines.append('and %d more' % (len(chats) - MYCHATS_LIMIT))
+    send_async(bot, chat_id=chat_id, text='\n'.join(lines))
+
+
 def empty_message(bot, update):
     """
     Empty messages could be status messages, so we check them if there is a new
@@ -356,20 +508,16 @@ def empty_message(bot, update):
     """
 
     # Keep chatlist
-    chats = db.get('chats')
-
-    if update.message.chat.id not in chats:
-        chats.append(update.message.chat.id)
-        db.set('chats', chats)
-        logger.info("I have been added to %d chats" % len(chats))
+    if db.sadd('chats', update.message.chat.id):
+        logger.info("I have been added to %d chats", db.slen('chats'))
 
     if len(update.message.new_chat_members) > 0:
-        # Bot was added to a group chat
-        if update.message.new_chat_members[0].username == BOTNAME:
-            return introduce(bot, update)
-        # Another user joined the chat
-        else:
-            return welcome(bot, update)
+        # Bot was added to a group chat, maybe along with others
+        if any(member.username == BOTNAME
+               for member in update.message.new_chat_members):
+            introduce(bot, update)
+        # Other users joined the chat
+        return welcome(bot, update)
 
     # Someone left the chat
     elif update.message.left_chat_member is not None:
@@ -377,6 +525,56 @@ def empty_message(bot, update):
             return goodbye(bot, update)
 
 
+def broadcast(bot, update):
+    """
+    Sends a message to every chat the bot knows, see broadcast.py. Only for
+    OWNERS, in a private chat: "/broadcast <message>" starts it,
+    "/broadcast" tells how far it got and "/broadcast cancel" stops it.
+    With shards, every worker gets the command (see shards.FANOUT) and runs
+    the broadcast for the chats of its shard, its replies tell which shard
+    they're from.
+    """
+    global broadcaster
+
+    message = update.message
+    chat_id = message.chat.id
+    if chat_id < 0 or message.from_user.id not in OWNERS:
+        return
+
+    parts = message.text.split(None, 1)
+    running = broadcaster is not None and not broadcaster.done
+    if len(parts) == 1:
+        text = broadcaster.status() if broadcaster is not None else \
+            'Send /broadcast <message> to send a message to every chat.'
+    elif parts[1] == 'cancel':
+        if running:
+            return broadcaster.cancel()
+        text = 'No broadcast is running, nothing to cancel.'
+    elif running:
+        text = 'A broadcast is running already: ' + broadcaster.status()
+    else:
+        broadcaster = new_broadcast(bot, text=parts[1], owner=chat_id)
+        return broadcaster.start()
+    send_async(bot, chat_id=chat_id, text=shard_label(text))
+
+
+def new_broadcast(bot, **kwargs):
+    """ Returns a Broadcast through the bot, see broadcast.py """
+    return Broadcast(
+        db, outbox,
+        lambda chat_id, text: bot.send_message(chat_id=chat_id, text=text),
+        lambda owner, text: send_async(bot, chat_id=owner,
+                                       text=shard_label(text)),
+        **kwargs)
+
+
+def shard_label(text):
+    """ Tells which shard a reply is from, when there are shards """
+    if SHARD is None:
+        return text
+    return 'Shard %s of %d: %s' % (SHARD, SHARDS, text)
+
+
 family_chat = -1001186177604
 test_chat = -313765365
 
@@ -394,116 +592,36 @@ def send_family_chat_msg(bot, update):
 
 
 def bis_bald(bot, update):
-    chats = db.get('chats')
-    if update.message.chat.id not in chats:
-        chats.append(update.message.chat.id)
-        db.set('chats', chats)
-        logger.info("I have been added to %d chats" % len(chats))
-    logger.info("id: {}, name: {}".format(update.message.from_user.id, update.message.from_user.first_name))
+    if db.sadd('chats', update.message.chat.id):
+        logger.info("I have been added to %d chats", db.slen('chats'))
+    logger.debug("id: %s, name: %s", update.message.from_user.id,
+                 update.message.from_user.first_name)
 
     if update.message.sticker is not None:
         if update.message.sticker.set_name == "SweetyBee" and update.message.sticker.emoji == "😏":
-            return send_sticker(bot, update, bot.get_sticker_set("covid2019byhro").stickers[0], True)
+            return send_sticker(bot, update, "covid2019byhro", 0, True)
 
     if update.message.text is not None:
         msg = update.message.text.lower()
-        characters = ["Jonas", "David", "Abdi", "Carlos", "Omar", "Essam", "Mohammed", "Stefan",
-                      "Kiki", "Sam", "Alex", "Sara", "Leonie", "Laura", "Hans",
-                      "Linn", "Rentier", "Farid"]
-        mains = ["Matteo", "Hanna", "Mia", "Amira"]
-
-        if bot.name.lower() in msg and bot.name.lower() != msg:
-            return at_handler(bot, update)
-
-        if "bis" in msg and "bald" in msg:
-            msgs = [emojize("Bis bald :red_heart:")]
-                    #emojize("{}, :police_car_light:")]
-            return echo(bot, update, msgs[random.randint(0, len(msgs)-1)])
-        """if "sommer 2020" in msg or "summer 2020" in msg:
-            msgs = ["{}, can summer come already?!",
-                    emojize("Summer 2020? Can't wait! :smiling_face_with_smiling_eyes:"),
-                   emojize("{}, :police_car_light: :police_car_light: :police_car_light:")]
-            return echo(bot, update, msgs[random.randint(0, len(msgs)-1)])"""
-        """if "sad" in msg or "traurigkeit" in msg:
-            msgs = ['Who said "sad"? I\'m calling positive police! <a href="tg://user?id={}">{}</a>',
-                    emojize("Wee woo wee woo! :oncoming_police_car:"),
-                    "{}, this is the positive police, we don't use word \"sad\" in this chat",
-                    "{}, sad spelled backwards is das and das not good."]
-            return echo(bot, update, msgs[random.randint(0, len(msgs)-1)])
-        if " s a d " in msg or "s*d" in msg or "s a d" == msg:
-            msgs = [emojize('{}, are you trying to mask word sad? :thinking_face:'),
-                    emojize("{}, I see what you're trying to do :eyes:"),
-                    "{}, nice try"]
-            return echo(bot, update, msgs[random.randint(0, len(msgs)-1)])"""
-        if "family" in msg and "chat" in msg:
-            msgs = [emojize('That\'s right, we\'re all family here :red_heart:')]
-            return echo(bot, update, msgs[random.randint(0, len(msgs)-1)])
-
-        if "lonely" in msg:
-            return echo(bot, update, "Lonely like island Ibiza", reply=True)
-
-        if "hollandaise" in msg and "pizza" in msg:
-            return echo(bot, update, "{}, I want a pizza margherita with extra tzatziki", reply=True)
-
-        if "pineapple pizza" in msg or "mint chocolate" in msg or "toast hawaii" in msg:
-            msgs = [emojize('Oh nooo, no food debates!'),
-                    "Here we go again",
-                    "{}, food discussions are important but first, let me make some tea"]
-            return echo(bot, update, msgs[random.randint(0, len(msgs) - 1)])
-
-        if "hawaii toast" in msg or "hawaii sandwich" in msg:
-            return send_photo(bot, update, "hawaii.jpg", caption=";)", reply=True)
-
-        if "food discussion" in msg or "food debate" in msg or "here we go again" in msg:
-            return send_photo(bot, update, "gta.jpg", caption="", reply=True)
-
-        #if "wtfock" in msg or "wtfrick" in msg:
-        #    return send_sticker(bot, update, bot.get_sticker_set("Druckfamilyquotes").stickers[19], True)
-
-        if "daddy" in msg:
-            msgs = [emojize('{}, papa'), emojize("Papa :index_pointing_up:"),
-                    "You need to stop using word \"daddy\", otherwise you'll become lonely. And other things will become your friends."]
-            return echo(bot, update, msgs[random.randint(0, len(msgs)-1)], reply=True)
-
-        if "bjorn" in msg or "bj*rn" in msg or "björn" in msg:
-            msgs = [emojize('Ugh, Bj*rn :face_vomiting:')]
-            return echo(bot, update, msgs[random.randint(0, len(msgs)-1)])
-
-        if "missing" in msg and "hours" in msg:
-            msgs = [emojize('Agree'), "Always.", "Every hour is missing {} hour".format(msg.split("missing ")[1].split(" hours")[0])]
-            return echo(bot, update, msgs[random.randint(0, len(msgs)-1)], reply=True)
-
-        if ("rentier" in msg and not bot.name.lower() in msg) or (msg == bot.name.lower()): #exclude mention
-            msgs = [emojize('Psss, want some weed?'),
-                    "Someone's called me?",
-                    "{}, password?",
-                    "{}, listen, every person is an island.",
-                    "{}, coffee?",
-                    "Yeah?"]
-            if update.message.from_user.id == 909049413:
-                msgs.append(emojize("{}, I know you don't like me, but I like you and that's enough! :red_heart:"))
-                msgs.append(emojize("Why you don't like me, {}? :disappointed_face:"))
-                msgs.append("I'm here to annoy Angelika")
-            return echo(bot, update, msgs[random.randint(0, len(msgs)-1)])
-
-        if "reindeer" == msg:
-            msgs = ["{}, I changed this password 3 months ago."]
-            return echo(bot, update, msgs[random.randint(0, len(msgs) - 1)])
-
-        if "superior" in msg:
-            return send_sticker(bot, update, bot.get_sticker_set("water81818").stickers[10], True)
-
-        if update.message.reply_to_message is not None:
-            if update.message.reply_to_message.from_user.id == bot.id:
-                if "coffee" in update.message.reply_to_message.text.lower():
-                    return coffee_reply(bot, update)
-
-        if "constantin" in msg:
-            consti = ["Constantpain", "Constantshit", "Constantmood", "Constantdrama", "Constantinople", "Constipation",
-                      "Cantstandhim", "Constandick", "Nora's evil twin", "Constellation"]
-            msgs = [emojize('Constantin? 🤔 Did you mean {}'.format(consti[random.randint(0, len(consti) - 1)]))]
-            return echo(bot, update, msgs[random.randint(0, len(msgs) - 1)], reply=True)
-
+        trigger = BANTER.compile(bot.name.lower()).match(bot, update, msg)
+        if trigger is not None:
+            TRIGGER_HITS.inc(trigger=trigger.name)
+            return respond(bot, update, trigger.response, msg)
+
+
+def respond(bot, update, response, msg):
+    """ Sends the response of a trigger, see triggers.py """
+    if isinstance(response, Echo):
+        return echo(bot, update, response.choose(update, msg),
+                    reply=response.reply)
+    if isinstance(response, Photo):
+        return send_photo(bot, update, response.photo, response.caption,
+                          reply=response.reply)
+    if isinstance(response, Sticker):
+        return send_sticker(bot, update, response.set_name, response.index,
+                            response.reply)
+    if isinstance(response, Handler):
+        return HANDLERS[response.name](bot, update)
 
 
 def coffee_reply(bot, update):
@@ -514,51 +632,27 @@ def coffee_reply(bot, update):
 
 
 def send_photo(bot, update, photo, caption, reply=False):
-    f = join(dirname(realpath(__file__)), "resources", "photos", photo)
+    message = update.message
+    chat_id = message.chat.id
     if reply:
-        bot.send_photo(update.message.chat.id, open(f, 'rb'), caption, reply_to_message=update.message.message_id)
+        job = partial(photos.send_photo, bot, chat_id, photo, caption, reply_to_message_id=message.message_id)
     else:
-        bot.send_photo(update.message.chat.id, open(f, 'rb'), caption)
+        job = partial(photos.send_photo, bot, chat_id, photo, caption)
+    outbox.submit(chat_id, job, CHATTER)
 
 def at_handler(bot, update):
     msg = update.message.text.lower()
-    if bot.name.lower() in msg and "coffee" in msg:
-        photo = join(dirname(realpath(__file__)), "resources", "photos", "rentier_coffee.jpg")
-        return bot.send_photo(update.message.chat.id, open(photo, 'rb'), "Here!",
-                       reply_to_message=update.message.message_id)
-
-    if bot.name.lower() in msg and ("days till" in msg or "days until" in msg) and (
-            "druck" in msg or "season 5" in msg):
-        date_from = datetime(2020, 6, 22, 13, 0, tzinfo=timezone.utc)
-        date_now = datetime.now(tz=timezone.utc)
-        days = (date_from - date_now).days
-        return echo(bot, update, "Days until druck: {}".format(days))
-
-    if bot.name.lower() in msg and "shakshuka" in msg:
-        photo = join(dirname(realpath(__file__)), "resources", "photos", "shakshuka.jpg")
-        return bot.send_photo(update.message.chat.id, open(photo, 'rb'), "Bon Appetit!",
-                              reply_to_message=update.message.message_id)
-
-    if bot.name.lower() in msg and "sandwich" in msg:
-        photo = join(dirname(realpath(__file__)), "resources", "photos", "sandwiches.jpg")
-        return bot.send_photo(update.message.chat.id, open(photo, 'rb'), "Here!",
-                              reply_to_message=update.message.message_id)
-
-    if bot.name.lower() in msg and "pancake" in msg:
-        photo = join(dirname(realpath(__file__)), "resources", "photos", "pancake.jpg")
-        return bot.send_photo(update.message.chat.id, open(photo, 'rb'), ";)",
-                              reply_to_message=update.message.message_id)
-
-    if bot.name.lower() in msg and " cake" in msg:
-        photo = join(dirname(realpath(__file__)), "resources", "photos", "cake.jpg")
-        return bot.send_photo(update.message.chat.id, open(photo, 'rb'), ";)",
-                              reply_to_message=update.message.message_id)
+    trigger = AT_BANTER.compile(bot.name.lower()).match(bot, update, msg)
+    if trigger is not None:
+        TRIGGER_HITS.inc(trigger=trigger.name)
+        return respond(bot, update, trigger.response, msg)
 
-    if bot.name.lower() in msg and "muffin" in msg:
-        photo = join(dirname(realpath(__file__)), "resources", "photos", "muffins.jpg")
-        return bot.send_photo(update.message.chat.id, open(photo, 'rb'), ";)",
-                              reply_to_message=update.message.message_id)
 
+# The handlers a Handler response of triggers.py may name
+HANDLERS = {
+    'at_handler': at_handler,
+    'coffee_reply': coffee_reply,
+}
 
 
 def echo(bot, update, msg, reply=False):
@@ -566,76 +660,208 @@ def echo(bot, update, msg, reply=False):
     chat_id = message.chat.id
 
     # Replace placeholders and send message
-    text = msg.format('<a href="tg://user?id={}">{}</a>'.format(
-        message.from_user.id, message.from_user.first_name))
+    text = msg.format(templates.mention(message.from_user))
     if reply:
-        send_async(bot, chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, reply_to_message_id=message.message_id)
+        send_async(bot, chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, reply_to_message_id=message.message_id, priority=CHATTER)
     else:
-        send_async(bot, chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+        send_async(bot, chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, priority=CHATTER)
 
 
-def send_sticker(bot, update, sticker, reply=False):
+def send_sticker(bot, update, set_name, index, reply=False):
     message = update.message
     chat_id = message.chat.id
     #sset = bot.get_sticker_set("Druckfamilyquotes")
     if reply:
-        bot.send_sticker(chat_id, sticker, reply_to_message_id=message.message_id)
+        job = partial(sticker_sets.send_sticker, bot, chat_id, set_name, index, reply_to_message_id=message.message_id)
     else:
-        bot.send_sticker(chat_id, sticker)
+        job = partial(sticker_sets.send_sticker, bot, chat_id, set_name, index)
+    outbox.submit(chat_id, job, CHATTER)
 
 
 def error(bot, update, error, **kwargs):
     """ Error handling """
 
-    try:
-        if isinstance(error, TelegramError)\
-                and error.message == "Unauthorized"\
-                or "PEER_ID_INVALID" in error.message\
-                and isinstance(update, Update):
+    if not isinstance(error, TelegramError):
+        # A bug in a handler rather than Telegram refusing something
+        logger.error('Handling update %s failed',
+                     getattr(update, 'update_id', None), exc_info=error)
+    elif isinstance(update, Update) and update.effective_chat is not None:
+        send_failed(update.effective_chat.id, error)
+    else:
+        logger.error("An error (%s) occurred: %s", type(error), error)
+
+
+def send_failed(chat_id, error):
+    """ Error handling for messages to chat_id, see outbox.Outbox """
 
-            chats = db.get('chats')
-            chats.remove(update.message.chat_id)
-            db.set('chats', chats)
-            logger.info('Removed chat_id %s from chat list'
-                        % update.message.chat_id)
-        else:
-            logger.error("An error (%s) occurred: %s"
-                         % (type(error), error.message))
-    except:
-        pass
+    # Telegram answers 403 Forbidden to chats that blocked or removed the
+    # bot; python-telegram-bot turns PEER_ID_INVALID into Peer_id_invalid
+    if isinstance(error, Unauthorized) \
+            or "PEER_ID_INVALID" in str(error).upper():
+
+        db.srem('chats', chat_id)
+        logger.info('Removed chat_id %s from chat list', chat_id)
+    else:
+        logger.error("An error (%s) occurred: %s", type(error), error)
+
+
+# Everything the bot sends is queued here, see outbox.py. Handlers only ever
+# queue jobs, so they can run on the event loop of the asyncio runtime as is;
+# there the jobs return coroutines of the async bot.
+# Shards share the global rate limit.
+outbox = (AsyncOutbox if RUNTIME == 'asyncio' else Outbox)(
+    on_error=send_failed, global_rate=GLOBAL_RATE / SHARDS,
+    global_burst=max(1, GLOBAL_BURST // SHARDS))
+metrics.Gauge('bot_outbox_pending', 'Messages queued for sending',
+              outbox.pending)
+
+# The handlers of the threads runtime run here, one update of a chat at a
+# time, see keyed.py and add_handlers(). The asyncio runtime handles updates
+# on its event loop in the order they come.
+updates = None if RUNTIME == 'asyncio' else KeyedExecutor(name='handler')
+
+# The last broadcast started, see broadcast()
+broadcaster = None
+
+# Commands: (command, handler, whether the handler takes the words after it)
+COMMANDS = [
+    ("start", help, False),
+    ("help", help, False),
+    ('welcome', set_welcome, True),
+    ('goodbye', set_goodbye, True),
+    ('disable_goodbye', disable_goodbye, False),
+    ('enable_goodbye', enable_goodbye, False),
+    ("lock", lock, False),
+    ("unlock", unlock, False),
+    ("quiet", quiet, False),
+    ("unquiet", unquiet, False),
+    ("mychats", my_chats, False),
+    ("broadcast", broadcast, False),
+    ("sendtest", send_test_chat_msg, False),
+    ("sendfamily", send_family_chat_msg, False),
+]
+
+
+def start(bot):
+    """ Runs once the bot is connected, before the first update """
+    if METRICS_PORT:
+        metrics.serve(int(METRICS_PORT) + int(SHARD or 0))
+    sticker_sets.prewarm(bot, STICKER_SETS)
+    outbox.start()
+    if updates is not None:
+        updates.start()
+
+    # Pick up a broadcast the last run didn't finish
+    global broadcaster
+    checkpoint = db.get('broadcast')
+    if checkpoint is not None:
+        broadcaster = new_broadcast(bot, checkpoint=checkpoint)
+        broadcaster.start()
+
+
+def stop():
+    """ Runs after the last update """
+    if updates is not None:
+        # Handle what's queued, the replies go in the outbox
+        updates.stop()
+    if broadcaster is not None:
+        broadcaster.pause()
+    outbox.stop(timeout=10)
+    if broadcaster is not None:
+        broadcaster.save()
+    logger.info('Sticker set cache: %s', sticker_sets.stats())
+
+    # Write out whatever the flusher still holds
+    db.close()
+    log_listener.stop()
+
+
+def instrumented(callback):
+    """ Returns callback, timing it and counting its errors """
+    return metrics.timed(HANDLER_SECONDS, HANDLER_ERRORS,
+                         handler=callback.__name__)(callback)
+
+
+def queued(callback, shed=False):
+    """ Returns callback, queued on updates by chat instead of run on the
+    thread of python-telegram-bot's Dispatcher. With shed, the update may
+    be dropped when its chat is flooding, see keyed.py. """
+    def submit(bot, update, **kwargs):
+        def job():
+            try:
+                callback(bot, update, **kwargs)
+            except Exception as e:
+                error(bot, update, e)
+        updates.submit(update.effective_chat.id, job, shed=shed)
+    return submit
+
+
+def async_dispatcher(bot):
+    """ Returns the dispatcher of the asyncio runtime for an AsyncBot """
+    import aiobot
+    dispatcher = aiobot.Dispatcher(
+        bot, [(command, instrumented(callback), pass_args)
+              for command, callback, pass_args in COMMANDS],
+        [(aiobot.status_update, instrumented(empty_message)),
+         (aiobot.group, instrumented(bis_bald))],
+        error)
+    metrics.Gauge('bot_updates_pending', 'Updates received but not handled '
+                  'yet', dispatcher.depth)
+    return dispatcher
+
+
+def add_handlers(dp):
+    """ Registers the handlers with a python-telegram-bot Dispatcher """
+    for command, callback, pass_args in COMMANDS:
+        dp.add_handler(CommandHandler(command, queued(instrumented(callback)),
+                                      pass_args=pass_args))
+
+    dp.add_handler(MessageHandler([Filters.status_update],
+                                  queued(instrumented(empty_message))))
+    # Banter is the first thing to go when a chat floods the bot
+    dp.add_handler(MessageHandler(Filters.group,
+                                  queued(instrumented(bis_bald), shed=True)))
+    metrics.Gauge('bot_updates_pending', 'Updates received but not handled '
+                  'yet', lambda: dp.update_queue.qsize() + updates.pending())
+
+    #dp.add_handler(MessageHandler([Filters.text], stats))
+
+    dp.add_error_handler(error)
 
 
 def main():
+    if MODE == 'webhook' and RUNTIME != 'asyncio':
+        sys.exit('mode = webhook needs runtime = asyncio in token.ini')
+
+    if RUNTIME == 'asyncio':
+        import aiobot
+        webhook = None
+        if MODE == 'webhook' and SHARD is None:
+            webhook = {
+                'url': get_settings("Webhook", "url"),
+                'listen': get_settings("Webhook", "listen",
+                                       fallback="0.0.0.0"),
+                'port': int(get_settings("Webhook", "port", fallback="8443")),
+            }
+        dispatcher = async_dispatcher(aiobot.AsyncBot(TOKEN, API_URL))
+        return aiobot.run(dispatcher, start, stop, webhook,
+                          sys.stdin if SHARD is not None else None)
+
     # Create the Updater and pass it your bot's token.
     #updater = Updater(TOKEN, workers=10, request_kwargs=REQUEST_KWARGS)
-    updater = Updater(TOKEN, workers=10)
+    updater = Updater(TOKEN, base_url=API_URL, workers=10)
 
     # Get the dispatcher to register handlers
-    dp = updater.dispatcher
-
-    dp.add_handler(CommandHandler("start", help))
-    dp.add_handler(CommandHandler("help", help))
-    dp.add_handler(CommandHandler('welcome', set_welcome, pass_args=True))
-    dp.add_handler(CommandHandler('goodbye', set_goodbye, pass_args=True))
-    dp.add_handler(CommandHandler('disable_goodbye', disable_goodbye))
-    dp.add_handler(CommandHandler('enable_goodbye', enable_goodbye))
-    dp.add_handler(CommandHandler("lock", lock))
-    dp.add_handler(CommandHandler("unlock", unlock))
-    dp.add_handler(CommandHandler("quiet", quiet))
-    dp.add_handler(CommandHandler("unquiet", unquiet))
-    dp.add_handler(CommandHandler("sendtest", send_test_chat_msg))
-    dp.add_handler(CommandHandler("sendfamily", send_family_chat_msg))
-
-    dp.add_handler(MessageHandler([Filters.status_update], empty_message))
-    dp.add_handler(MessageHandler(Filters.group, bis_bald))
+    add_handlers(updater.dispatcher)
 
-    #dp.add_handler(MessageHandler([Filters.text], stats))
-
-    dp.add_error_handler(error)
+    start(updater.bot)
 
     update_queue = updater.start_polling(timeout=30, clean=False)
 
     updater.idle()
 
+    # Updater has stopped
+    stop()
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Broadcasts: one message sent to every chat in the chat registry, the
+'chats' set of the db, started by the owner of the bot with /broadcast.
+
+A Broadcast goes through the chat ids in ascending order and keeps at most
+window of its messages in the outbox at a time. They have the lowest
+priority (BROADCAST), so replies to users go first, and the outbox's
+global bucket sets the pace. Chats that blocked or removed the bot fail
+with Unauthorized or PEER_ID_INVALID and are pruned from the registry by
+the outbox's on_error, like for any other message.
+
+Progress is checkpointed in the db, so a broadcast that was running when
+the bot stopped is resumed on the next start:
+
+broadcast -> {"text": the message,
+              "owner": chat id progress is reported to,
+              "cursor": every chat up to this id has been sent to,
+              "sent": messages sent so far,
+              "failed": messages that could not be sent so far}
+
+When the bot is stopped the outbox finishes what's queued first, so the
+checkpoint is exact. After a crash, the messages sent since the last
+checkpoint that made it to disk are sent again, up to about
+CHECKPOINT_EVERY + window of them.
+"""
+import inspect
+import logging
+import threading
+import time
+
+from telegram.error import RetryAfter
+
+import metrics
+from outbox import BROADCAST
+
+# Key of the checkpoint in the db
+KEY = 'broadcast'
+
+# Messages of a broadcast queued in the outbox at a time
+WINDOW = 100
+
+# Messages between checkpoints, each of which is written to disk right away
+CHECKPOINT_EVERY = 100
+
+# Seconds between progress lines in the log
+PROGRESS_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+MESSAGES = metrics.Counter('bot_broadcast_messages_total',
+                           'Messages of broadcasts by whether they were sent',
+                           ['result'])
+
+
+class Broadcast(object):
+    """
+    Sends text to every chat of the registry in db through outbox.
+    send(chat_id, text) makes the API call or returns an awaitable of it,
+    report(owner, text) tells the owner how it's going. With checkpoint, an
+    interrupted broadcast is resumed after the cursor it saved.
+    """
+
+    def __init__(self, db, outbox, send, report, text=None, owner=None,
+                 checkpoint=None, window=WINDOW):
+        if checkpoint is not None:
+            text = checkpoint['text']
+            owner = checkpoint['owner']
+        self.db = db
+        self.outbox = outbox
+        self.send = send
+        self.report = report
+        self.text = text
+        self.owner = owner
+        self.window = window
+        self.lock = threading.Lock()
+        self.cursor = checkpoint['cursor'] if checkpoint else None
+        self.sent = checkpoint['sent'] if checkpoint else 0
+        self.failed = checkpoint['failed'] if checkpoint else 0
+        self.resumed = self.sent + self.failed
+        self.chats = sorted(chat for chat in db.get('chats') or ()
+                            if self.cursor is None or chat > self.cursor)
+        self.total = len(self.chats) + self.resumed
+        # Index of the next chat to queue, indexes of those in the outbox
+        # and of those that failed past the last checkpoint
+        self.next = 0
+        self.queued = set()
+        self.failures = set()
+        self.done = False
+        self.paused = False
+        self.flusher = None
+        self.started = time.monotonic()
+        self.logged = self.started
+
+    def start(self):
+        """ Starts sending, or resuming """
+        if self.resumed:
+            logger.info('Resuming broadcast after chat %s, %d chats to go',
+                        self.cursor, len(self.chats))
+        else:
+            logger.info('Broadcasting to %d chats', self.total)
+        if not self.chats:
+            with self.lock:
+                self.done = True
+                self._forget()
+            return self._finish()
+        self.save()
+        self._fill()
+
+    def pause(self):
+        """ Stops queueing messages, at shutdown. The outbox still sends
+        those it has, save() once it's done. """
+        with self.lock:
+            self.paused = True
+
+    def cancel(self):
+        """ Stops the broadcast for good """
+        with self.lock:
+            self.paused = True
+            self.done = True
+            self._forget()
+        logger.info('Broadcast cancelled: %s', self.status())
+        self.report(self.owner, 'Broadcast cancelled. ' + self.status())
+
+    def save(self):
+        """ Checkpoints the progress in the db """
+        with self.lock:
+            if self.done:
+                return
+            first = min(self.queued) if self.queued else self.next
+            if first:
+                self.cursor = self.chats[first - 1]
+            # Messages past the cursor are sent again on resume, so they
+            # don't count yet
+            self.failures = set(i for i in self.failures if i >= first)
+            ahead = self.next - first - len(self.queued)
+            failed = self.failed - len(self.failures)
+            sent = self.sent - (ahead - len(self.failures))
+            # Under the lock, so it can't be written after _forget()
+            self.db.set(KEY, {'text': self.text, 'owner': self.owner,
+                              'cursor': self.cursor, 'sent': sent,
+                              'failed': failed})
+
+    def status(self):
+        """ Returns a line on the progress of the broadcast """
+        with self.lock:
+            done = self.sent + self.failed
+            rate = (done - self.resumed) / max(time.monotonic() -
+                                               self.started, 1e-3)
+        text = '%d of %d chats done, %d failed, %.1f messages/s' % (
+            done, self.total, self.failed, rate)
+        if rate and done < self.total:
+            text += ', about %.0f min left' % (
+                (self.total - done) / rate / 60)
+        return text
+
+    def _finish(self):
+        """ Tells the owner the broadcast is done """
+        logger.info('Broadcast done: %s', self.status())
+        self.report(self.owner, 'Broadcast done. ' + self.status())
+
+    def _flush(self):
+        """ Writes the db, and so the checkpoint, in a thread of its own so
+        sending doesn't wait for it. Skipped while the last one still runs,
+        the write-behind flusher gets to it later. """
+        if self.flusher is not None and self.flusher.is_alive():
+            return
+        self.flusher = threading.Thread(target=self.db.flush,
+                                        name='broadcast-checkpoint',
+                                        daemon=True)
+        self.flusher.start()
+
+    def _forget(self):
+        # Called with lock held
+        if self.db.get(KEY) is not None:
+            self.db.rem(KEY)
+
+    def _fill(self):
+        """ Queues messages until window of them are in the outbox """
+        with self.lock:
+            if self.paused:
+                return
+            indexes = []
+            while len(self.queued) < self.window \
+                    and self.next < len(self.chats):
+                indexes.append(self.next)
+                self.queued.add(self.next)
+                self.next += 1
+        for index in indexes:
+            self.outbox.submit(self.chats[index], self._job(index),
+                               BROADCAST)
+
+    def _job(self, index):
+        chat_id = self.chats[index]
+
+        def job():
+            try:
+                result = self.send(chat_id, self.text)
+            except Exception as e:
+                self._finished(index, e)
+                raise
+            if inspect.isawaitable(result):
+                return self._wait(index, result)
+            self._finished(index)
+        return job
+
+    async def _wait(self, index, result):
+        try:
+            await result
+        except Exception as e:
+            self._finished(index, e)
+            raise
+        self._finished(index)
+
+    def _finished(self, index, error=None):
+        """ Bookkeeping after the message for chats[index] was sent, or
+        raised error. The outbox reports the error. """
+        if isinstance(error, RetryAfter):
+            # The outbox sends it again later
+            return
+        MESSAGES.inc(result='sent' if error is None else 'failed')
+        now = time.monotonic()
+        with self.lock:
+            self.queued.discard(index)
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+                self.failures.add(index)
+            done = self.sent + self.failed
+            finished = not self.queued and self.next == len(self.chats) \
+                and not self.done
+            if finished:
+                self.done = True
+                self._forget()
+            log = now - self.logged >= PROGRESS_SECONDS
+            if log:
+                self.logged = now
+        if finished:
+            return self._finish()
+        if log:
+            logger.info('Broadcast: %s', self.status())
+        if done % CHECKPOINT_EVERY == 0:
+            self.save()
+            self._flush()
+        self._fill()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Per-chat settings of the bot.
+
+Each chat's settings are kept as one record in the db, a dict stored under
+the chat id:
+
+<chat_id> -> {"welcome": welcome message or null for the default,
+              "goodbye": goodbye message, null for the default or false
+                         if goodbye messages are disabled,
+              "admin": user id of the user who invited the bot,
+              "locked": true if only the admin may change settings,
+              "quiet": true if the bot is quieted}
+
+Older versions used one top-level key per setting (<chat_id>, <chat_id>_bye,
+<chat_id>_adm, <chat_id>_lck and <chat_id>_quiet). migrate() converts those,
+either on bot startup or by running this file on a db:
+
+    python3 chatsettings.py bot.db
+"""
+import re
+import sys
+
+import python3pickledb as pickledb
+
+# Bumped whenever the settings layout in the db changes
+SCHEMA_VERSION = 2
+
+# Number of chats whose settings are kept in memory
+CACHE_SIZE = 5000
+
+OLD_KEY = re.compile(r'^(-?\d+)(_bye|_adm|_lck|_quiet)?$')
+
+
+class ChatSettings(object):
+    """
+    Settings of one chat. Instances handed out by SettingsStore are shared
+    between threads and must not be modified, use SettingsStore.update().
+    """
+
+    __slots__ = ('welcome', 'goodbye', 'admin', 'locked', 'quiet')
+
+    def __init__(self, welcome=None, goodbye=None, admin=None, locked=False,
+                 quiet=False):
+        self.welcome = welcome
+        self.goodbye = goodbye
+        self.admin = admin
+        self.locked = locked
+        self.quiet = quiet
+
+    @classmethod
+    def from_dict(cls, record):
+        """ Builds settings from a db record, ignoring unknown fields """
+        return cls(**{k: v for k, v in record.items() if k in cls.__slots__})
+
+    def to_dict(self):
+        """ Returns the db record of these settings """
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def replace(self, **changes):
+        """ Returns a copy of these settings with some fields changed """
+        record = self.to_dict()
+        record.update(changes)
+        return ChatSettings(**record)
+
+    def __repr__(self):
+        return 'ChatSettings(%s)' % ', '.join(
+            '%s=%r' % (k, getattr(self, k)) for k in self.__slots__)
+
+
+class SettingsStore(object):
+    """
+    Reads and writes ChatSettings records, keeping the records of the
+    cache_size most recently active chats in memory so a handler needs one
+    dict lookup for all settings of a chat. Memory stays flat no matter how
+    many inactive chats the bot is in.
+    """
+
+    def __init__(self, db, cache_size=CACHE_SIZE):
+        self.db = db
+        self.cache = pickledb.LRUCache(cache_size)
+
+    def get(self, chat_id):
+        """ Returns the settings of a chat, defaults if it has none yet """
+        settings = self.cache.get(chat_id)
+        if settings is None:
+            # Under the lock so an update() can't slip in between reading
+            # the record and caching it
+            with self.cache.lock:
+                settings = self.cache.get(chat_id)
+                if settings is None:
+                    record = self.db.get(str(chat_id))
+                    settings = ChatSettings.from_dict(record) \
+                        if isinstance(record, dict) else ChatSettings()
+                    self.cache.put(chat_id, settings)
+        return settings
+
+    def update(self, chat_id, **changes):
+        """ Changes some settings of a chat and returns the new settings """
+        with self.cache.lock:
+            settings = self.get(chat_id).replace(**changes)
+            self.db.set(str(chat_id), settings.to_dict())
+            self.cache.put(chat_id, settings)
+        return settings
+
+    def forget(self, chat_id):
+        """ Drops a chat's settings from the cache (not from the db) """
+        self.cache.pop(chat_id)
+
+
+def migrate(db):
+    """
+    Converts the one-key-per-setting layout of older versions into settings
+    records. Does nothing if the db is already up to date. Returns the
+    number of chats that were converted.
+    """
+    if (db.get('schema') or 1) >= SCHEMA_VERSION:
+        return 0
+
+    records = {}
+    old_keys = []
+    for key in db.getall():
+        match = OLD_KEY.match(key)
+        if not match:
+            continue
+        chat, suffix = match.groups()
+        record = records.setdefault(chat, {})
+        value = db.get(key)
+        if suffix is None:
+            if isinstance(value, dict):
+                # Already a settings record
+                record.update(value)
+                continue
+            record['welcome'] = value
+        elif suffix == '_bye':
+            # enable_goodbye used to store True, meaning the default message
+            record['goodbye'] = None if value is True else value
+        elif suffix == '_adm':
+            record['admin'] = value
+        elif suffix == '_lck':
+            record['locked'] = bool(value)
+        elif suffix == '_quiet':
+            record['quiet'] = bool(value)
+        if suffix is not None:
+            old_keys.append(key)
+
+    # One write for the whole conversion instead of one per key
+    with db.batch():
+        db.mset({chat: ChatSettings.from_dict(record).to_dict()
+                 for chat, record in records.items()})
+        db.mdel(old_keys)
+        db.set('schema', SCHEMA_VERSION)
+    return len(records)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('Usage: %s <db file>' % sys.argv[0])
+    db = pickledb.load(sys.argv[1], True)
+    print('Migrated %d chats' % migrate(db))
+    db.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Keyed executor the handlers of bot.py run on in the threads runtime.
+
+python-telegram-bot's Dispatcher hands every update to its handler on its
+one thread, so a slow handler holds up all chats, and with run_async the
+updates of a chat may be handled out of order. Instead, the handlers
+registered in add_handlers() only queue the update here, keyed by its chat:
+
+- the updates of a chat are handled one at a time, in the order they came
+- different chats are handled in parallel by workers threads
+- chats take turns: a worker takes the first update of the chat that has
+  waited longest, and a chat with more queued goes to the back of the
+  line, so one busy chat can't keep the workers from the others
+
+Queues are bounded. A job submitted with shed=True (banter, see bis_bald())
+is dropped when its chat already has key_limit updates queued or limit
+updates are queued over all; any other job is never dropped, submit()
+waits for room instead, which holds up the Dispatcher like a full queue
+would.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import metrics
+
+# Worker threads
+WORKERS = 10
+
+# Updates queued for one chat before sheddable ones are dropped
+KEY_LIMIT = 20
+
+# Updates queued over all chats before sheddable ones are dropped and
+# submit() waits for the others
+LIMIT = 1000
+
+logger = logging.getLogger(__name__)
+
+WAIT_SECONDS = metrics.Histogram('bot_update_wait_seconds',
+                                 'Time updates were queued before a worker '
+                                 'took them')
+SHED = metrics.Counter('bot_updates_shed_total',
+                       'Updates dropped because their queue was full')
+
+
+class KeyedExecutor(object):
+    """
+    Runs jobs, functions without arguments, on workers threads: jobs of the
+    same key one after the other in order of submission, jobs of different
+    keys in parallel. Jobs should handle their own errors, anything they
+    raise is logged.
+    """
+
+    def __init__(self, workers=WORKERS, key_limit=KEY_LIMIT, limit=LIMIT,
+                 name='keyed'):
+        self.workers = workers
+        self.key_limit = key_limit
+        self.limit = limit
+        self.name = name
+        self.lock = threading.Lock()
+        # Workers wait on cond for jobs, submit() on room for room in the
+        # queue and drain() on idle for the last job to be done
+        self.cond = threading.Condition(self.lock)
+        self.room = threading.Condition(self.lock)
+        self.idle = threading.Condition(self.lock)
+        # key -> deque of (job, time queued), for every key that has
+        # jobs queued or running
+        self.queues = {}
+        # Keys with queued jobs and none running, in the order they take
+        # turns
+        self.ready = deque()
+        self.queued = 0
+        self.running = 0
+        self.shed = 0
+        self.threads = []
+        self.stopping = False
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='%s-%d' % (self.name, i),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """ Runs what's queued, then stops the workers """
+        with self.lock:
+            self.stopping = True
+            self.cond.notify_all()
+            self.room.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None
+                        else max(0, deadline - time.monotonic()))
+
+    def submit(self, key, job, shed=False):
+        """
+        Queues job after the other jobs of key. Returns False if it was
+        dropped, see the module docstring.
+        """
+        with self.lock:
+            queue = self.queues.get(key)
+            if shed and (self.queued >= self.limit or queue is not None
+                         and len(queue) >= self.key_limit):
+                self.shed += 1
+                SHED.inc()
+                return False
+            while self.queued >= self.limit and not self.stopping:
+                self.room.wait()
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = deque()
+                self.ready.append(key)
+                self.cond.notify()
+            queue.append((job, time.monotonic()))
+            self.queued += 1
+            return True
+
+    def pending(self):
+        """ Returns the number of jobs queued or running """
+        with self.lock:
+            return self.queued + self.running
+
+    def drain(self, timeout=None):
+        """ Waits until no job is queued or running, returns whether so """
+        with self.lock:
+            return self.idle.wait_for(
+                lambda: not self.queued and not self.running, timeout)
+
+    def _next(self):
+        """ Waits for the job whose turn it is, None when stopping """
+        with self.lock:
+            while not self.ready:
+                if self.stopping and not self.queues:
+                    return None
+                self.cond.wait()
+            key = self.ready.popleft()
+            job, queued = self.queues[key].popleft()
+            if self.queued == self.limit:
+                self.room.notify_all()
+            self.queued -= 1
+            self.running += 1
+        WAIT_SECONDS.observe(time.monotonic() - queued)
+        return key, job
+
+    def _done(self, key):
+        with self.lock:
+            self.running -= 1
+            if self.queues[key]:
+                # Behind the keys that waited while this one ran
+                self.ready.append(key)
+                self.cond.notify()
+            else:
+                del self.queues[key]
+            if not self.queues:
+                self.idle.notify_all()
+                if self.stopping:
+                    self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            work = self._next()
+            if work is None:
+                return
+            key, job = work
+            try:
+                job()
+            except Exception:
+                logger.exception('Job of %s failed', key)
+            finally:
+                self._done(key)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Logging of the bot, kept off the threads and the event loop that handle
+updates.
+
+setup() puts a QueueHandler on the root logger. A record logged by a handler
+is put on a bounded queue as is, without formatting its message, and a
+single background thread formats it and writes it to a log file that is
+rotated once it reaches max_bytes. So a slow disk only ever stalls that
+thread; if the queue is full the record is dropped and counted instead of
+blocking the caller.
+
+High-volume lines of the bot are logged at DEBUG. With sample set, 1 in
+sample of those is kept per call site, with sample 0 they are not logged at
+all.
+"""
+import logging
+import queue
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+import metrics
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Size at which the log file is rotated and how many old ones are kept
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 5
+
+# Records waiting to be written before new ones are dropped
+QUEUE_SIZE = 10000
+
+DROPPED = metrics.Counter('bot_log_dropped_total',
+                          'Log records dropped because the queue was full')
+
+
+class Sampler(logging.Filter):
+    """ Lets every record above DEBUG through, and 1 in rate of the DEBUG
+    records of each call site """
+
+    def __init__(self, rate):
+        super(Sampler, self).__init__()
+        self.rate = rate
+        # msg -> counter of its records
+        self.seen = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        seen = self.seen.get(record.msg)
+        if seen is None:
+            seen = self.seen.setdefault(record.msg, count())
+        return next(seen) % self.rate == 0
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener's thread and drops
+    records instead of waiting when the queue is full. Arguments of log
+    calls must not be changed after the call, as they're formatted later.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+
+class Listener(QueueListener):
+    """ QueueListener that waits for room for its stop marker, the queue
+    may be full """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def setup(filename, level=logging.INFO, sample=0, sampled=(),
+          max_bytes=MAX_BYTES, backups=BACKUPS, queue_size=QUEUE_SIZE):
+    """
+    Sends the records of the root logger to filename through a queue, see
+    above. sampled are the names of the loggers whose DEBUG records are
+    sampled, those of libraries stay at level. Returns the QueueListener
+    writing them; stop() it at exit to write what's still queued.
+    """
+    records = queue.Queue(queue_size)
+    handler = LazyQueueHandler(records)
+    if sample:
+        handler.addFilter(Sampler(sample))
+        for name in sampled:
+            logging.getLogger(name).setLevel(logging.DEBUG)
+    out = RotatingFileHandler(filename, maxBytes=max_bytes,
+                              backupCount=backups, encoding='utf-8')
+    out.setFormatter(logging.Formatter(FORMAT))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = Listener(records, out, respect_handler_level=True)
+    listener.start()
+    return listener
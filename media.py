@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Caches for the media the bot sends: file_ids of its own photos and sticker
+sets looked up by name.
+
+The first time a picture from resources/photos is sent it is uploaded;
+Telegram answers with a file_id that can be sent instead of the file from
+then on. The ids are kept in the db so they survive restarts:
+
+media -> {<file name>: {"file_id": id of the upload,
+                        "bot": id of the bot that uploaded it,
+                        "size": size of the file when it was uploaded,
+                        "mtime": modification time of the file then}}
+
+A file_id only works for the bot that uploaded it and is dropped when the
+file changes on disk. If Telegram rejects a cached id anyway (BadRequest),
+the file is uploaded again and the new id is kept. Other errors say
+nothing about the id, they are raised as they are and the outbox retries
+the send with the same id. Only one upload of a file runs at a time: sends
+of it that come in meanwhile wait for its file_id.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from os.path import dirname, realpath, join
+
+from telegram.error import BadRequest
+
+PHOTOS = join(dirname(realpath(__file__)), "resources", "photos")
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache(object):
+    """ Sends files from a directory, uploading each one only once """
+
+    def __init__(self, db, directory=PHOTOS, key='media'):
+        self.db = db
+        self.directory = directory
+        self.key = key
+        self.lock = threading.Lock()
+        self.entries = dict(db.get(key) or {})
+        # name -> lock held while the file is uploaded, threading.Lock for
+        # the threaded bot and asyncio.Lock for the async one
+        self.uploads = {}
+        self.async_uploads = {}
+
+    def file_id(self, bot, name):
+        """ Returns the cached file_id of a file, or None """
+        entry = self.entries.get(name)
+        if entry is None or entry['bot'] != bot.id:
+            return None
+        stat = os.stat(join(self.directory, name))
+        if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            return None
+        return entry['file_id']
+
+    def remember(self, bot, name, file_id):
+        """ Records the file_id of an upload """
+        stat = os.stat(join(self.directory, name))
+        with self.lock:
+            self.entries[name] = {'file_id': file_id, 'bot': bot.id,
+                                  'size': stat.st_size,
+                                  'mtime': stat.st_mtime}
+            self.db.set(self.key, dict(self.entries))
+
+    def forget(self, name, file_id=None):
+        """
+        Drops the file_id of a file, so it is uploaded next time. With
+        file_id, only if that is still the cached one.
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or file_id not in (None, entry['file_id']):
+                return
+            del self.entries[name]
+            self.db.set(self.key, dict(self.entries))
+
+    def _upload_lock(self, name, locks, factory):
+        with self.lock:
+            lock = locks.get(name)
+            if lock is None:
+                lock = locks[name] = factory()
+            return lock
+
+    def send_photo(self, bot, chat_id, name, caption=None, **kwargs):
+        """
+        Sends a photo by file_id, uploading it if there is none yet.
+        Returns a coroutine for the async bot of aiobot.py.
+        """
+        if asyncio.iscoroutinefunction(bot.send_photo):
+            return self._send_photo_async(bot, chat_id, name, caption,
+                                          **kwargs)
+        rejected = file_id = self.file_id(bot, name)
+        if file_id is not None:
+            try:
+                return bot.send_photo(chat_id, file_id, caption, **kwargs)
+            except BadRequest as e:
+                self._rejected(name, file_id, e)
+
+        with self._upload_lock(name, self.uploads, threading.Lock):
+            # Another send may have uploaded it while this one waited
+            file_id = self.file_id(bot, name)
+            if file_id is not None and file_id != rejected:
+                return bot.send_photo(chat_id, file_id, caption, **kwargs)
+            with open(join(self.directory, name), 'rb') as f:
+                message = bot.send_photo(chat_id, f, caption, **kwargs)
+            self._uploaded(bot, name, message)
+        return message
+
+    async def _send_photo_async(self, bot, chat_id, name, caption, **kwargs):
+        rejected = file_id = self.file_id(bot, name)
+        if file_id is not None:
+            try:
+                return await bot.send_photo(chat_id, file_id, caption,
+                                            **kwargs)
+            except BadRequest as e:
+                self._rejected(name, file_id, e)
+
+        async with self._upload_lock(name, self.async_uploads,
+                                     asyncio.Lock):
+            file_id = self.file_id(bot, name)
+            if file_id is not None and file_id != rejected:
+                return await bot.send_photo(chat_id, file_id, caption,
+                                            **kwargs)
+            with open(join(self.directory, name), 'rb') as f:
+                message = await bot.send_photo(chat_id, f, caption,
+                                               **kwargs)
+            self._uploaded(bot, name, message)
+        return message
+
+    def _rejected(self, name, file_id, error):
+        logger.info('file_id of %s was rejected (%s), uploading it again',
+                    name, error.message)
+        # Not if another send has replaced it with a new upload meanwhile
+        self.forget(name, file_id)
+
+    def _uploaded(self, bot, name, message):
+        # The largest size is the one that was uploaded
+        self.remember(bot, name, message.photo[-1].file_id)
+
+
+# Seconds a sticker set is served without asking Telegram again
+STICKER_TTL = 3600
+
+
+class StickerSets(object):
+    """
+    Cache of bot.get_sticker_set() results. A set older than ttl seconds is
+    still served while a background thread (or task, with the async bot of
+    aiobot.py) fetches it again, so only the very first lookup of a set
+    waits for Telegram. Counts hits, misses, stale hits, refreshes and
+    failed refreshes, see stats().
+    """
+
+    def __init__(self, ttl=STICKER_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # name -> (sticker set, time it was fetched)
+        self.sets = {}
+        self.refreshing = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def _lookup(self, name):
+        """
+        Returns the cached set called name or None, and whether it needs to
+        be refreshed. Counts the lookup.
+        """
+        entry = self.sets.get(name)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None, False
+            sticker_set, fetched = entry
+            self.hits += 1
+            if time.monotonic() - fetched < self.ttl \
+                    or name in self.refreshing:
+                return sticker_set, False
+            self.stale += 1
+            self.refreshing.add(name)
+            return sticker_set, True
+
+    def get(self, bot, name):
+        """ Returns the sticker set called name """
+        sticker_set, stale = self._lookup(name)
+        if sticker_set is None:
+            return self.fetch(bot, name)
+        if stale:
+            threading.Thread(target=self.refresh, args=(bot, name),
+                             name='sticker-refresh', daemon=True).start()
+        return sticker_set
+
+    async def get_async(self, bot, name):
+        """ get() for the async bot """
+        sticker_set, stale = self._lookup(name)
+        if sticker_set is None:
+            return await self.fetch_async(bot, name)
+        if stale:
+            asyncio.ensure_future(self.refresh_async(bot, name))
+        return sticker_set
+
+    def send_sticker(self, bot, chat_id, name, index, **kwargs):
+        """
+        Sends the sticker at index of the set called name. Returns a
+        coroutine for the async bot.
+        """
+        if asyncio.iscoroutinefunction(bot.send_sticker):
+            return self._send_sticker_async(bot, chat_id, name, index,
+                                            **kwargs)
+        return bot.send_sticker(chat_id, self.get(bot, name).stickers[index],
+                                **kwargs)
+
+    async def _send_sticker_async(self, bot, chat_id, name, index, **kwargs):
+        sticker_set = await self.get_async(bot, name)
+        return await bot.send_sticker(chat_id, sticker_set.stickers[index],
+                                      **kwargs)
+
+    def fetch(self, bot, name):
+        """ Asks Telegram for a sticker set and caches it """
+        sticker_set = bot.get_sticker_set(name)
+        self.sets[name] = (sticker_set, time.monotonic())
+        return sticker_set
+
+    async def fetch_async(self, bot, name):
+        """ fetch() for the async bot """
+        sticker_set = await bot.get_sticker_set(name)
+        self.sets[name] = (sticker_set, time.monotonic())
+        return sticker_set
+
+    def refresh(self, bot, name):
+        try:
+            self.fetch(bot, name)
+            self._refreshed(name)
+        except Exception as e:
+            self._refreshed(name, e)
+
+    async def refresh_async(self, bot, name):
+        try:
+            await self.fetch_async(bot, name)
+            self._refreshed(name)
+        except Exception as e:
+            self._refreshed(name, e)
+
+    def _refreshed(self, name, error=None):
+        with self.lock:
+            self.refreshing.discard(name)
+            if error is None:
+                self.refreshes += 1
+                return
+            # Keep serving the old set, the next stale hit tries again
+            self.errors += 1
+        logger.warning('Could not refresh sticker set %s: %s', name, error)
+
+    def prewarm(self, bot, names):
+        """
+        Fetches the given sets in the background. With the async bot this
+        needs a running or soon to run event loop.
+        """
+        names = [name for name in names if name not in self.sets]
+        if asyncio.iscoroutinefunction(bot.get_sticker_set):
+            return asyncio.ensure_future(self._prewarm_async(bot, names))
+
+        def run():
+            for name in names:
+                try:
+                    self.fetch(bot, name)
+                except Exception as e:
+                    logger.warning('Could not prewarm sticker set %s: %s',
+                                   name, e)
+        thread = threading.Thread(target=run, name='sticker-prewarm',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    async def _prewarm_async(self, bot, names):
+        for name in names:
+            try:
+                await self.fetch_async(bot, name)
+            except Exception as e:
+                logger.warning('Could not prewarm sticker set %s: %s', name, e)
+
+    def stats(self):
+        """ Returns the counters and the number of cached sets """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'stale': self.stale, 'refreshes': self.refreshes,
+                    'errors': self.errors, 'size': len(self.sets)}
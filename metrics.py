@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Metrics of the bot in the Prometheus text format, served on
+http://127.0.0.1:<port>/metrics when token.ini says
+
+    [Bot]
+    metrics_port = 9100
+
+Metrics are registered in REGISTRY when they are created, usually at import
+time of the module they measure. Counters and histograms are updated as
+things happen; gauges may instead be given a function that is called for
+every scrape, for numbers that something else keeps anyway, like the length
+of a queue.
+"""
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the buckets of latency histograms
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+
+class Registry(object):
+    """ The metrics there are, in the order they were created """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        """ Returns all metrics in the Prometheus text format """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                logger.warning('Could not collect %s: %s', metric.name, e)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                          .replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """ A named metric, one value per combination of its labels """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        # tuple of label values -> value
+        self.values = {}
+        registry.add(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %s' % (self.name, _labels(self.labels, key),
+                             _number(value)) for key, value in values]
+
+
+class Counter(Metric):
+    """ A count that only goes up """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A number that goes up and down. With function, it is whatever
+    function() returns at the time of the scrape, a number or, for a gauge
+    with labels, a dict of {tuple of label values: number}. kind may be
+    'counter' for a function that returns a running count.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function=None, labels=(), kind=None,
+                 registry=REGISTRY):
+        super(Gauge, self).__init__(name, help, labels, registry)
+        self.function = function
+        if kind is not None:
+            self.kind = kind
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            value = self.function()
+            with self.lock:
+                self.values = value if self.labels else {(): value}
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    """ Counts observations, e.g. latencies, in buckets """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS,
+                 registry=REGISTRY):
+        super(Histogram, self).__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # Counts per bucket (the last one is +Inf), sum
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self.values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    self.name, _labels(self.labels, key,
+                                       'le="%s"' % _number(bound)),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (self.name,
+                                          _labels(self.labels, key),
+                                          _number(total)))
+            lines.append('%s_count%s %d' % (self.name,
+                                            _labels(self.labels, key),
+                                            cumulative))
+        return lines
+
+
+def timed(histogram, errors=None, **labels):
+    """
+    Decorator that observes how long each call takes in histogram and,
+    with errors, counts the exceptions it raises by type
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if errors is not None:
+                    errors.inc(type=type(e).__name__, **labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorate
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """ Serves /metrics from a thread of its own, returns the server """
+    handler = type('Handler', (_Handler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    logger.info('Serving metrics on %s:%d', host, port)
+    return server
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Outbound message queue of the bot.
+
+Everything the bot sends goes through an Outbox instead of being sent from
+the handler. The Outbox keeps to Telegram's flood limits with token buckets,
+one for all chats together and one per chat, so a burst of joins in a big
+group is spread out instead of being answered with 429 errors. Jobs have a
+priority (lower is sent first, see WELCOME, REPLY, CHATTER and BROADCAST);
+jobs of the same chat are sent one at a time and in order of priority, then
+submission.
+A chat that gets a 429 anyway is paused for the retry_after Telegram asks
+for and the message is sent again.
+
+Several events of a chat within a short window can be coalesced into one
+message with coalesce(), e.g. one welcome for everyone who joined: the
+first is sent right away, what comes in the window after it is sent
+together when the window closes.
+"""
+import asyncio
+import heapq
+import inspect
+import logging
+import threading
+import time
+from functools import partial
+from itertools import count
+
+from telegram.error import RetryAfter
+
+import metrics
+
+# Priorities
+WELCOME = 0
+REPLY = 1
+CHATTER = 2
+BROADCAST = 3
+
+# Telegram allows about 30 messages per second over all chats and 20 per
+# minute in one group
+GLOBAL_RATE = 30.0
+GLOBAL_BURST = 30
+CHAT_RATE = 20 / 60.0
+CHAT_BURST = 3
+
+# Seconds coalesce() waits for more events before sending
+COALESCE_WINDOW = 2.0
+
+logger = logging.getLogger(__name__)
+
+SEND_SECONDS = metrics.Histogram('bot_send_seconds',
+                                 'Time a queued job took to send')
+SEND_ERRORS = metrics.Counter('bot_send_errors_total',
+                              'Jobs that raised, by type of error',
+                              ['type'])
+
+
+class TokenBucket(object):
+    """ rate tokens per second, at most burst of them saved up """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'held')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+        self.held = 0.0
+
+    def delay(self, now):
+        """ Returns how many seconds to wait until a token is available """
+        if self.held > now:
+            return self.held - now
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def hold(self, until):
+        """ Hands out no tokens before until """
+        self.held = max(self.held, until)
+
+    def full(self, now):
+        return self.held <= now and \
+            self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class Outbox(object):
+    """
+    Sends jobs, functions without arguments that make one API call, from
+    workers threads. on_error(chat_id, error) is called when a job raises
+    anything but RetryAfter.
+    """
+
+    def __init__(self, workers=4, global_rate=GLOBAL_RATE,
+                 global_burst=GLOBAL_BURST, chat_rate=CHAT_RATE,
+                 chat_burst=CHAT_BURST, on_error=None):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.on_error = on_error
+        self.cond = threading.Condition()
+        self.seq = count()
+        self.bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+        # chat_id -> token bucket, dropped again once it's full
+        self.buckets = {}
+        # chat_id -> heap of (priority, seq, job)
+        self.queues = {}
+        # Heap of (priority, seq, chat_id) of chats whose first job may be
+        # sent as soon as the global bucket allows. Entries that no longer
+        # match the first job of their chat are skipped.
+        self.ready = []
+        # Heap of (time, chat_id) of chats waiting for their own bucket
+        self.delayed = []
+        self.waiting = set()
+        # Chats with a job being sent right now
+        self.busy = set()
+        # key -> (chat_id, items, job, priority) of a coalesce() window
+        # that's still open
+        self.batches = {}
+        self.threads = []
+        self.stopping = False
+        self.swept = time.monotonic()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='outbox-%d' % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """ Sends what's queued, then stops the workers """
+        self._flush()
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None
+                        else max(0, deadline - time.monotonic()))
+        if any(thread.is_alive() for thread in self.threads):
+            with self.cond:
+                dropped = len(self.busy) + sum(
+                    len(queue) for queue in self.queues.values())
+            logger.warning('Dropped %d queued messages', dropped)
+
+    def submit(self, chat_id, job, priority=REPLY):
+        """ Queues job for sending to chat_id """
+        with self.cond:
+            queue = self.queues.setdefault(chat_id, [])
+            entry = (priority, next(self.seq), job)
+            heapq.heappush(queue, entry)
+            if queue[0] is entry and chat_id not in self.busy \
+                    and chat_id not in self.waiting:
+                heapq.heappush(self.ready, (priority, entry[1], chat_id))
+                self._wake()
+
+    def coalesce(self, chat_id, key, items, job, priority=WELCOME,
+                 window=COALESCE_WINDOW):
+        """
+        Queues job(items) right away if no window is open under key, and
+        opens one for window seconds. Items submitted under key while it is
+        open are collected and queued as one job(items) when it closes.
+        """
+        with self.cond:
+            batch = self.batches.get(key)
+            if batch is not None:
+                batch[1].extend(items)
+                return
+            self.batches[key] = (chat_id, [], job, priority)
+        self.submit(chat_id, partial(job, list(items)), priority)
+
+        def close():
+            with self.cond:
+                # Gone if stop() flushed it already
+                batch = self.batches.pop(key, None)
+            if batch is not None and batch[1]:
+                self.submit(chat_id, partial(job, batch[1]), priority)
+
+        self._later(window, close)
+
+    def _flush(self):
+        """ Queues the items of all open coalesce() windows now """
+        with self.cond:
+            batches, self.batches = self.batches, {}
+        for chat_id, items, job, priority in batches.values():
+            if items:
+                self.submit(chat_id, partial(job, items), priority)
+
+    def pending(self):
+        """ Returns the number of queued jobs """
+        with self.cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def _take(self, now):
+        """
+        Returns (chat_id, entry) of a job that may be sent now, or None and
+        the number of seconds until one may be (None for no job at all).
+        Must be called with cond held.
+        """
+        while self.delayed and self.delayed[0][0] <= now:
+            _, chat_id = heapq.heappop(self.delayed)
+            self.waiting.discard(chat_id)
+            self._schedule(chat_id)
+        timeout = self.delayed[0][0] - now if self.delayed else None
+
+        while self.ready:
+            priority, seq, chat_id = self.ready[0]
+            queue = self.queues.get(chat_id)
+            if not queue or queue[0][1] != seq or chat_id in self.busy \
+                    or chat_id in self.waiting:
+                heapq.heappop(self.ready)
+                continue
+            wait = self.bucket.delay(now)
+            if wait:
+                timeout = wait if timeout is None else min(timeout, wait)
+                break
+            heapq.heappop(self.ready)
+            bucket = self.buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.buckets[chat_id] = TokenBucket(
+                    self.chat_rate, self.chat_burst, now)
+            wait = bucket.delay(now)
+            if wait:
+                heapq.heappush(self.delayed, (now + wait, chat_id))
+                self.waiting.add(chat_id)
+                timeout = wait if timeout is None else min(timeout, wait)
+                continue
+            bucket.take()
+            self.bucket.take()
+            self.busy.add(chat_id)
+            return (chat_id, heapq.heappop(queue)), None
+
+        if now - self.swept > 60:
+            self._sweep(now)
+        return None, timeout
+
+    def _next(self):
+        """ Waits for a job that may be sent now, None when stopping """
+        with self.cond:
+            while True:
+                job, timeout = self._take(time.monotonic())
+                if job is not None:
+                    return job
+                if self.stopping and not self.queues:
+                    return None
+                self.cond.wait(timeout)
+
+    def _wake(self):
+        # Called with cond held
+        if self.stopping:
+            self.cond.notify_all()
+        else:
+            self.cond.notify()
+
+    def _later(self, delay, function):
+        timer = threading.Timer(delay, function)
+        timer.daemon = True
+        timer.start()
+
+    def _schedule(self, chat_id):
+        queue = self.queues.get(chat_id)
+        if queue:
+            priority, seq, _ = queue[0]
+            heapq.heappush(self.ready, (priority, seq, chat_id))
+            self._wake()
+        elif queue is not None:
+            del self.queues[chat_id]
+
+    def _sweep(self, now):
+        # Buckets of idle chats are full again, a new one would be the same
+        self.swept = now
+        for chat_id in [c for c, b in self.buckets.items() if b.full(now)]:
+            del self.buckets[chat_id]
+
+    def _done(self, chat_id, entry=None, error=None):
+        """ Bookkeeping after a job was sent or raised error """
+        if error is not None:
+            SEND_ERRORS.inc(type=type(error).__name__)
+        if error is not None and not isinstance(error, RetryAfter):
+            if self.on_error is not None:
+                self.on_error(chat_id, error)
+            else:
+                logger.error('Sending to chat %s failed: %s', chat_id, error)
+        with self.cond:
+            self.busy.discard(chat_id)
+            if not isinstance(error, RetryAfter):
+                self._schedule(chat_id)
+                if self.stopping:
+                    self._wake()
+                return
+            # Flood limit hit anyway: send the same job again, but not
+            # before Telegram says so
+            logger.warning('Flood limit in chat %s, retrying in %ss',
+                           chat_id, error.retry_after)
+            until = time.monotonic() + error.retry_after
+            heapq.heappush(self.queues.setdefault(chat_id, []), entry)
+            bucket = self.buckets.get(chat_id)
+            if bucket is not None:
+                bucket.hold(until)
+            heapq.heappush(self.delayed, (until, chat_id))
+            self.waiting.add(chat_id)
+            self._wake()
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                with self.cond:
+                    self.cond.notify_all()
+                return
+            chat_id, entry = job
+            start = time.perf_counter()
+            try:
+                entry[2]()
+            except Exception as e:
+                SEND_SECONDS.observe(time.perf_counter() - start)
+                self._done(chat_id, entry, e)
+            else:
+                SEND_SECONDS.observe(time.perf_counter() - start)
+                self._done(chat_id)
+
+
+class AsyncOutbox(Outbox):
+    """
+    Outbox for the asyncio runtime (see aiobot.py). Jobs may return
+    awaitables, which are awaited on the event loop; every job the limits
+    allow is in flight at once instead of one per worker thread. submit()
+    and coalesce() may still be called from any thread.
+    """
+
+    def __init__(self, **kwargs):
+        super(AsyncOutbox, self).__init__(workers=0, **kwargs)
+        self.loop = None
+        self.event = None
+        self.task = None
+        self.sending = set()
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.event = asyncio.Event()
+        self.task = self.loop.create_task(self._run())
+
+    def stop(self, timeout=None):
+        """ Sends what's queued, then stops. Call when the loop isn't
+        running. """
+        self._flush()
+        with self.cond:
+            self.stopping = True
+        self.loop.call_soon(self.event.set)
+        try:
+            self.loop.run_until_complete(
+                asyncio.wait_for(asyncio.shield(self.task), timeout))
+        except asyncio.TimeoutError:
+            logger.warning('Dropped %d queued messages', self.pending())
+
+    def _wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def _later(self, delay, function):
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, function)
+
+    async def _run(self):
+        while True:
+            with self.cond:
+                job, timeout = self._take(time.monotonic())
+                if job is None and self.stopping and not self.queues \
+                        and not self.sending:
+                    return
+                self.event.clear()
+            if job is not None:
+                task = self.loop.create_task(self._send(*job))
+                self.sending.add(task)
+                task.add_done_callback(self._sent)
+                continue
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _sent(self, task):
+        self.sending.discard(task)
+        if self.stopping:
+            self.event.set()
+
+    async def _send(self, chat_id, entry):
+        start = time.perf_counter()
+        try:
+            result = entry[2]()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            SEND_SECONDS.observe(time.perf_counter() - start)
+            self._done(chat_id, entry, e)
+        else:
+            SEND_SECONDS.observe(time.perf_counter() - start)
+            self._done(chat_id)
@@ -28,8 +28,29 @@
 # THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import re
+import atexit
+import contextlib
+import copy
 import json
 import io
+import itertools
+import marshal
+import mmap
+import shutil
+import sqlite3
+import struct
+import functools
+import inspect
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 """
 This version of pickleDB is has not been tested. It should only be used for
@@ -38,39 +59,864 @@ some issues with Python 2.x. python3pickledb.py written by olivierlemoal.
 Please report issues to bitbucket (patx/pickledb).
 """
 
-def load(location, option):
-    '''Return a pickledb object. location is the path to the json file.'''
-    return pickledb(location, option)
+# Mutators that are recorded in the journal and may be replayed from it
+JOURNAL_OPS = frozenset(['set', 'rem', 'lcreate', 'ladd', 'lrem', 'lpop',
+                         'lrem_value', 'append', 'lappend', 'dcreate', 'dadd',
+                         'drem', 'dpop', 'screate', 'sadd', 'srem', 'deldb',
+                         'mset', 'mdel', '_apply'])
+
+# Journal size in bytes after which it is folded into a new snapshot
+COMPACT_SIZE = 1024 * 1024
+
+# Number of decoded values a lazily loaded db keeps around
+LAZY_CACHE_SIZE = 10000
+
+# Number of top-level keys encoded at a time when writing a snapshot
+CHUNK_SIZE = 1000
+
+# Start of a snapshot in the binary format and the version of that format
+BINARY_MAGIC = b'PKDB'
+BINARY_VERSION = 1
+_CHUNK_LENGTH = struct.Struct('<I')
+
+
+def _json_default(obj):
+    '''Encode the types json doesn't know about, i.e. sets'''
+    if isinstance(obj, (set, frozenset)):
+        return {'__set__': list(obj)}
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+def _json_object_hook(obj):
+    '''Decode what _json_default encoded'''
+    if len(obj) == 1 and '__set__' in obj:
+        return set(obj['__set__'])
+    return obj
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=_json_default)
+
+
+def _loads(data):
+    return json.loads(data, object_hook=_json_object_hook)
+
+
+def _chunks(items):
+    '''Split an iterable of items into dicts of up to CHUNK_SIZE of them'''
+    items = iter(items)
+    while True:
+        chunk = dict(itertools.islice(items, CHUNK_SIZE))
+        if not chunk:
+            return
+        yield chunk
+
+
+class JSONCodec(object):
+    '''The json snapshot format: one object holding every key. It's encoded
+    with orjson when that is installed, unless accelerated is False, and
+    with the json module otherwise; the files are the same either way.
+    Snapshots are encoded and written CHUNK_SIZE keys at a time, so the
+    whole file is never held in memory as one string.'''
+
+    name = 'json'
+
+    def __init__(self, accelerated=True):
+        self.accelerated = accelerated and orjson is not None
+        self._encoder = json.JSONEncoder(ensure_ascii=False,
+                                         default=_json_default)
+
+    def dump(self, items, f):
+        '''Write the (key, value) pairs of items to the binary file f'''
+        f.write(b'{')
+        first = True
+        for chunk in _chunks(items):
+            data = None
+            if self.accelerated:
+                try:
+                    data = orjson.dumps(chunk, default=_json_default,
+                                        option=orjson.OPT_NON_STR_KEYS)
+                except TypeError:
+                    # e.g. ints of more than 64 bits, json copes with those
+                    pass
+            if data is None:
+                data = self._encoder.encode(chunk).encode('utf-8')
+            if not first:
+                f.write(b', ')
+            f.write(data[1:-1])
+            first = False
+        f.write(b'}')
+
+    def load(self, data):
+        '''Decode the bytes of a snapshot. Always with the json module: orjson
+        has no object_hook, and finding the sets in what it returns takes
+        longer than its faster parsing saves.'''
+        return json.loads(data.decode('utf-8'), object_hook=_json_object_hook)
+
+
+class BinaryCodec(object):
+    '''A compact binary snapshot format. The file starts with BINARY_MAGIC,
+    the format version and the marshal version, one byte each, followed by
+    chunks of up to CHUNK_SIZE keys: the length of the chunk as 4 bytes
+    little endian, then the chunk as a marshalled dict. marshal handles
+    every type a db holds, sets included, and never runs code on load, but
+    a Python can't read files written by a newer one.'''
+
+    name = 'binary'
+
+    def dump(self, items, f):
+        '''Write the (key, value) pairs of items to the binary file f'''
+        f.write(BINARY_MAGIC + bytes([BINARY_VERSION, marshal.version]))
+        for chunk in _chunks(items):
+            data = marshal.dumps(chunk)
+            f.write(_CHUNK_LENGTH.pack(len(data)))
+            f.write(data)
+
+    def load(self, data):
+        '''Decode the bytes of a snapshot'''
+        header = len(BINARY_MAGIC)
+        if data[:header] != BINARY_MAGIC:
+            raise ValueError('Not a binary pickledb snapshot')
+        if data[header] != BINARY_VERSION:
+            raise ValueError('Unknown binary snapshot version %d'
+                             % data[header])
+        if data[header + 1] > marshal.version:
+            raise ValueError('Snapshot written by a newer Python '
+                             '(marshal version %d)' % data[header + 1])
+        view = memoryview(data)
+        pos = header + 2
+        db = {}
+        while pos < len(data):
+            length, = _CHUNK_LENGTH.unpack_from(view, pos)
+            pos += _CHUNK_LENGTH.size
+            if pos + length > len(data):
+                raise ValueError('Truncated binary snapshot')
+            db.update(marshal.loads(view[pos:pos + length]))
+            pos += length
+        return db
+
+
+# Snapshot formats by name, see pickledb.__init__
+CODECS = {'json': JSONCodec(), 'binary': BinaryCodec()}
+
+
+def load(location, option, backend='json', read_cache=None,
+         read_cache_ttl=None, **kwargs):
+    '''Return a pickledb object. location is the path to the json file, or
+    to a SQLite file with backend='sqlite'. Extra keyword arguments select
+    write-behind or journal mode or the snapshot codec, see
+    pickledb.__init__ and sqlitedb.__init__. With read_cache set, get() is served from an LRU
+    cache of that many keys, see cacheddb.'''
+    if backend == 'sqlite':
+        db = sqlitedb(location, option, **kwargs)
+    elif backend == 'json':
+        db = pickledb(location, option, **kwargs)
+    else:
+        raise ValueError('Unknown pickledb backend %r' % (backend,))
+    if read_cache:
+        db = cacheddb(db, read_cache, read_cache_ttl)
+    return db
+
+
+def convert(source, destination):
+    '''Copy the json db at source into a SQLite db at destination.
+    Returns the number of keys copied.'''
+    src = pickledb(source, False)
+    dst = sqlitedb(destination, False)
+    try:
+        with dst._lock:
+            for key, value in src.db.items():
+                dst._put(key, value)
+        dst.dump()
+        return len(src.db)
+    finally:
+        src.close()
+        dst.close()
+
+
+def _close_at_exit(db):
+    '''Have db closed at interpreter exit without keeping it alive until
+    then. Returns the hook for close() to unregister.'''
+    ref = weakref.ref(db)
+
+    def hook():
+        db = ref()
+        if db is not None:
+            db.close()
+    atexit.register(hook)
+    return hook
+
+
+def _mutator(method):
+    '''Run a mutator under the db write lock, so the change and its journal
+    record can't be reordered against other writers or a compaction. In a
+    batch, the old value of the key it changes (its first argument, every
+    key for deldb) is kept for a rollback first. Keyword arguments are
+    passed on; the method's journal record holds them like any other.'''
+    # Name of the key argument, for calls that pass it by keyword
+    first = list(inspect.signature(method).parameters)[1:2]
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write:
+            if self._undo is not None:
+                if not first:
+                    keys = list(self.db.keys())
+                elif args:
+                    keys = args[:1]
+                else:
+                    keys = [kwargs[first[0]]] if first[0] in kwargs else []
+                for key in keys:
+                    self._save(key)
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _LockSide(object):
+    '''Context manager for one side of a RWLock'''
+
+    __slots__ = ('_acquire', '_release')
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+
+    def __exit__(self, *exc_info):
+        self._release()
+
+
+class RWLock(object):
+    '''A readers-writer lock: any number of readers or one writer. Both sides
+    are reentrant and the writer may take the read side as well. Waiting
+    writers keep new readers out, so a stream of reads can't starve them,
+    but not a thread that already reads. Use as "with lock.read:" or
+    "with lock.write:".'''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        # Read sides held by the current thread, to let it in again while
+        # a writer waits: that writer waits for it, so it would never get
+        # in otherwise
+        self._held = threading.local()
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting = 0
+        self.read = _LockSide(self.acquire_read, self.release_read)
+        self.write = _LockSide(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._depth += 1
+                return
+            held = getattr(self._held, 'reads', 0)
+            if held:
+                self._held.reads = held + 1
+                return
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+            self._held.reads = 1
+
+    def release_read(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._depth -= 1
+                return
+            self._held.reads -= 1
+            if self._held.reads:
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._depth += 1
+                return
+            self._waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = me
+            self._depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    def is_writer(self):
+        '''Return True if the calling thread holds the write side'''
+        return self._writer == threading.get_ident()
+
+
+# Regexes to find the top-level items of a json object without decoding them
+_WS = br'[ \t\n\r]*'
+# Loops are unrolled (a run of plain bytes, then (special, run)*) since that
+# is a lot faster with re than an alternation per byte
+_STR = br'"[^"\\]*(?:\\.[^"\\]*)*"'
+_FLAT = (br'(?:' + _STR +
+         br'|\{[^{}\[\]"]*(?:' + _STR + br'[^{}\[\]"]*)*\}'
+         br'|\[[^{}\[\]"]*(?:' + _STR + br'[^{}\[\]"]*)*\]'
+         br'|[^,}\s{\["][^,}\s]*)')
+_OPEN = re.compile(_WS + br'\{' + _WS + br'(\}?)')
+_ITEM = re.compile(_WS + br'(' + _STR + br')' + _WS + br':' + _WS +
+                   br'(' + _FLAT + br')' + _WS + br'([,}])')
+_KEY = re.compile(_WS + br'(' + _STR + br')' + _WS + br':' + _WS)
+_END = re.compile(_WS + br'([,}])')
+_STRING = re.compile(_STR)
+_NEXT = re.compile(br'["{}\[\]]')
+
+
+def _skip(buf, pos):
+    '''Return the offset just past the json array or object at pos'''
+    depth = 0
+    while True:
+        m = _NEXT.search(buf, pos)
+        if m is None:
+            raise ValueError('Unterminated json value at offset %d' % pos)
+        char = m.group()
+        if char == b'"':
+            pos = _STRING.match(buf, m.start()).end()
+            continue
+        pos = m.end()
+        if char in b'{[':
+            depth += 1
+        else:
+            depth -= 1
+            if not depth:
+                return pos
+
+
+def _scan(buf):
+    '''Index the top-level items of the json object in buf.
+    Returns a dict of key -> (offset << 32 | length) of the encoded value.'''
+    index = {}
+    m = _OPEN.match(buf)
+    if m is None:
+        raise ValueError('Not a json object')
+    if m.group(1):
+        return index
+    pos = m.end()
+    while True:
+        # Most values have no nested containers and are matched in one go
+        m = _ITEM.match(buf, pos)
+        if m is not None:
+            key = m.group(1)
+            start, end = m.span(2)
+        else:
+            m = _KEY.match(buf, pos)
+            if m is None:
+                raise ValueError('Malformed json at offset %d' % pos)
+            key = m.group(1)
+            start = m.end()
+            end = _skip(buf, start)
+            m = _END.match(buf, end)
+            if m is None:
+                raise ValueError('Malformed json at offset %d' % end)
+        key = json.loads(key) if b'\\' in key else key[1:-1].decode('utf-8')
+        index[key] = start << 32 | (end - start)
+        if m.group(m.lastindex) == b'}':
+            return index
+        pos = m.end()
+
+
+_MISSING = object()
+
+
+class LazyDict(object):
+    '''The dict behind a pickledb loaded with lazy=True. The db file is
+    memory-mapped and only its top-level keys are indexed up front; values
+    are decoded on first access and kept in an LRU cache of cache_size.
+    Values changed since the file was last written live in memory until
+    the next snapshot. Values a writer (the thread holding the db's write
+    lock) looks at are kept as well, since mutators change them in place.
+
+    Snapshots written through a LazyDict also write the key index to
+    <location>.idx, so the next load doesn't have to scan the file.'''
+
+    def __init__(self, location, lock, cache_size=LAZY_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._lock = lock
+        self._cache = OrderedDict()
+        self._changed = {}
+        self._deleted = set()
+        self._touched = None
+        self._generation = 0
+        self._file = (None, {})
+        if location is not None:
+            self._file = self._open(location)
+
+    def _open(self, location):
+        '''Map a db file and index it'''
+        with io.open(location, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if not stat.st_size:
+                return (None, {})
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buf[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+            raise ValueError('%s is a binary snapshot, lazy loading needs '
+                             'json' % location)
+        index = None
+        try:
+            with io.open(location + '.idx', 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved['stamp'] == [stat.st_size, stat.st_mtime_ns]:
+                index = dict(zip(saved['keys'], saved['spans']))
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return (buf, index if index is not None else _scan(buf))
+
+    def save_index(self, location):
+        '''Write the key index of the file at location next to it'''
+        stat = os.stat(location)
+        index = self._file[1]
+        data = json.dumps({'stamp': [stat.st_size, stat.st_mtime_ns],
+                           'keys': list(index), 'spans': list(index.values())},
+                          ensure_ascii=False)
+        tmp = location + '.idx.tmp'
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, location + '.idx')
+
+    def __getitem__(self, key):
+        writer = self._lock.is_writer()
+        if not writer:
+            value = self._changed.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                try:
+                    self._cache.move_to_end(key)
+                except KeyError:
+                    pass
+                return value
+        with self._lock.read:
+            return self._fetch(key, writer)
+
+    def fetch(self, key):
+        '''self[key] for callers that hold the db lock already'''
+        return self._fetch(key, self._lock.is_writer())
+
+    def _fetch(self, key, writer):
+        value = self._changed.get(key, _MISSING)
+        if value is not _MISSING:
+            if writer:
+                # It's about to be changed in place, reopen() must keep it
+                self._touch(key)
+            return value
+        if key in self._deleted:
+            raise KeyError(key)
+        value = self._cache.pop(key, _MISSING)
+        if value is _MISSING:
+            buf, index = self._file
+            span = index[key]
+            start = span >> 32
+            value = _loads(buf[start:start + (span & 0xffffffff)]
+                           .decode('utf-8'))
+        if writer:
+            self._touch(key)
+            self._changed[key] = value
+        else:
+            self._cache[key] = value
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def __setitem__(self, key, value):
+        self._touch(key)
+        self._changed[key] = value
+        self._deleted.discard(key)
+        self._cache.pop(key, None)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._touch(key)
+        self._changed.pop(key, None)
+        self._cache.pop(key, None)
+        if key in self._file[1]:
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self._changed or \
+            key in self._file[1] and key not in self._deleted
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        changed = list(self._changed)
+        deleted = self._deleted
+        return [k for k in self._file[1]
+                if k not in deleted and k not in self._changed] + changed
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def clear(self):
+        self._generation += 1
+        self._file = (None, {})
+        self._changed.clear()
+        self._deleted.clear()
+        self._cache.clear()
+
+    def snapshot(self):
+        '''Capture what write() needs: the old file, the keys, and the
+        changed values as they are now. Must be called with the db lock
+        held. Writers must not change the captured values in place until
+        write() is done, see pickledb._mutable().'''
+        self._touched = set()
+        return (self._file, self.keys(), dict(self._changed),
+                self._generation)
+
+    def write(self, f, snapshot):
+        '''Write a snapshot() as a json object to the binary file f, without
+        the db lock. Values that weren't changed are copied from the old
+        file without decoding them. Returns what reopen() needs once f is
+        in place.'''
+        (buf, index), keys, changed, generation = snapshot
+        written = {}
+        pos = f.write(b'{')
+        for key in keys:
+            value = changed.get(key, _MISSING)
+            if value is _MISSING:
+                span = index[key]
+                start = span >> 32
+                data = buf[start:start + (span & 0xffffffff)]
+            else:
+                data = _dumps(value).encode('utf-8')
+            item = _dumps(key).encode('utf-8') + b': '
+            if written:
+                item = b', ' + item
+            pos += f.write(item)
+            written[key] = pos << 32 | len(data)
+            pos += f.write(data)
+        f.write(b'}')
+        return written, list(changed), generation
+
+    def reopen(self, location, written):
+        '''Switch to the file written by write(). Must be called with the
+        write side of the db lock held.'''
+        index, changed, generation = written
+        if generation != self._generation:
+            # Cleared while the file was written, it's out of date already
+            self._touched = None
+            return
+        with io.open(location, 'rb') as f:
+            buf = None
+            if os.fstat(f.fileno()).st_size:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Readers that still hold the old map keep it alive until done
+        self._file = (buf, index)
+        for key in changed:
+            if key not in self._touched:
+                self._changed.pop(key, None)
+        self._deleted = set(k for k in self._deleted if k in index)
+        self._touched = None
+
+    def _touch(self, key):
+        '''Note a change of key while a snapshot is being written'''
+        if self._touched is not None:
+            self._touched.add(key)
+
+
+class Index(object):
+    '''A secondary index of a db: the keys holding each value, so finding
+    them takes time in the number of keys found rather than in the size of
+    the db. Pass indexes as indexes={name: Index(...)} to a db and query
+    them with db.lookup(name, value).
+
+    With suffix, only keys ending in it are indexed. With field, only dict
+    values are, by what they hold in that field; keys where it's missing
+    are left out. Values that can't be hashed aren't indexed. An Index
+    belongs to one db, which keeps it up to date on every mutation and
+    rebuilds it on load, or on the first lookup() if the db is lazy.'''
+
+    def __init__(self, field=None, suffix=None):
+        self.field = field
+        self.suffix = suffix
+        # indexed value -> set of keys, key -> indexed value
+        self._keys = {}
+        self._values = {}
+
+    def value_of(self, key, value):
+        '''Return what key is indexed by when it holds value, or _MISSING'''
+        if self.suffix is not None and not key.endswith(self.suffix):
+            return _MISSING
+        if self.field is not None:
+            if not isinstance(value, dict):
+                return _MISSING
+            value = value.get(self.field, _MISSING)
+        if value is not _MISSING:
+            try:
+                hash(value)
+            except TypeError:
+                return _MISSING
+        return value
+
+    def update(self, key, value):
+        '''Note that key now holds value, _MISSING if it was deleted'''
+        new = _MISSING if value is _MISSING else self.value_of(key, value)
+        old = self._values.get(key, _MISSING)
+        if old is not _MISSING:
+            if new is not _MISSING and old == new:
+                return
+            keys = self._keys[old]
+            keys.discard(key)
+            if not keys:
+                del self._keys[old]
+            del self._values[key]
+        if new is not _MISSING:
+            self._keys.setdefault(new, set()).add(key)
+            self._values[key] = new
+
+    def lookup(self, value):
+        '''Return a set of the keys indexed by value'''
+        return set(self._keys.get(value, ()))
+
+    def rebuild(self, items):
+        '''Index the (key, value) pairs of items from scratch'''
+        self.clear()
+        for key, value in items:
+            self.update(key, value)
+
+    def clear(self):
+        self._keys.clear()
+        self._values.clear()
 
 
 class pickledb(object):
 
-    def __init__(self, location, option):
+    def __init__(self, location, option, flush_interval=None, flush_ops=None,
+                 journal=False, compact_size=COMPACT_SIZE, lazy=False,
+                 cache_size=LAZY_CACHE_SIZE, codec='json', indexes=None):
         '''Creates a database object and loads the data from the location path.
-        If the file does not exist it will be created on the first update.'''
+        If the file does not exist it will be created on the first update.
+
+        Snapshots are written by a background thread to a temp file that is
+        fsynced and then renamed over the db file, so a crash leaves either
+        the old or the new version on disk. Mutators only mark the db dirty
+        and wake that thread; with flush_interval and/or flush_ops set it
+        waits to write until flush_interval seconds or flush_ops mutations
+        have passed, whichever comes first (write-behind). Call flush() or
+        close() to write pending changes right away; close() also runs at
+        interpreter exit.
+
+        The db may be used from several threads. Single key reads don't
+        lock at all, mutators hold the write side of a RWLock and the
+        flusher only holds its read side while encoding, so reads never wait
+        for a dump. Use ladd_unique(), incr() and cas() instead of get() and
+        set() pairs where another thread may write the same key.
+
+        With journal=True every mutation is appended as one json line to
+        <location>.journal instead of rewriting the whole file. The journal
+        is replayed on load and folded into a new snapshot in the background
+        once it grows past compact_size bytes. Write-behind options are
+        ignored in journal mode.
+
+        With lazy=True the file is memory-mapped and only its keys are
+        indexed on load. Values are decoded when first used and at most
+        cache_size of them are kept, see LazyDict. Lazy loading can't be
+        combined with journal mode.
+
+        codec is the format snapshots are written in, 'json' or 'binary'
+        (see JSONCodec and BinaryCodec) or a codec object. Either format
+        is loaded, whatever codec is; the next snapshot converts the file.
+        Lazy loading needs json.
+
+        indexes is a dict of name -> Index for lookup(). They are built on
+        load, or for a lazily loaded db on the first lookup(), since that
+        decodes every value.'''
+        if lazy and journal:
+            raise ValueError('lazy loading does not support journal mode')
+        if codec in CODECS:
+            codec = CODECS[codec]
+        elif isinstance(codec, str):
+            raise ValueError('Unknown pickledb codec %r' % (codec,))
+        if lazy and codec.name != 'json':
+            raise ValueError('lazy loading needs the json codec')
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        self.journal = journal
+        self.compact_size = compact_size
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.codec = codec
+        self.indexes = dict(indexes or {})
+        self._journal = None
+        self._journal_size = 0
+        self._compactor = None
+        self._lock = RWLock()
+        self._compact_lock = threading.Lock()
+        self._dirty = 0
+        self._closed = False
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        # Guards _dirty, which handler threads bump while a flush runs
+        self._dirty_lock = threading.Lock()
+        self._flusher = None
+        # While in a batch: key -> value before the batch, and the encoded
+        # journal records of the batch (journal mode only)
+        self._undo = None
+        self._records = None
+        # The shallow copy of the db a snapshot is being encoded from, see
+        # _freeze(), or the changed values of a lazy db being written
+        self._frozen = None
+        # Whether the indexes are built and kept up to date, see lookup()
+        self._indexed = False
+        self._index_lock = threading.Lock()
+        # See write_stats()
+        self.mutations = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0
         self.load(location, option)
+        if not journal:
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             name='pickledb-flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+        self._exit_hook = _close_at_exit(self)
 
     def load(self, location, option):
         '''Loads, reloads or changes the path to the db file.
         DO NOT USE this method has it may be deprecated in the future.'''
         location = os.path.expanduser(location)
         self.loco = location
+        self.jloc = location + '.journal'
         self.fsave = option
-        if os.path.exists(location):
+        if self.journal:
+            self._recover()
+        elif self.lazy:
+            self.db = LazyDict(location if os.path.exists(location) else None,
+                               self._lock, self.cache_size)
+        elif os.path.exists(location):
             self._loaddb()
         else:
             self.db = {}
+        self._indexed = False
+        if not self.lazy:
+            self._build_indexes()
         return True
 
     def dump(self):
         '''Force dump memory db to file.'''
-        self._dumpdb(True)
+        if self._journal is not None:
+            return self.compact()
+        with self._flush_lock:
+            with self._dirty_lock:
+                self._dirty = 0
+            self._writedb()
+        return True
+
+    def flush(self):
+        '''Write changes held back by write-behind mode to the file, or
+        fsync the journal in journal mode.
+        Returns False if there was nothing to write.'''
+        if self._journal is not None:
+            with self._lock.write:
+                os.fsync(self._journal.fileno())
+            return True
+        with self._flush_lock:
+            with self._dirty_lock:
+                if not self._dirty:
+                    return False
+                self._dirty = 0
+            try:
+                self._writedb()
+            except Exception:
+                with self._dirty_lock:
+                    self._dirty += 1
+                raise
+        return True
+
+    def close(self):
+        '''Stop the write-behind flusher and write out pending changes.
+        Safe to call more than once.'''
+        atexit.unregister(self._exit_hook)
+        self._closed = True
+        if self._flusher is not None:
+            self._wake.set()
+            self._flusher.join()
+            self._flusher = None
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        if self._journal is not None:
+            self.flush()
+            self._journal.close()
+            self._journal = None
+        self.flush()
+        return True
+
+    def compact(self):
+        '''Fold the journal into a new snapshot of the db file and start an
+        empty journal. Writers only wait while the snapshot is encoded.'''
+        if self._journal is None:
+            return self.dump()
+        old = self.jloc + '.old'
+        compacted = self.loco + '.compact'
+        with self._compact_lock:
+            start = time.perf_counter()
+            try:
+                with self._lock.write:
+                    snapshot = self._freeze()
+                    self._journal.close()
+                    if os.path.exists(old):
+                        # An earlier compaction failed half way, keep its
+                        # records
+                        with io.open(old, 'ab') as dst, \
+                                io.open(self.jloc, 'rb') as src:
+                            shutil.copyfileobj(src, dst)
+                        os.remove(self.jloc)
+                    else:
+                        os.replace(self.jloc, old)
+                    self._journal = io.open(self.jloc, 'ab')
+                    self._journal_size = 0
+                f = self._encode(compacted, snapshot)
+            finally:
+                self._frozen = None
+            # Until <location>.compact exists the old snapshot plus both
+            # journals is the truth; once it does, it replaces all three.
+            self._commit(f, compacted, start)
+            os.remove(old)
+            os.replace(compacted, self.loco)
         return True
 
+    def write_stats(self):
+        '''Return the number of mutations, of writes to the db file or
+        journal, of bytes written and the seconds snapshots took to write
+        so far'''
+        return {'mutations': self.mutations, 'writes': self.writes,
+                'bytes_written': self.bytes_written,
+                'write_seconds': self.write_seconds}
+
+    @_mutator
     def set(self, key, value):
         '''Set the (string,int,whatever) value of a key'''
         self.db[key] = value
-        self._dumpdb(self.fsave)
+        self._changed('set', key, value)
         return True
 
     def get(self, key):
@@ -82,24 +928,129 @@ class pickledb(object):
 
     def getall(self):
         '''Return a list of all keys in db'''
-        return self.db.keys()
+        with self._lock.read:
+            return list(self.db.keys())
+
+    def mget(self, keys):
+        '''Get the values of several keys, None for missing ones'''
+        with self._lock.read:
+            return [self._held(key, None) for key in keys]
+
+    def lookup(self, name, value):
+        '''Return the set of keys the index name maps value to, see Index'''
+        index = self.indexes[name]
+        with self._lock.read:
+            if not self._indexed:
+                # Other readers may be here as well, but no writer
+                with self._index_lock:
+                    if not self._indexed:
+                        self._build_indexes()
+            return index.lookup(value)
+
+    def mset(self, mapping):
+        '''Set several keys from a dict, persisted as one change'''
+        with self._lock.write:
+            if self._undo is not None:
+                for key in mapping:
+                    self._save(key)
+            for key, value in mapping.items():
+                self.db[key] = value
+            self._changed('mset', dict(mapping))
+        return True
+
+    def mdel(self, keys):
+        '''Delete several keys, persisted as one change. Missing keys are
+        skipped. Returns the number of keys deleted'''
+        with self._lock.write:
+            keys = [key for key in keys if key in self.db]
+            if self._undo is not None:
+                for key in keys:
+                    self._save(key)
+            for key in keys:
+                del self.db[key]
+            if keys:
+                self._changed('mdel', keys)
+        return len(keys)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group the mutations made in a with block into one transaction:
+
+            with db.batch():
+                db.set('a', 1)
+                db.sadd('chats', 2)
+
+        They are persisted together once the block ends, as one snapshot
+        or one journal record, and undone if it raises. Other writers wait
+        until the block ends; readers on other threads may see the changes
+        before that. A batch within a batch is part of the outer one.'''
+        with self._lock.write:
+            if self._undo is not None:
+                yield self
+                return
+            self._undo = {}
+            self._records = [] if self._journal is not None else None
+            try:
+                yield self
+            except BaseException:
+                undo, self._undo, self._records = self._undo, None, None
+                for key, value in undo.items():
+                    if value is _MISSING:
+                        if key in self.db:
+                            del self.db[key]
+                    else:
+                        self.db[key] = value
+                    if self._indexed:
+                        for index in self.indexes.values():
+                            index.update(key, value)
+                raise
+            undo, self._undo = self._undo, None
+            records, self._records = self._records, None
+            if not undo:
+                return
+            if records is None:
+                self._dumpdb(self.fsave)
+            elif self.fsave:
+                self._append('["_apply", [%s]]\n' % ', '.join(records))
+
+    @_mutator
+    def incr(self, key, amount=1):
+        '''Add amount to the number stored at key, which counts as 0 when
+        missing. Returns the new value'''
+        value = self.db.get(key, 0) + amount
+        self.db[key] = value
+        self._changed('set', key, value)
+        return value
+
+    @_mutator
+    def cas(self, key, expected, value):
+        '''Compare and set: set key to value only if it currently holds
+        expected (None for a missing key). Returns True if it was set'''
+        if self.db.get(key) != expected:
+            return False
+        self.db[key] = value
+        self._changed('set', key, value)
+        return True
 
+    @_mutator
     def rem(self, key):
         '''Delete a key'''
         del self.db[key]
-        self._dumpdb(self.fsave)
+        self._changed('rem', key)
         return True
 
+    @_mutator
     def lcreate(self, name):
         '''Create a list'''
         self.db[name] = []
-        self._dumpdb(self.fsave)
+        self._changed('lcreate', name)
         return True
 
+    @_mutator
     def ladd(self, name, value):
         '''Add a value to a list'''
-        self.db[name].append(value)
-        self._dumpdb(self.fsave)
+        self._mutable(name).append(value)
+        self._changed('ladd', name, value)
         return True
 
     def lgetall(self, name):
@@ -110,48 +1061,75 @@ class pickledb(object):
         '''Return one value in a list'''
         return self.db[name][pos]
 
+    @_mutator
+    def ladd_unique(self, name, value):
+        '''Add a value to a list unless it is already in there.
+        Returns True if the value was added'''
+        if value in self.db[name]:
+            return False
+        self._mutable(name).append(value)
+        self._changed('ladd', name, value)
+        return True
+
+    @_mutator
+    def lrem_value(self, name, value):
+        '''Remove the first occurrence of a value from a list.
+        Returns False if the value wasn't in the list'''
+        try:
+            self._mutable(name).remove(value)
+        except ValueError:
+            return False
+        self._changed('lrem_value', name, value)
+        return True
+
+    @_mutator
     def lrem(self, name):
         '''Remove a list and all of its values'''
         number = len(self.db[name])
         del self.db[name]
-        self._dumpdb(self.fsave)
+        self._changed('lrem', name)
         return number
 
+    @_mutator
     def lpop(self, name, pos):
         '''Remove one value in a list'''
         value = self.db[name][pos]
-        del self.db[name][pos]
-        self._dumpdb(self.fsave)
+        del self._mutable(name)[pos]
+        self._changed('lpop', name, pos)
         return value
 
     def llen(self, name):
         '''Returns the length of the list'''
         return len(self.db[name])
 
+    @_mutator
     def append(self, key, more):
         '''Add more to a key's value'''
         tmp = self.db[key]
         self.db[key] = ('%s%s' % (tmp, more))
-        self._dumpdb(self.fsave)
+        self._changed('append', key, more)
         return True
 
+    @_mutator
     def lappend(self, name, pos, more):
         '''Add more to a value in a list'''
         tmp = self.db[name][pos]
-        self.db[name][pos] = ('%s%s' % (tmp, more))
-        self._dumpdb(self.fsave)
+        self._mutable(name)[pos] = ('%s%s' % (tmp, more))
+        self._changed('lappend', name, pos, more)
         return True
 
+    @_mutator
     def dcreate(self, name):
         '''Create a dict'''
         self.db[name] = {}
-        self._dumpdb(self.fsave)
+        self._changed('dcreate', name)
         return True
 
+    @_mutator
     def dadd(self, name, pair):
         '''Add a key-value pair to a dict, "pair" is a tuple'''
-        self.db[name][pair[0]] = pair[1]
-        self._dumpdb(self.fsave)
+        self._mutable(name)[pair[0]] = pair[1]
+        self._changed('dadd', name, pair)
         return True
 
     def dget(self, name, key):
@@ -162,26 +1140,30 @@ class pickledb(object):
         '''Return all key-value pairs from a dict'''
         return self.db[name]
 
+    @_mutator
     def drem(self, name):
         '''Remove a dict and all of its pairs'''
         del self.db[name]
-        self._dumpdb(self.fsave)
+        self._changed('drem', name)
         return True
 
+    @_mutator
     def dpop(self, name, key):
         '''Remove one key-value in a dict'''
         value = self.db[name][key]
-        del self.db[name][key]
-        self._dumpdb(self.fsave)
+        del self._mutable(name)[key]
+        self._changed('dpop', name, key)
         return value
 
     def dkeys(self, name):
         '''Return all the keys for a dict'''
-        return self.db[name].keys()
+        with self._lock.read:
+            return list(self._held(name).keys())
 
     def dvals(self, name):
         '''Return all the values for a dict'''
-        return self.db[name].values()
+        with self._lock.read:
+            return list(self._held(name).values())
 
     def dexists(self, name, key):
         '''Determine if a key exists or not'''
@@ -190,18 +1172,997 @@ class pickledb(object):
         else:
             return 0
 
+    @_mutator
+    def screate(self, name):
+        '''Create a set'''
+        self.db[name] = set()
+        self._changed('screate', name)
+        return True
+
+    @_mutator
+    def sadd(self, name, value):
+        '''Add a value to a set. Returns True if it wasn't in there yet'''
+        if value in self.db[name]:
+            return False
+        self._mutable(name).add(value)
+        self._changed('sadd', name, value)
+        return True
+
+    @_mutator
+    def srem(self, name, value):
+        '''Remove a value from a set. Returns False if it wasn't in there'''
+        if value not in self.db[name]:
+            return False
+        self._mutable(name).remove(value)
+        self._changed('srem', name, value)
+        return True
+
+    def sismember(self, name, value):
+        '''Determine if a value is in a set'''
+        return value in self.db[name]
+
+    def sgetall(self, name):
+        '''Return a copy of all values in a set'''
+        with self._lock.read:
+            return set(self._held(name))
+
+    def slen(self, name):
+        '''Returns the number of values in a set'''
+        return len(self.db[name])
+
+    @_mutator
     def deldb(self):
         '''Delete everything from the database'''
-        self.db = {}
-        self._dumpdb(self.fsave)
+        self.db.clear()
+        self._changed('deldb')
         return True
 
     def _loaddb(self):
-        '''Load or reload the json info from the file'''
-        self.db = json.load(io.open(self.loco, 'r', encoding='utf-8'))
+        '''Load or reload the db from the file, in whichever format it is'''
+        with io.open(self.loco, 'rb') as f:
+            data = f.read()
+        name = 'binary' if data.startswith(BINARY_MAGIC) else 'json'
+        codec = self.codec if self.codec.name == name else CODECS[name]
+        self.db = codec.load(data)
+
+    def _save(self, key):
+        '''Keep the value of key from before the batch, once'''
+        if key not in self._undo:
+            value = self.db.get(key, _MISSING)
+            self._undo[key] = value if value is _MISSING \
+                else copy.deepcopy(value)
+
+    def _apply(self, records):
+        '''Replay the records of a batch from the journal'''
+        for record in records:
+            getattr(self, record[0])(*record[1:])
+
+    def _changed(self, op, *args):
+        '''Update the indexes for a mutation and persist it, either as a
+        journal record or by dumping'''
+        self.mutations += 1
+        if self._indexed:
+            self._reindex(op, args)
+        if self._undo is not None:
+            # Persisted when the batch ends, see batch()
+            if self._records is not None and self.fsave:
+                self._records.append(_dumps((op,) + args))
+            return
+        if self._journal is None:
+            self._dumpdb(self.fsave)
+            return
+        if not self.fsave:
+            return
+        self._append(_dumps((op,) + args) + '\n')
+
+    def _build_indexes(self):
+        '''Index every key of the db, on load() or, if the db is lazy, under
+        the db lock on the first lookup()'''
+        for index in self.indexes.values():
+            index.rebuild((key, self._held(key)) for key in self.db.keys())
+        self._indexed = bool(self.indexes)
+
+    def _reindex(self, op, args):
+        '''Update the indexes for the keys a mutation changed'''
+        if op == 'deldb':
+            for index in self.indexes.values():
+                index.clear()
+            return
+        # The first argument of the other mutators is the key they change
+        keys = args[0] if op in ('mset', 'mdel') else args[:1]
+        for key in keys:
+            value = self.db.get(key, _MISSING)
+            for index in self.indexes.values():
+                index.update(key, value)
+
+    def _append(self, record):
+        '''Write a record to the journal'''
+        record = record.encode('utf-8')
+        self._journal.write(record)
+        self._journal.flush()
+        self._journal_size += len(record)
+        self.writes += 1
+        self.bytes_written += len(record)
+        if self._journal_size >= self.compact_size \
+                and self._compactor is None:
+            self._compactor = threading.Thread(target=self._compact_loop,
+                                               name='pickledb-compactor')
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def _compact_loop(self):
+        '''Body of the background compaction thread'''
+        try:
+            self.compact()
+        finally:
+            self._compactor = None
+
+    def _recover(self):
+        '''Rebuild the db from the last snapshot plus the journal(s) and
+        open the journal for appending'''
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        old = self.jloc + '.old'
+        compacted = self.loco + '.compact'
+        if os.path.exists(compacted):
+            # A compaction got as far as writing its snapshot, which already
+            # contains everything from the rotated journal
+            if os.path.exists(old):
+                os.remove(old)
+            os.replace(compacted, self.loco)
+        if os.path.exists(self.loco):
+            self._loaddb()
+        else:
+            self.db = {}
+        fsave, self.fsave = self.fsave, False
+        try:
+            self._replay(old)
+            good = self._replay(self.jloc)
+        finally:
+            self.fsave = fsave
+            # Replayed records aren't new changes
+            self.mutations = 0
+        self._journal = io.open(self.jloc, 'ab')
+        # Drop a trailing record that was torn by a crash
+        self._journal.truncate(good)
+        self._journal_size = good
+        if os.path.exists(old):
+            self.compact()
+
+    def _replay(self, path):
+        '''Apply the records of a journal file to the db. Returns the size
+        of the valid part of the file.'''
+        good = 0
+        if not os.path.exists(path):
+            return good
+        with io.open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = _loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if record[0] not in JOURNAL_OPS:
+                    raise ValueError('Unknown journal op %r in %s'
+                                     % (record[0], path))
+                getattr(self, record[0])(*record[1:])
+                good += len(line)
+        return good
 
     def _dumpdb(self, forced):
-        '''Dump (write, save) the json dump into the file'''
-        if forced:
-            f = io.open(self.loco, 'w', encoding='utf-8')
-            f.write(json.dumps(self.db, ensure_ascii=False))
+        '''Mark the db dirty and wake the flusher thread to dump (write,
+        save) it, unless write-behind mode holds the write back'''
+        if not forced:
+            return
+        with self._dirty_lock:
+            self._dirty += 1
+            dirty = self._dirty
+        if self.flush_ops and dirty >= self.flush_ops \
+                or not (self.flush_interval or self.flush_ops):
+            self._wake.set()
+
+    def _writedb(self):
+        '''Write the whole db to the file'''
+        if self.lazy:
+            return self._writelazy()
+        # Writers only wait for the shallow copy, not for the encoding
+        start = time.perf_counter()
+        with self._lock.read:
+            snapshot = self._freeze()
+        try:
+            f = self._encode(self.loco, snapshot)
+        finally:
+            self._frozen = None
+        self._commit(f, self.loco, start)
+
+    def _writelazy(self):
+        '''Write a LazyDict to the file, then switch it over to that file'''
+        tmp = self.loco + '.tmp'
+        start = time.perf_counter()
+        # Writers only wait for the capture, not for the copy
+        with self._lock.read:
+            snapshot = self.db.snapshot()
+            self._frozen = snapshot[2]
+        try:
+            with io.open(tmp, 'wb') as f:
+                written = self.db.write(f, snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+                self.writes += 1
+                self.bytes_written += f.tell()
+        finally:
+            self._frozen = None
+        self.write_seconds += time.perf_counter() - start
+        os.replace(tmp, self.loco)
+        self._fsync_dir(self.loco)
+        with self._lock.write:
+            self.db.reopen(self.loco, written)
+        # Only a speed-up for the next load, a stale or torn one is ignored
+        self.db.save_index(self.loco)
+
+    def _held(self, key, default=_MISSING):
+        '''self.db[key], or default for a missing key if given, for callers
+        holding the db lock, without a LazyDict taking it again'''
+        try:
+            return self.db.fetch(key) if self.lazy else self.db[key]
+        except KeyError:
+            if default is _MISSING:
+                raise
+            return default
+
+    def _freeze(self):
+        '''Return a shallow copy of the db to encode a snapshot from. Must
+        be called with the db lock held. Until _frozen is reset, mutators
+        copy a list, dict or set before changing it in place (see
+        _mutable()), so the snapshot keeps the value it had.'''
+        self._frozen = dict(self.db)
+        return self._frozen
+
+    def _mutable(self, name):
+        '''Return the value of name for changing it in place, copied first
+        if the snapshot being encoded holds the same object'''
+        value = self.db[name]
+        frozen = self._frozen
+        if frozen is not None and frozen.get(name) is value:
+            value = self.db[name] = copy.copy(value)
+        return value
+
+    def _encode(self, path, snapshot):
+        '''Stream a snapshot taken by _freeze() to a temp file next to path
+        with the codec. Returns the file for _commit().'''
+        f = io.open(path + '.tmp', 'wb')
+        try:
+            self.codec.dump(snapshot.items(), f)
+            f.flush()
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    def _commit(self, f, path, start):
+        '''fsync a temp file written by _encode() and rename it over path,
+        so path is atomically replaced. start is when encoding began.'''
+        try:
+            os.fsync(f.fileno())
+            self.writes += 1
+            self.bytes_written += f.tell()
+        finally:
+            f.close()
+        self.write_seconds += time.perf_counter() - start
+        os.replace(f.name, path)
+        self._fsync_dir(path)
+
+    def _fsync_dir(self, path):
+        '''Make a rename into the directory of path durable'''
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(os.path.dirname(path) or '.', os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _flush_loop(self):
+        '''Body of the flusher thread'''
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except (IOError, OSError):
+                # Still dirty, try again on the next wake up
+                pass
+
+
+# Sets are stored as this marker in kv plus one members row per value
+_SET = _dumps(set())
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)
+    WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS members (name TEXT, member TEXT,
+    PRIMARY KEY (name, member)) WITHOUT ROWID;
+"""
+_GET = 'SELECT value FROM kv WHERE key = ?'
+_PUT = 'INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)'
+_DEL = 'DELETE FROM kv WHERE key = ?'
+_KEYS = 'SELECT key FROM kv'
+_MEMBERS = 'SELECT member FROM members WHERE name = ?'
+_IS_MEMBER = 'SELECT 1 FROM members WHERE name = ? AND member = ?'
+_COUNT_MEMBERS = 'SELECT COUNT(*) FROM members WHERE name = ?'
+_ADD_MEMBER = 'INSERT OR IGNORE INTO members (name, member) VALUES (?, ?)'
+_DEL_MEMBER = 'DELETE FROM members WHERE name = ? AND member = ?'
+_DEL_MEMBERS = 'DELETE FROM members WHERE name = ?'
+
+
+def _locked(method):
+    '''Run a sqlitedb method while holding its connection lock'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class sqlitedb(object):
+    '''The pickledb API on top of a SQLite file instead of a json document
+    held in memory. Each key is a row holding its json encoded value, the
+    values of sets are rows of their own so membership tests and adds
+    don't decode the whole set. Only the rows a call touches are read or
+    written, so startup and write cost don't grow with the db.
+
+    Values are decoded from their row on every read, so unlike pickledb,
+    get(), lgetall() and dgetall() return copies: changing one in place
+    changes nothing in the db, write it back with set().'''
+
+    def __init__(self, location, option, flush_interval=None, flush_ops=None,
+                 indexes=None):
+        '''Opens (creating if needed) the SQLite db at location in WAL mode.
+
+        Writes go into an open transaction. It is committed after every
+        mutation, or with flush_interval and/or flush_ops set, every
+        flush_interval seconds or after flush_ops mutations, whichever
+        comes first. Call flush() or close() to commit right away; close()
+        also runs at interpreter exit.
+
+        Only flush_interval starts a background thread. By default every
+        mutation commits before it returns, so there is nothing left for
+        one to do. With flush_ops alone, the mutation that reaches it
+        commits, and up to flush_ops - 1 mutations after the last one wait
+        for flush() or close().
+
+        indexes is a dict of name -> Index for lookup(). They are kept in
+        memory and built on load, which reads every row.'''
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        self.indexes = dict(indexes or {})
+        self._lock = threading.RLock()
+        self._conn = None
+        self._dirty = 0
+        self._closed = False
+        self._wake = threading.Event()
+        self._flusher = None
+        # True while in a batch, see batch()
+        self._batch = False
+        # See write_stats()
+        self.mutations = 0
+        self.writes = 0
+        self.write_seconds = 0.0
+        self.load(location, option)
+        if flush_interval:
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             name='sqlitedb-flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+        self._exit_hook = _close_at_exit(self)
+
+    @_locked
+    def load(self, location, option):
+        '''Opens or changes the path to the db file'''
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+        location = os.path.expanduser(location)
+        self.loco = location
+        self.fsave = option
+        # Transactions are handled by _begin()/flush() rather than sqlite3
+        self._conn = sqlite3.connect(location, isolation_level=None,
+                                     check_same_thread=False,
+                                     cached_statements=64)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._rebuild_indexes()
+        return True
+
+    def dump(self):
+        '''Force commit of all pending writes. In a batch, they are
+        committed when it ends.'''
+        with self._lock:
+            if self._batch:
+                return True
+            self._dirty = 0
+            if self._conn.in_transaction:
+                start = time.perf_counter()
+                self._conn.execute('COMMIT')
+                self.writes += 1
+                self.write_seconds += time.perf_counter() - start
+        return True
+
+    def flush(self):
+        '''Commit writes held back by flush_interval/flush_ops.
+        Returns False if there was nothing to commit.'''
+        with self._lock:
+            if not self._dirty:
+                return False
+            return self.dump()
+
+    def close(self):
+        '''Stop the flusher, commit and close the db. Safe to call more
+        than once.'''
+        atexit.unregister(self._exit_hook)
+        self._closed = True
+        if self._flusher is not None:
+            self._wake.set()
+            self._flusher.join()
+            self._flusher = None
+        with self._lock:
+            if self._conn is not None:
+                self.dump()
+                self._conn.close()
+                self._conn = None
+        return True
+
+    def write_stats(self):
+        '''Return the number of mutations, of commits and the seconds the
+        commits took so far. SQLite doesn't tell how many bytes a commit
+        wrote.'''
+        return {'mutations': self.mutations, 'writes': self.writes,
+                'write_seconds': self.write_seconds}
+
+    @_locked
+    def set(self, key, value):
+        '''Set the (string,int,whatever) value of a key'''
+        self._put(key, value)
+        self._changed()
+        return True
+
+    @_locked
+    def get(self, key):
+        '''Get the value of a key'''
+        try:
+            return self._value(key)
+        except KeyError:
+            return None
+
+    @_locked
+    def getall(self):
+        '''Return a list of all keys in db'''
+        return [row[0] for row in self._conn.execute(_KEYS)]
+
+    @_locked
+    def mget(self, keys):
+        '''Get the values of several keys, None for missing ones'''
+        return [self.get(key) for key in keys]
+
+    @_locked
+    def lookup(self, name, value):
+        '''Return the set of keys the index name maps value to, see Index'''
+        return self.indexes[name].lookup(value)
+
+    @_locked
+    def mset(self, mapping):
+        '''Set several keys from a dict, committed as one change'''
+        for key, value in mapping.items():
+            self._put(key, value)
+        self._changed()
+        return True
+
+    @_locked
+    def mdel(self, keys):
+        '''Delete several keys, committed as one change. Missing keys are
+        skipped. Returns the number of keys deleted'''
+        self._begin()
+        deleted = 0
+        for key in keys:
+            deleted += self._conn.execute(_DEL, (key,)).rowcount
+            self._conn.execute(_DEL_MEMBERS, (key,))
+            self._reindex(key, _MISSING)
+        if deleted:
+            self._changed()
+        return deleted
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group the mutations made in a with block into one transaction,
+        committed once the block ends and rolled back if it raises. Other
+        threads wait until the block ends. A batch within a batch is part
+        of the outer one.'''
+        with self._lock:
+            if self._batch:
+                yield self
+                return
+            # Within the open transaction, so releasing the savepoint
+            # doesn't commit writes held back by flush_interval/flush_ops
+            self._begin()
+            self._conn.execute('SAVEPOINT batch')
+            self._batch = True
+            try:
+                yield self
+            except BaseException:
+                self._batch = False
+                self._conn.execute('ROLLBACK TO batch')
+                self._conn.execute('RELEASE batch')
+                self._rebuild_indexes()
+                raise
+            self._batch = False
+            self._conn.execute('RELEASE batch')
+            self._changed()
+
+    @_locked
+    def incr(self, key, amount=1):
+        '''Add amount to the number stored at key, which counts as 0 when
+        missing. Returns the new value'''
+        value = (self.get(key) or 0) + amount
+        self._put(key, value)
+        self._changed()
+        return value
+
+    @_locked
+    def cas(self, key, expected, value):
+        '''Compare and set: set key to value only if it currently holds
+        expected (None for a missing key). Returns True if it was set'''
+        if self.get(key) != expected:
+            return False
+        self._put(key, value)
+        self._changed()
+        return True
+
+    @_locked
+    def rem(self, key):
+        '''Delete a key'''
+        self._value(key)
+        self._begin()
+        self._conn.execute(_DEL, (key,))
+        self._conn.execute(_DEL_MEMBERS, (key,))
+        self._reindex(key, _MISSING)
+        self._changed()
+        return True
+
+    def lcreate(self, name):
+        '''Create a list'''
+        return self.set(name, [])
+
+    @_locked
+    def ladd(self, name, value):
+        '''Add a value to a list'''
+        values = self._value(name)
+        values.append(value)
+        self._put(name, values)
+        self._changed()
+        return True
+
+    @_locked
+    def ladd_unique(self, name, value):
+        '''Add a value to a list unless it is already in there.
+        Returns True if the value was added'''
+        values = self._value(name)
+        if value in values:
+            return False
+        values.append(value)
+        self._put(name, values)
+        self._changed()
+        return True
+
+    @_locked
+    def lrem_value(self, name, value):
+        '''Remove the first occurrence of a value from a list.
+        Returns False if the value wasn't in the list'''
+        values = self._value(name)
+        try:
+            values.remove(value)
+        except ValueError:
+            return False
+        self._put(name, values)
+        self._changed()
+        return True
+
+    def lgetall(self, name):
+        '''Return a copy of all values in a list'''
+        return self._value(name)
+
+    def lget(self, name, pos):
+        '''Return one value in a list'''
+        return self._value(name)[pos]
+
+    @_locked
+    def lrem(self, name):
+        '''Remove a list and all of its values'''
+        number = len(self._value(name))
+        self.rem(name)
+        return number
+
+    @_locked
+    def lpop(self, name, pos):
+        '''Remove one value in a list'''
+        values = self._value(name)
+        value = values.pop(pos)
+        self._put(name, values)
+        self._changed()
+        return value
+
+    def llen(self, name):
+        '''Returns the length of the list'''
+        return len(self._value(name))
+
+    @_locked
+    def append(self, key, more):
+        '''Add more to a key's value'''
+        self._put(key, '%s%s' % (self._value(key), more))
+        self._changed()
+        return True
+
+    @_locked
+    def lappend(self, name, pos, more):
+        '''Add more to a value in a list'''
+        values = self._value(name)
+        values[pos] = '%s%s' % (values[pos], more)
+        self._put(name, values)
+        self._changed()
+        return True
+
+    def dcreate(self, name):
+        '''Create a dict'''
+        return self.set(name, {})
+
+    @_locked
+    def dadd(self, name, pair):
+        '''Add a key-value pair to a dict, "pair" is a tuple'''
+        values = self._value(name)
+        values[pair[0]] = pair[1]
+        self._put(name, values)
+        self._changed()
+        return True
+
+    def dget(self, name, key):
+        '''Return the value for a key in a dict'''
+        return self._value(name)[key]
+
+    def dgetall(self, name):
+        '''Return a copy of all key-value pairs from a dict'''
+        return self._value(name)
+
+    def drem(self, name):
+        '''Remove a dict and all of its pairs'''
+        return self.rem(name)
+
+    @_locked
+    def dpop(self, name, key):
+        '''Remove one key-value in a dict'''
+        values = self._value(name)
+        value = values.pop(key)
+        self._put(name, values)
+        self._changed()
+        return value
+
+    def dkeys(self, name):
+        '''Return all the keys for a dict'''
+        return list(self._value(name).keys())
+
+    def dvals(self, name):
+        '''Return all the values for a dict'''
+        return list(self._value(name).values())
+
+    def dexists(self, name, key):
+        '''Determine if a key exists or not'''
+        if self._value(name)[key] is not None:
+            return 1
+        else:
+            return 0
+
+    def screate(self, name):
+        '''Create a set'''
+        return self.set(name, set())
+
+    @_locked
+    def sadd(self, name, value):
+        '''Add a value to a set. Returns True if it wasn't in there yet'''
+        self._set_exists(name)
+        self._begin()
+        added = self._conn.execute(_ADD_MEMBER,
+                                   (name, _dumps(value))).rowcount > 0
+        if added:
+            self._changed()
+        return added
+
+    @_locked
+    def srem(self, name, value):
+        '''Remove a value from a set. Returns False if it wasn't in there'''
+        self._set_exists(name)
+        self._begin()
+        removed = self._conn.execute(_DEL_MEMBER,
+                                     (name, _dumps(value))).rowcount > 0
+        if removed:
+            self._changed()
+        return removed
+
+    @_locked
+    def sismember(self, name, value):
+        '''Determine if a value is in a set'''
+        self._set_exists(name)
+        return self._conn.execute(_IS_MEMBER,
+                                  (name, _dumps(value))).fetchone() is not None
+
+    def sgetall(self, name):
+        '''Return a copy of all values in a set'''
+        return self._value(name)
+
+    @_locked
+    def slen(self, name):
+        '''Returns the number of values in a set'''
+        self._set_exists(name)
+        return self._conn.execute(_COUNT_MEMBERS, (name,)).fetchone()[0]
+
+    @_locked
+    def deldb(self):
+        '''Delete everything from the database'''
+        self._begin()
+        self._conn.execute('DELETE FROM kv')
+        self._conn.execute('DELETE FROM members')
+        for index in self.indexes.values():
+            index.clear()
+        self._changed()
+        return True
+
+    def _begin(self):
+        '''Open a transaction for the next write unless one is open'''
+        if not self._conn.in_transaction:
+            self._conn.execute('BEGIN')
+
+    def _changed(self):
+        '''Count a mutation and commit when it is time to'''
+        self.mutations += 1
+        if not self.fsave or self._batch:
+            return
+        self._dirty += 1
+        if not (self.flush_interval or self.flush_ops) \
+                or self.flush_ops and self._dirty >= self.flush_ops:
+            self.dump()
+
+    def _value(self, key):
+        '''Return the value of a key, raising KeyError if it is missing'''
+        with self._lock:
+            row = self._conn.execute(_GET, (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            if row[0] == _SET:
+                return set(_loads(member) for (member,)
+                           in self._conn.execute(_MEMBERS, (key,)))
+            return _loads(row[0])
+
+    def _set_exists(self, name):
+        '''Raise KeyError unless name holds a set'''
+        row = self._conn.execute(_GET, (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        if row[0] != _SET:
+            raise TypeError('%r is not a set' % (name,))
+
+    def _put(self, key, value):
+        '''Write the row(s) of a key'''
+        self._begin()
+        self._conn.execute(_DEL_MEMBERS, (key,))
+        if isinstance(value, (set, frozenset)):
+            self._conn.execute(_PUT, (key, _SET))
+            self._conn.executemany(_ADD_MEMBER,
+                                   ((key, _dumps(v)) for v in value))
+        else:
+            self._conn.execute(_PUT, (key, _dumps(value)))
+        self._reindex(key, value)
+
+    def _reindex(self, key, value):
+        '''Update the indexes for a key that now holds value'''
+        for index in self.indexes.values():
+            index.update(key, value)
+
+    def _rebuild_indexes(self):
+        '''Build the indexes from the rows of the db'''
+        if not self.indexes:
+            return
+        # Sets can't be indexed, so their members aren't read
+        rows = [(key, _MISSING if value == _SET else _loads(value))
+                for key, value in self._conn.execute(
+                    'SELECT key, value FROM kv')]
+        for index in self.indexes.values():
+            index.rebuild(rows)
+
+    def _flush_loop(self):
+        '''Body of the flusher thread'''
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # Still dirty, try again on the next wake up
+                pass
+
+
+
+class LRUCache(object):
+    '''A thread-safe mapping that keeps the size most recently used keys,
+    each for at most ttl seconds if ttl is set. Counts hits, misses,
+    evictions and expiries, see stats(). lock may be held around several
+    calls to make them atomic.'''
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        '''Return the value of key, or default on a miss'''
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._data[key]
+                self.expired += 1
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        '''Store value under key, evicting the least recently used keys
+        if the cache is full'''
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        '''Drop key from the cache'''
+        with self.lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        '''Return the counters and current size as a dict'''
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expired': self.expired,
+                    'size': len(self._data)}
+
+
+def _invalidating(name):
+    '''Make a cacheddb method that runs a mutator of the wrapped db and then
+    drops the key it changed (its first argument) from the cache'''
+    first = list(inspect.signature(getattr(pickledb, name)).parameters)[1]
+
+    def method(self, *args, **kwargs):
+        try:
+            return getattr(self.backend, name)(*args, **kwargs)
+        finally:
+            self._invalidate(args[0] if args else kwargs.get(first))
+    method.__name__ = name
+    method.__doc__ = getattr(pickledb, name).__doc__
+    return method
+
+
+class cacheddb(object):
+    '''Read cache in front of a pickledb or sqlitedb. get() answers from an
+    LRUCache of recently read keys and goes to the wrapped db on a miss;
+    every mutator drops the key it changes from the cache. Best paired with
+    the SQLite backend, where it keeps only the hot keys in memory.
+
+    Values returned by get() are shared with the cache and must not be
+    modified in place. Everything else is passed through to the wrapped
+    db, which is available as backend.'''
+
+    def __init__(self, db, size, ttl=None):
+        self.backend = db
+        self.cache = LRUCache(size, ttl)
+        # Bumped by every write so a miss can tell whether the value it
+        # read may already be out of date
+        self._generation = 0
+
+    def get(self, key):
+        '''Get the value of a key'''
+        value = self.cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        generation = self._generation
+        value = self.backend.get(key)
+        with self.cache.lock:
+            if generation == self._generation:
+                self.cache.put(key, value)
+        return value
+
+    def load(self, location, option):
+        self.cache.clear()
+        return self.backend.load(location, option)
+
+    def deldb(self):
+        '''Delete everything from the database'''
+        try:
+            return self.backend.deldb()
+        finally:
+            with self.cache.lock:
+                self._generation += 1
+                self.cache.clear()
+
+    def mget(self, keys):
+        '''Get the values of several keys, None for missing ones'''
+        return [self.get(key) for key in keys]
+
+    def mset(self, mapping):
+        '''Set several keys from a dict, persisted as one change'''
+        try:
+            return self.backend.mset(mapping)
+        finally:
+            for key in mapping:
+                self._invalidate(key)
+
+    def mdel(self, keys):
+        '''Delete several keys, persisted as one change'''
+        keys = list(keys)
+        try:
+            return self.backend.mdel(keys)
+        finally:
+            for key in keys:
+                self._invalidate(key)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''See pickledb.batch()'''
+        try:
+            with self.backend.batch():
+                yield self
+        except BaseException:
+            # Values read in the batch may have been rolled back
+            with self.cache.lock:
+                self._generation += 1
+                self.cache.clear()
+            raise
+
+    def stats(self):
+        '''Return the cache counters, see LRUCache.stats()'''
+        return self.cache.stats()
+
+    def _invalidate(self, key):
+        with self.cache.lock:
+            self._generation += 1
+            self.cache.pop(key)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+for _name in ('set', 'rem', 'incr', 'cas', 'lcreate', 'ladd', 'ladd_unique',
+              'lrem_value', 'lrem', 'lpop', 'append', 'lappend', 'dcreate',
+              'dadd', 'drem', 'dpop', 'screate', 'sadd', 'srem'):
+    setattr(cacheddb, _name, _invalidating(_name))
+del _name
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        sys.exit('Usage: %s <json db> <sqlite db>' % sys.argv[0])
+    print('Copied %d keys' % convert(sys.argv[1], sys.argv[2]))
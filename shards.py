@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Runs the bot as several processes, each owning the chats of one shard:
+
+    [Bot]
+    shards = 4
+
+    python3 shards.py
+
+This is the ingestion process. It gets the updates like a single bot would
+(polling or webhook, see aiobot.py) and writes each one, as a line of json,
+to the stdin of the worker process that owns its chat: worker
+chat_id % shards. Workers are bot.py processes started with BOT_SHARD and
+BOT_SHARDS in their environment. Each loads only the db file of its shard
+(bot.<shard>.db) and handles the updates in the order they were written.
+So the updates of a chat are handled in order, and a chat's settings live
+in exactly one process: a /welcome is read back by the same worker that
+wrote it, there's no other copy to go stale. Workers send their replies
+themselves and split the global rate limit between them. Commands about
+every chat, /broadcast, are written to every worker instead, which each
+runs them for the chats it owns (see FANOUT).
+
+When the number of shards changes, the first start splits bot.db (or the
+shard files of the old number of shards) into the new ones, see reshard().
+"""
+import argparse
+import asyncio
+import configparser
+import glob
+import logging
+import os
+import re
+import sys
+from os.path import dirname, realpath, join
+
+import aiobot
+import logs
+import python3pickledb as pickledb
+from broadcast import KEY as BROADCAST_KEY
+
+ROOT = dirname(realpath(__file__))
+BOT = join(ROOT, 'bot.py')
+
+# Keys of bot.db that belong to one chat, see chatsettings.py
+CHAT_KEY = re.compile(r'^(-?\d+)(_\w+)?$')
+
+# Commands passed on to every worker, not only to the one of their chat
+FANOUT = ['broadcast']
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(chat_id, shards):
+    """ Returns the shard that owns a chat """
+    return int(chat_id) % shards
+
+
+def shard_path(path, shard):
+    """ Returns the db file of a shard, bot.db -> bot.<shard>.db """
+    root, ext = os.path.splitext(path)
+    return '%s.%d%s' % (root, shard, ext)
+
+
+def shard_paths(path):
+    """ Returns {shard: db file} of the shard files of path there are """
+    root, ext = os.path.splitext(path)
+    found = {}
+    for name in glob.glob('%s.*%s' % (glob.escape(root), ext)):
+        shard = name[len(root) + 1:len(name) - len(ext)]
+        if shard.isdigit():
+            found[int(shard)] = name
+    return found
+
+
+def reshard(path, shards, backend='json'):
+    """
+    Splits the db at path, or the shard files of it there are, into shards
+    shard files. Per chat keys and the chats set are split by chat. Every
+    shard runs a broadcast for its own chats, so the checkpoints of a
+    running one are merged into one that every new shard resumes, after
+    the lowest cursor of them (see merge_checkpoints()). Other keys are
+    copied to every shard. The old files are kept with a .bak suffix.
+    Returns False if the files already are split that way or there is no db
+    yet.
+    """
+    old = shard_paths(path)
+    if sorted(old) == list(range(shards)):
+        return False
+    sources = [old[shard] for shard in sorted(old)] or \
+        ([path] if os.path.exists(path) else [])
+    if not sources:
+        return False
+
+    records = [{'chats': set()} for _ in range(shards)]
+    checkpoints = []
+    for source in sources:
+        db = pickledb.load(source, False, backend=backend)
+        try:
+            for key in db.getall():
+                value = db.get(key)
+                match = CHAT_KEY.match(key)
+                if key == 'chats':
+                    for chat in value or ():
+                        records[shard_of(chat, shards)]['chats'].add(chat)
+                elif match:
+                    records[shard_of(match.group(1), shards)][key] = value
+                elif key == BROADCAST_KEY:
+                    checkpoints.append(value)
+                else:
+                    for record in records:
+                        record.setdefault(key, value)
+        finally:
+            db.close()
+    if checkpoints:
+        checkpoint = merge_checkpoints(checkpoints, len(sources))
+        for record in records:
+            record[BROADCAST_KEY] = checkpoint
+
+    # Written next to the old files first, so a crash in between leaves the
+    # old files as they were
+    for shard, record in enumerate(records):
+        new = shard_path(path, shard) + '.new'
+        if os.path.exists(new):
+            os.remove(new)
+        db = pickledb.load(new, False, backend=backend)
+        for key, value in record.items():
+            db.set(key, value)
+        db.dump()
+        db.close()
+    for source in sources:
+        os.replace(source, source + '.bak')
+    for shard in range(shards):
+        os.replace(shard_path(path, shard) + '.new', shard_path(path, shard))
+    logger.info('Split %s into %d shards', ', '.join(sources), shards)
+    return True
+
+
+def merge_checkpoints(checkpoints, sources):
+    """
+    Returns the broadcast checkpoint that resumes the checkpoints of
+    sources shard files in every new shard. A shard that had no checkpoint
+    left was done, or never started (see broadcast.py), so its chats after
+    the lowest cursor get the message again: a chat is sent to twice rather
+    than not at all. The counts of the old shards can't be split by the new
+    ones, each new shard starts counting again.
+    """
+    checkpoint = dict(checkpoints[0], sent=0, failed=0)
+    if len(checkpoints) < sources:
+        logger.warning('Only %d of %d shards had a broadcast checkpoint, the '
+                       'chats of the others after the cursor are sent to '
+                       'again', len(checkpoints), sources)
+    for other in checkpoints[1:]:
+        if (other['text'], other['owner']) != \
+                (checkpoint['text'], checkpoint['owner']):
+            logger.warning('Shards were running different broadcasts, '
+                           'resuming the first one only')
+            continue
+        if other['cursor'] is None or checkpoint['cursor'] is not None \
+                and other['cursor'] < checkpoint['cursor']:
+            checkpoint['cursor'] = other['cursor']
+    return checkpoint
+
+
+def get_settings(block, name, **kwargs):
+    settings = configparser.ConfigParser()
+    settings.read(join(ROOT, 'token.ini'))
+    return settings.get(block, name, **kwargs)
+
+
+class Router(aiobot.Dispatcher):
+    """
+    Dispatcher of the ingestion process: passes every update on to the
+    worker process of its chat instead of handling it, and the commands of
+    FANOUT to every worker. A worker that died is started again.
+    """
+
+    def __init__(self, bot, shards):
+        # The commands are only matched, see dispatch(), not handled here
+        super(Router, self).__init__(
+            bot, [(command, True, False) for command in FANOUT], [], None)
+        self.shards = shards
+        self.workers = [None] * shards
+        self.routed = [0] * shards
+        # Held while a line is passed on to a shard's worker, so its lines
+        # go out in order and only one dispatch starts a dead worker again
+        self.locks = [asyncio.Lock() for _ in range(shards)]
+
+    async def spawn(self, shard):
+        env = dict(os.environ, BOT_SHARD=str(shard),
+                   BOT_SHARDS=str(self.shards))
+        self.workers[shard] = await asyncio.create_subprocess_exec(
+            sys.executable, BOT, stdin=asyncio.subprocess.PIPE, env=env)
+
+    async def start(self, bot):
+        for shard in range(self.shards):
+            await self.spawn(shard)
+
+    async def dispatch(self, update):
+        line = update.to_json().encode() + b'\n'
+        chat = update.effective_chat
+        if update.message is not None and \
+                self.handler(update.message)[0] is not None:
+            shards = range(self.shards)
+        else:
+            shards = [shard_of(chat.id, self.shards) if chat is not None
+                      else 0]
+        for shard in shards:
+            await self.route(shard, line)
+
+    async def route(self, shard, line):
+        """ Writes line to the worker of shard """
+        async with self.locks[shard]:
+            # Whoever held the lock before may have replaced the worker
+            worker = self.workers[shard]
+            if worker.returncode is None:
+                try:
+                    await self._send(shard, worker, line)
+                    return
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            logger.error('Worker %d is gone (%s), starting it again',
+                         shard, worker.returncode)
+            await self.spawn(shard)
+            await self._send(shard, self.workers[shard], line)
+
+    async def _send(self, shard, worker, line):
+        worker.stdin.write(line)
+        await worker.stdin.drain()
+        self.routed[shard] += 1
+
+    async def drain(self):
+        await super(Router, self).drain()
+        for worker in self.workers:
+            await worker.stdin.drain()
+
+    async def stop(self):
+        """ Closes the workers' stdin and waits for them to finish """
+        for worker in self.workers:
+            worker.stdin.close()
+        await asyncio.gather(*(worker.wait() for worker in self.workers))
+        logger.info('Updates routed to each shard: %s', self.routed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Runs the bot as one process per shard of the chats')
+    parser.add_argument('--shards', type=int, default=int(get_settings(
+        "Bot", "shards", fallback=str(os.cpu_count() or 1))))
+    args = parser.parse_args()
+
+    # The workers log to example.<shard>.log
+    log_listener = logs.setup('example.log')
+
+    for path, backend in (('bot.db', 'json'), ('bot.sqlite', 'sqlite')):
+        reshard(path, args.shards, backend)
+
+    mode = get_settings("Bot", "mode", fallback="polling")
+    webhook = None
+    if mode == 'webhook':
+        webhook = {
+            'url': get_settings("Webhook", "url"),
+            'listen': get_settings("Webhook", "listen", fallback="0.0.0.0"),
+            'port': int(get_settings("Webhook", "port", fallback="8443")),
+        }
+    bot = aiobot.AsyncBot(get_settings("Bot", "token"),
+                          os.environ.get("BOT_API_URL") or get_settings(
+                              "Bot", "api_url", fallback=aiobot.API_URL))
+    router = Router(bot, args.shards)
+    try:
+        aiobot.run(router, router.start, router.stop, webhook)
+    finally:
+        log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Welcome and goodbye messages with placeholders.
+
+A message set with /welcome or /goodbye is HTML written by the chat's admin.
+It is parsed once into a Template, a list of literal parts and placeholders,
+and the compiled templates are cached by text, so greeting someone is a join
+over the parts instead of a chain of str.replace() calls. Everything filled
+into a placeholder is escaped, so a name like "<3" can't break the message.
+
+Placeholders, each of which stands for everyone greeted by the message:
+
+$username  mentions of the users, "A, B and C"
+$mention   the same, kept for messages written with it in mind
+$title     title of the chat
+$count     number of users
+$id        user ids, "1, 2 and 3"
+"""
+import re
+from html import escape
+
+from python3pickledb import LRUCache
+
+# Compiled templates kept in memory, one per distinct message text
+CACHE_SIZE = 5000
+
+# Only whole names: "$identity" or "$count_a" are left as they are
+PLACEHOLDER = re.compile(
+    r'\$(username|mention|title|count|id)(?![A-Za-z0-9_])')
+
+
+def mention(user):
+    """ Returns an HTML link to a user, showing their first name """
+    return '<a href="tg://user?id=%d">%s</a>' % (
+        user.id, escape(user.first_name, quote=False))
+
+
+def enumerate_names(names):
+    """ Returns "A", "A and B" or "A, B and C" """
+    if len(names) > 1:
+        return '%s and %s' % (', '.join(names[:-1]), names[-1])
+    return ''.join(names)
+
+
+class Template(object):
+    """ A message compiled into literal parts and placeholder names """
+
+    __slots__ = ('text', 'parts', 'names')
+
+    def __init__(self, text):
+        self.text = text
+        # Even positions are literal text, odd ones placeholder names
+        self.parts = PLACEHOLDER.split(text)
+        self.names = frozenset(self.parts[1::2])
+
+    def render(self, chat, users):
+        """ Returns the message for users joining or leaving chat """
+        values = {}
+        if self.names & {'username', 'mention'}:
+            values['username'] = values['mention'] = enumerate_names(
+                [mention(user) for user in users])
+        if 'title' in self.names:
+            values['title'] = escape(chat.title or '', quote=False)
+        if 'count' in self.names:
+            values['count'] = str(len(users))
+        if 'id' in self.names:
+            values['id'] = enumerate_names([str(user.id) for user in users])
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = values[parts[i]]
+        return ''.join(parts)
+
+
+_cache = LRUCache(CACHE_SIZE)
+
+
+def compile(text):
+    """ Returns the Template for a message text, compiling it once """
+    template = _cache.get(text)
+    if template is None:
+        template = Template(text)
+        _cache.put(text, template)
+    return template
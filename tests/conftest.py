@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the bot live in the top directory of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
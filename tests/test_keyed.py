@@ -0,0 +1,181 @@
+import threading
+import time
+
+import pytest
+
+from keyed import KeyedExecutor
+
+
+@pytest.fixture
+def executors():
+    """ Returns a function that starts a KeyedExecutor, stopped after the
+    test """
+    started = []
+
+    def start(**kwargs):
+        executor = KeyedExecutor(**kwargs)
+        executor.start()
+        started.append(executor)
+        return executor
+
+    yield start
+    for executor in started:
+        executor.stop(timeout=5)
+
+
+def blocker(executor, key='gate'):
+    """ Submits a job that keeps a worker busy until the returned event is
+    set, and waits for a worker to take it """
+    gate = threading.Event()
+    running = threading.Event()
+
+    def job():
+        running.set()
+        gate.wait(5)
+
+    executor.submit(key, job)
+    assert running.wait(5)
+    return gate
+
+
+def test_jobs_of_a_key_run_in_order(executors):
+    executor = executors(workers=4)
+    lock = threading.Lock()
+    done = {}
+    running = set()
+    overlaps = []
+
+    def job(key, i):
+        def run():
+            with lock:
+                if key in running:
+                    overlaps.append(key)
+                running.add(key)
+            time.sleep(0.0001)
+            with lock:
+                running.discard(key)
+                done.setdefault(key, []).append(i)
+        return run
+
+    for i in range(50):
+        for key in range(5):
+            assert executor.submit(key, job(key, i))
+    assert executor.drain(10)
+    assert done == {key: list(range(50)) for key in range(5)}
+    assert not overlaps
+    assert executor.pending() == 0
+
+
+def test_keys_run_in_parallel(executors):
+    executor = executors(workers=2)
+    barrier = threading.Barrier(2, timeout=5)
+    for key in ('a', 'b'):
+        executor.submit(key, barrier.wait)
+    assert executor.drain(5)
+    assert not barrier.broken
+
+
+def test_keys_take_turns(executors):
+    executor = executors(workers=1)
+    order = []
+    gate = blocker(executor)
+    for key, i in (('a', 0), ('a', 1), ('a', 2), ('b', 0)):
+        executor.submit(key, lambda key=key, i=i: order.append((key, i)))
+    gate.set()
+    assert executor.drain(5)
+    assert order == [('a', 0), ('b', 0), ('a', 1), ('a', 2)]
+
+
+def test_cold_keys_under_skewed_load(executors):
+    # One chat floods the bot with hundreds of updates just before many
+    # quiet chats send one each
+    executor = executors(workers=2)
+    lock = threading.Lock()
+    order = []
+
+    def job(key):
+        def run():
+            time.sleep(0.0002)
+            with lock:
+                order.append(key)
+        return run
+
+    gates = [blocker(executor, key) for key in ('gate-0', 'gate-1')]
+    for i in range(500):
+        executor.submit('hot', job('hot'))
+    for key in range(100):
+        executor.submit(key, job(key))
+    for gate in gates:
+        gate.set()
+    assert executor.drain(10)
+    # Queued behind the whole flood in a plain FIFO pool, every quiet chat
+    # gets its turn within a few of the hot one's here
+    last_cold = max(i for i, key in enumerate(order) if key != 'hot')
+    assert order[:last_cold].count('hot') <= 3
+    assert order.count('hot') == 500
+
+
+def test_shedding(executors):
+    executor = executors(workers=1, key_limit=3, limit=6)
+    ran = []
+    gate = blocker(executor)
+    for i in range(3):
+        assert executor.submit('a', lambda: ran.append('a'))
+    # A full chat only drops sheddable jobs, and only its own
+    assert not executor.submit('a', lambda: ran.append('shed'), shed=True)
+    assert executor.submit('b', lambda: ran.append('b'), shed=True)
+    assert executor.submit('a', lambda: ran.append('a'))
+    assert executor.submit('c', lambda: ran.append('c'))
+    # limit is reached: sheddable jobs are dropped, others wait for room
+    assert not executor.submit('d', lambda: ran.append('shed'), shed=True)
+    waiting = threading.Thread(
+        target=executor.submit, args=('d', lambda: ran.append('d')))
+    waiting.start()
+    waiting.join(0.2)
+    assert waiting.is_alive()
+    gate.set()
+    waiting.join(5)
+    assert not waiting.is_alive()
+    assert executor.drain(5)
+    assert sorted(ran) == ['a'] * 4 + ['b', 'c', 'd']
+    assert executor.shed == 2
+
+
+def test_failing_job_is_logged_and_the_key_goes_on(executors, caplog):
+    executor = executors(workers=1)
+    ran = []
+
+    def fail():
+        raise RuntimeError('boom')
+
+    executor.submit('a', fail)
+    executor.submit('a', lambda: ran.append(1))
+    assert executor.drain(5)
+    assert ran == [1]
+    assert 'Job of a failed' in caplog.text
+
+
+def test_stop_runs_what_is_queued(executors):
+    executor = executors(workers=1)
+    ran = []
+    gate = blocker(executor)
+    for i in range(5):
+        executor.submit(i % 2, lambda i=i: ran.append(i))
+    stopping = threading.Thread(target=executor.stop)
+    stopping.start()
+    gate.set()
+    stopping.join(5)
+    assert not stopping.is_alive()
+    assert sorted(ran) == list(range(5))
+    assert not any(thread.is_alive() for thread in executor.threads)
+
+
+def test_stop_timeout_is_shared(executors):
+    executor = executors(workers=3)
+    gates = [blocker(executor, key) for key in range(3)]
+    start = time.monotonic()
+    executor.stop(timeout=0.3)
+    # One deadline for all workers, not 0.3s each
+    assert time.monotonic() - start < 0.6
+    for gate in gates:
+        gate.set()
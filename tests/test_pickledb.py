@@ -0,0 +1,382 @@
+import gc
+import threading
+import time
+import weakref
+
+import pytest
+
+import python3pickledb as pickledb
+
+
+def run(function, timeout=5):
+    """ Runs function in a thread and returns what it returned, failing
+    the test if it doesn't within timeout seconds """
+    result = {}
+
+    def target():
+        try:
+            result['value'] = function()
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'deadlocked'
+    if 'error' in result:
+        raise result['error']
+    return result.get('value')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+@pytest.fixture(params=['json', 'lazy'])
+def db(request, tmp_path):
+    path = str(tmp_path / 'test.db')
+    db = pickledb.load(path, True)
+    db.set('chats', {1, 2, 3})
+    db.set('settings', {'welcome': 'Hi', 'quiet': False})
+    db.close()
+    db = pickledb.load(path, True, lazy=request.param == 'lazy')
+    yield db
+    db.close()
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'journal': True},
+                                    {'backend': 'sqlite'}])
+def test_closed_db_is_not_kept_alive(tmp_path, kwargs):
+    db = pickledb.load(str(tmp_path / 'test.db'), True, **kwargs)
+    db.set('a', 1)
+    db.close()
+    ref = weakref.ref(db)
+    del db
+    gc.collect()
+    assert ref() is None
+
+
+def test_read_lock_reentrant_while_writer_waits(db):
+    lock = db._lock
+    writer = threading.Thread(target=db.set, args=('other', 1), daemon=True)
+
+    def nested_reads():
+        with lock.read:
+            writer.start()
+            wait_for(lambda: lock._waiting)
+            # Each of these takes the read side again under the one held
+            return (db.sgetall('chats'), db.dkeys('settings'),
+                    db.dvals('settings'), db.get('other'))
+
+    assert run(nested_reads) == ({1, 2, 3}, ['welcome', 'quiet'],
+                                 ['Hi', False], None)
+    writer.join(5)
+    assert db.get('other') == 1
+
+
+def test_readers_against_writers(db):
+    stop = threading.Event()
+
+    def read():
+        while not stop.is_set():
+            with db._lock.read:
+                db.sgetall('chats')
+                db.dkeys('settings')
+                db.mget(['chats', 'settings', 'missing'])
+
+    def write(base):
+        for i in range(200):
+            db.sadd('chats', base + i)
+            db.dadd('settings', ('n', i))
+
+    def writers():
+        threads = [threading.Thread(target=write, args=(base,), daemon=True)
+                   for base in (1000, 2000)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    readers = [threading.Thread(target=read, daemon=True) for _ in range(4)]
+    for thread in readers:
+        thread.start()
+    try:
+        run(writers, timeout=20)
+    finally:
+        stop.set()
+        for thread in readers:
+            thread.join(5)
+    assert len(db.sgetall('chats')) == 403
+
+
+def test_index(db):
+    db.close()
+    db = pickledb.load(db.loco, True, lazy=db.lazy,
+                       indexes={'admin': pickledb.Index(field='admin')})
+    try:
+        db.set('-1', {'admin': 7})
+        db.set('-2', {'admin': 7})
+        db.set('-3', {'admin': 8})
+        # A lazy db only builds it now, from what it holds
+        assert db.lookup('admin', 7) == {'-1', '-2'}
+        db.set('-2', {'admin': 8})
+        db.rem('-3')
+        with pytest.raises(RuntimeError):
+            with db.batch():
+                db.set('-1', {'admin': 8})
+                raise RuntimeError
+        assert db.lookup('admin', 7) == {'-1'}
+        assert db.lookup('admin', 8) == {'-2'}
+    finally:
+        db.close()
+
+
+def crashed(db, tmp_path):
+    """ Returns the path of a copy of db's files as a crash would leave
+    them, with nothing written after this point """
+    crash = tmp_path / 'crash'
+    crash.mkdir()
+    for path in tmp_path.iterdir():
+        if path.is_file():
+            (crash / path.name).write_bytes(path.read_bytes())
+    return str(crash / 'test.db')
+
+
+def test_journal_recovery(tmp_path):
+    path = str(tmp_path / 'test.db')
+    db = pickledb.load(path, True, journal=True)
+    try:
+        db.set('a', 1)
+        db.set('chats', {1})
+        db.compact()
+        db.set('b', [1, 2])
+        db.ladd('b', 3)
+        with db.batch():
+            db.set('c', 'x')
+            db.incr('a')
+        crash = crashed(db, tmp_path)
+    finally:
+        db.close()
+    # A record torn by the crash, e.g. half of a batch
+    with open(crash + '.journal', 'ab') as f:
+        f.write(b'["_apply", [["set", "c", "y"], ["set", "d"')
+
+    db = pickledb.load(crash, True, journal=True)
+    try:
+        assert db.get('a') == 2
+        assert db.get('b') == [1, 2, 3]
+        assert db.get('c') == 'x'
+        assert db.get('d') is None
+        assert db.sgetall('chats') == {1}
+        # The torn record is dropped, new ones go after the good ones
+        db.set('d', 4)
+    finally:
+        db.close()
+    db = pickledb.load(crash, False, journal=True)
+    try:
+        assert db.get('d') == 4
+    finally:
+        db.close()
+
+
+def test_journal_recovery_after_interrupted_compaction(tmp_path):
+    path = str(tmp_path / 'test.db')
+    db = pickledb.load(path, True, journal=True)
+    db.set('a', 1)
+    db.close()
+    # Rotated journal left behind by a compaction that didn't finish
+    with open(path + '.journal', 'rb') as f:
+        records = f.read()
+    with open(path + '.journal.old', 'wb') as f:
+        f.write(records)
+    with open(path + '.journal', 'wb') as f:
+        f.write(b'["set", "b", 2]\n')
+
+    db = pickledb.load(path, False, journal=True)
+    try:
+        assert (db.get('a'), db.get('b')) == (1, 2)
+    finally:
+        db.close()
+
+
+
+def test_sqlitedb(tmp_path):
+    path = str(tmp_path / 'test.sqlite')
+    db = pickledb.load(path, True, backend='sqlite',
+                       indexes={'admin': pickledb.Index(field='admin')})
+    try:
+        db.set('-1', {'admin': 7})
+        db.set('l', [1])
+        db.screate('chats')
+        db.sadd('chats', -1)
+        db.ladd('l', 2)
+        # Values are copies, changing one changes nothing in the db
+        db.lgetall('l').append(3)
+        db.dgetall('-1')['admin'] = 8
+        assert db.lgetall('l') == [1, 2]
+        assert db.lookup('admin', 7) == {'-1'}
+        with pytest.raises(ValueError):
+            with db.batch():
+                db.set('-1', {'admin': 8})
+                db.sadd('chats', -2)
+                raise ValueError
+        assert db.get('-1') == {'admin': 7}
+        assert db.sgetall('chats') == {-1}
+        assert db.lookup('admin', 8) == set()
+    finally:
+        db.close()
+
+    db = pickledb.load(path, False, backend='sqlite')
+    try:
+        assert db.get('-1') == {'admin': 7}
+        assert db.lgetall('l') == [1, 2]
+        assert db.sismember('chats', -1)
+    finally:
+        db.close()
+
+
+
+def test_lazy(tmp_path):
+    path = str(tmp_path / 'test.db')
+    db = pickledb.load(path, True)
+    db.mset({str(i): {'n': i} for i in range(100)})
+    db.set('chats', set(range(100)))
+    db.close()
+
+    db = pickledb.load(path, True, lazy=True, cache_size=10)
+    try:
+        # Nothing is decoded until it is read, and only cache_size kept
+        assert not db.db._cache and not db.db._changed
+        assert [db.get(str(i))['n'] for i in range(50)] == list(range(50))
+        assert len(db.db._cache) == 10
+        db.dadd('5', ('n', -5))
+        db.rem('6')
+        db.sadd('chats', 100)
+        db.set('new', 1)
+        db.dump()
+        assert db.get('5') == {'n': -5} and db.get('6') is None
+        assert len(db.getall()) == 101
+    finally:
+        db.close()
+
+    db = pickledb.load(path, False, lazy=True)
+    try:
+        assert db.get('5') == {'n': -5}
+        assert db.get('6') is None
+        assert db.get('7') == {'n': 7}
+        assert db.get('new') == 1
+        assert db.slen('chats') == 101
+    finally:
+        db.close()
+
+
+
+@pytest.mark.parametrize('journal', [False, True])
+def test_batch_rollback(tmp_path, journal):
+    path = str(tmp_path / 'test.db')
+    db = pickledb.load(path, True, journal=journal)
+    db.set('a', 1)
+    db.set('l', [1])
+    with pytest.raises(ValueError):
+        with db.batch():
+            db.set('a', 2)
+            db.ladd('l', 2)
+            db.set('new', 1)
+            db.rem('a')
+            raise ValueError
+    assert (db.get('a'), db.get('l'), db.get('new')) == (1, [1], None)
+    db.close()
+    # Nothing of it reached the file or the journal
+    db = pickledb.load(path, False, journal=journal)
+    try:
+        assert (db.get('a'), db.get('l'), db.get('new')) == (1, [1], None)
+    finally:
+        db.close()
+
+
+
+@pytest.mark.parametrize('codec', ['json', 'binary'])
+def test_codecs(tmp_path, codec):
+    path = str(tmp_path / 'test.db')
+    values = {'chats': {1, -2}, 'list': [1, 'a', None], 'n': 2 ** 70,
+              'text': 'Grüße <3', 'settings': {'welcome': 'Hi', 'x': 1.5}}
+    db = pickledb.load(path, True, codec=codec)
+    db.mset(values)
+    db.close()
+    # Either format loads, whatever codec is set
+    for other in ('json', 'binary'):
+        db = pickledb.load(path, False, codec=other)
+        try:
+            assert {key: db.get(key) for key in db.getall()} == values
+        finally:
+            db.close()
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'journal': True},
+                                    {'backend': 'sqlite'},
+                                    {'read_cache': 10}])
+def test_mutators_take_keyword_arguments(tmp_path, kwargs):
+    path = str(tmp_path / 'test.db')
+    db = pickledb.load(path, True, **kwargs)
+    try:
+        db.set(key='n', value=1)
+        assert db.incr('n', amount=2) == 3
+        assert db.get('n') == 3
+        db.lcreate(name='l')
+        db.ladd('l', value='a')
+        with pytest.raises(ValueError):
+            with db.batch():
+                db.set(key='n', value=10)
+                raise ValueError
+        assert db.get('n') == 3
+    finally:
+        db.close()
+    # Journal records replay the keyword arguments like positional ones
+    db = pickledb.load(path, False, **kwargs)
+    try:
+        assert (db.get('n'), db.lgetall('l')) == (3, ['a'])
+    finally:
+        db.close()
+
+
+def test_lazy_snapshot_does_not_block_writers(tmp_path):
+    path = str(tmp_path / 'test.db')
+    db = pickledb.load(path, True)
+    db.set('chats', {1})
+    db.close()
+    # Held back by write-behind, so only dump() writes
+    db = pickledb.load(path, True, lazy=True, flush_interval=60,
+                       flush_ops=1000)
+    try:
+        db.sadd('chats', 2)
+        copying = threading.Event()
+        done = threading.Event()
+        write = db.db.write
+
+        def slow_write(f, snapshot):
+            copying.set()
+            done.wait(5)
+            return write(f, snapshot)
+
+        db.db.write = slow_write
+        dump = threading.Thread(target=db.dump, daemon=True)
+        dump.start()
+        assert copying.wait(5)
+        # While the file is copied, writers go on, changing in place too
+        run(lambda: (db.sadd('chats', 3), db.set('other', 1)), timeout=2)
+        done.set()
+        dump.join(5)
+        # The snapshot has the set as it was when the copy began
+        with open(path) as f:
+            assert pickledb._loads(f.read())['chats'] == {1, 2}
+        assert db.sgetall('chats') == {1, 2, 3}
+    finally:
+        db.close()
+    db = pickledb.load(path, False, lazy=True)
+    try:
+        assert (db.sgetall('chats'), db.get('other')) == ({1, 2, 3}, 1)
+    finally:
+        db.close()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Text triggers of the bot: which words in a group message get which reaction.
+
+Triggers are declared in the tables at the bottom of this file and compiled
+once per bot name into a Matcher. A Matcher finds every trigger pattern in a
+message with a single regex scan and then only looks at the triggers whose
+patterns showed up, so the cost per message doesn't grow with the number of
+triggers.
+
+A pattern may contain {bot}, which is replaced with the lower case @name of
+the bot when compiling.
+"""
+import itertools
+import random
+import re
+from datetime import datetime, timezone
+
+from emoji import emojize
+
+
+class Echo(object):
+    """ Reply with a random one of msgs, which may also be a function of
+    (update, msg) returning the list. {} in a message is replaced with a
+    mention of the sender. """
+
+    __slots__ = ('msgs', 'reply')
+
+    def __init__(self, msgs, reply=False):
+        self.msgs = msgs
+        self.reply = reply
+
+    def choose(self, update, msg):
+        """ Returns the message to send """
+        msgs = self.msgs(update, msg) if callable(self.msgs) else self.msgs
+        return random.choice(msgs)
+
+
+class Photo(object):
+    """ Send one of the pictures in resources/photos """
+
+    __slots__ = ('photo', 'caption', 'reply')
+
+    def __init__(self, photo, caption, reply=False):
+        self.photo = photo
+        self.caption = caption
+        self.reply = reply
+
+
+class Sticker(object):
+    """ Send the sticker at index of a sticker set """
+
+    __slots__ = ('set_name', 'index', 'reply')
+
+    def __init__(self, set_name, index, reply=False):
+        self.set_name = set_name
+        self.index = index
+        self.reply = reply
+
+
+class Handler(object):
+    """ Pass the update on to a handler of the bot, by its name in
+    bot.HANDLERS """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Trigger(object):
+    """
+    One row of a trigger table. A message matches if it contains a pattern
+    from each group in all (a group is a pattern or a tuple of alternatives),
+    none of the patterns in none, equals one of equals (if given) and when
+    (a function of (bot, update, msg)) returns True (if given). With
+    replies, only messages that reply to another message are looked at,
+    which spares a trigger with nothing but when from running it on every
+    message.
+    Of all matching triggers the one with the lowest priority wins; it
+    defaults to the position in the table.
+    """
+
+    __slots__ = ('name', 'response', 'all', 'none', 'equals', 'when',
+                 'replies', 'priority')
+
+    def __init__(self, name, response, all=(), none=(), equals=(), when=None,
+                 replies=False, priority=None):
+        self.name = name
+        self.response = response
+        self.all = tuple(g if isinstance(g, tuple) else (g,) for g in all)
+        self.none = tuple(none)
+        self.equals = tuple(equals)
+        self.when = when
+        self.replies = replies
+        self.priority = priority
+
+    def format(self, **names):
+        """ Returns a copy with the placeholders in patterns filled in """
+        return Trigger(self.name, self.response,
+                       [tuple(p.format(**names) for p in g) for g in self.all],
+                       [p.format(**names) for p in self.none],
+                       [p.format(**names) for p in self.equals],
+                       self.when, self.replies, self.priority)
+
+
+class Matcher(object):
+    """ A trigger table compiled for one bot name """
+
+    def __init__(self, triggers):
+        self.triggers = triggers
+        patterns = set()
+        for trigger in triggers:
+            for group in trigger.all:
+                patterns.update(group)
+            patterns.update(trigger.none)
+        # At each position of the message the lookahead reports the longest
+        # pattern starting there; shorter ones that are a prefix of it are
+        # added from prefixes below, which only holds patterns that have
+        # any. The patterns are merged into a trie so re checks each
+        # character once instead of once per pattern, and the leading
+        # character class lets it skip hopeless positions. Most messages
+        # contain no pattern at all, which search (no lookahead) finds out
+        # several times faster.
+        self.regex = self.search = None
+        if patterns:
+            trie = _trie_regex(patterns)
+            first = ''.join(sorted(set(re.escape(p[0]) for p in patterns)))
+            self.regex = re.compile('(?=[%s])(?=(%s))' % (first, trie),
+                                    re.DOTALL)
+            self.search = re.compile(trie, re.DOTALL).search
+        self.prefixes = {}
+        for p in patterns:
+            shorter = tuple(q for q in patterns if q != p and p.startswith(q))
+            if shorter:
+                self.prefixes[p] = shorter
+
+        # Triggers are only looked at once one of their patterns from the
+        # first group of all (or an exact message) has been seen, or for
+        # replies if that's all they have to go on. Each list is in order
+        # of priority, see match().
+        self.by_pattern = {}
+        self.by_equals = {}
+        self.on_reply = []
+        self.always = []
+        for trigger in triggers:
+            if trigger.all:
+                for pattern in trigger.all[0]:
+                    self.by_pattern.setdefault(pattern, []).append(trigger)
+            elif trigger.equals:
+                for text in trigger.equals:
+                    self.by_equals.setdefault(text, []).append(trigger)
+            elif trigger.replies:
+                self.on_reply.append(trigger)
+            else:
+                self.always.append(trigger)
+        for candidates in itertools.chain(
+                self.by_pattern.values(), self.by_equals.values(),
+                (self.on_reply, self.always)):
+            candidates.sort(key=_priority)
+
+    def match(self, bot, update, msg):
+        """ Returns the winning trigger for a lower case message, or None """
+        # Written out in one function, this runs for every group message
+        first = self.search(msg) if self.regex is not None else None
+        if first is None:
+            found = _EMPTY
+            lists = []
+        else:
+            found = set(self.regex.findall(msg, first.start()))
+            if not found.isdisjoint(self.prefixes):
+                for pattern in found & self.prefixes.keys():
+                    found.update(self.prefixes[pattern])
+            by_pattern = self.by_pattern
+            lists = [by_pattern[p] for p in found if p in by_pattern]
+        if msg in self.by_equals:
+            lists.append(self.by_equals[msg])
+        if self.on_reply and update.message.reply_to_message is not None:
+            lists.append(self.on_reply)
+        if self.always:
+            lists.append(self.always)
+        # Each list is sorted, so its first match is its best one and a
+        # list is done once its triggers can't beat the best match so far
+        best = None
+        for candidates in lists:
+            for trigger in candidates:
+                if best is not None and trigger.priority >= best.priority:
+                    break
+                if trigger.equals and msg not in trigger.equals:
+                    continue
+                for group in trigger.all:
+                    if found.isdisjoint(group):
+                        break
+                else:
+                    if found.isdisjoint(trigger.none) and (
+                            trigger.when is None
+                            or trigger.when(bot, update, msg)):
+                        best = trigger
+                        break
+        return best
+
+
+_EMPTY = frozenset()
+
+
+def _priority(trigger):
+    return trigger.priority
+
+
+def _trie_regex(patterns):
+    """ Returns a regex matching the longest of patterns at a position """
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def emit(node):
+        branches = [re.escape(char) + emit(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        regex = branches[0] if len(branches) == 1 \
+            else '(?:%s)' % '|'.join(branches)
+        # A pattern ends here, longer ones may go on
+        return '(?:%s)?' % regex if '' in node else regex
+
+    return emit(trie)
+
+
+class TriggerTable(object):
+    """ A list of triggers plus a Matcher for each bot name seen so far """
+
+    def __init__(self, triggers):
+        self.triggers = []
+        for position, trigger in enumerate(triggers):
+            if trigger.priority is None:
+                trigger.priority = position
+            self.triggers.append(trigger)
+        self._matchers = {}
+
+    def compile(self, bot_name):
+        """ Returns the Matcher for a lower case bot name """
+        matcher = self._matchers.get(bot_name)
+        if matcher is None:
+            matcher = Matcher([t.format(bot=bot_name) for t in self.triggers])
+            self._matchers[bot_name] = matcher
+        return matcher
+
+
+# Responses that depend on the message or the sender
+
+def missing_hours(update, msg):
+    return [emojize('Agree'), "Always.", "Every hour is missing {} hour".format(
+        msg.split("missing ")[1].split(" hours")[0])]
+
+
+def rentier(update, msg):
+    msgs = [emojize('Psss, want some weed?'),
+            "Someone's called me?",
+            "{}, password?",
+            "{}, listen, every person is an island.",
+            "{}, coffee?",
+            "Yeah?"]
+    if update.message.from_user.id == 909049413:
+        msgs.append(emojize("{}, I know you don't like me, but I like you and that's enough! :red_heart:"))
+        msgs.append(emojize("Why you don't like me, {}? :disappointed_face:"))
+        msgs.append("I'm here to annoy Angelika")
+    return msgs
+
+
+def constantin(update, msg):
+    consti = ["Constantpain", "Constantshit", "Constantmood", "Constantdrama", "Constantinople", "Constipation",
+              "Cantstandhim", "Constandick", "Nora's evil twin", "Constellation"]
+    return [emojize('Constantin? 🤔 Did you mean {}'.format(random.choice(consti)))]
+
+
+def days_until_druck(update, msg):
+    date_from = datetime(2020, 6, 22, 13, 0, tzinfo=timezone.utc)
+    date_now = datetime.now(tz=timezone.utc)
+    return ["Days until druck: {}".format((date_from - date_now).days)]
+
+
+# Conditions that aren't about the words in the message
+
+def mentions_bot(bot, update, msg):
+    """ The bot is mentioned in the message, not just named on its own """
+    return msg != bot.name.lower()
+
+
+def answers_coffee(bot, update, msg):
+    """ The message replies to the bot offering coffee """
+    replied = update.message.reply_to_message
+    return replied is not None and replied.from_user.id == bot.id \
+        and "coffee" in replied.text.lower()
+
+
+# Triggers for any group message, see bot.bis_bald
+BANTER = TriggerTable([
+    Trigger('mention', Handler('at_handler'), all=['{bot}'],
+            when=mentions_bot),
+    Trigger('bis bald', Echo([emojize("Bis bald :red_heart:")]),
+            all=['bis', 'bald']),
+    Trigger('family chat',
+            Echo([emojize('That\'s right, we\'re all family here :red_heart:')]),
+            all=['family', 'chat']),
+    Trigger('lonely', Echo(["Lonely like island Ibiza"], reply=True),
+            all=['lonely']),
+    Trigger('hollandaise pizza',
+            Echo(["{}, I want a pizza margherita with extra tzatziki"],
+                 reply=True),
+            all=['hollandaise', 'pizza']),
+    Trigger('food debate',
+            Echo([emojize('Oh nooo, no food debates!'),
+                  "Here we go again",
+                  "{}, food discussions are important but first, let me make some tea"]),
+            all=[('pineapple pizza', 'mint chocolate', 'toast hawaii')]),
+    Trigger('hawaii toast', Photo("hawaii.jpg", ";)", reply=True),
+            all=[('hawaii toast', 'hawaii sandwich')]),
+    Trigger('here we go again', Photo("gta.jpg", "", reply=True),
+            all=[('food discussion', 'food debate', 'here we go again')]),
+    Trigger('daddy',
+            Echo([emojize('{}, papa'), emojize("Papa :index_pointing_up:"),
+                  "You need to stop using word \"daddy\", otherwise you'll become lonely. And other things will become your friends."],
+                 reply=True),
+            all=['daddy']),
+    Trigger('bjorn', Echo([emojize('Ugh, Bj*rn :face_vomiting:')]),
+            all=[('bjorn', 'bj*rn', 'björn')]),
+    Trigger('missing hours', Echo(missing_hours, reply=True),
+            all=['missing', 'hours']),
+    # The bot's own name only, any other mention was handled above
+    Trigger('rentier', Echo(rentier), all=['rentier'], none=['{bot}']),
+    Trigger('rentier', Echo(rentier), equals=['{bot}']),
+    Trigger('reindeer', Echo(["{}, I changed this password 3 months ago."]),
+            equals=['reindeer']),
+    Trigger('superior', Sticker("water81818", 10, reply=True),
+            all=['superior']),
+    Trigger('coffee reply', Handler('coffee_reply'), when=answers_coffee,
+            replies=True),
+    Trigger('constantin', Echo(constantin, reply=True), all=['constantin']),
+])
+
+# Triggers for messages that mention the bot, see bot.at_handler
+AT_BANTER = TriggerTable([
+    Trigger('coffee', Photo("rentier_coffee.jpg", "Here!", reply=True),
+            all=['{bot}', 'coffee']),
+    Trigger('days until druck', Echo(days_until_druck),
+            all=['{bot}', ('days till', 'days until'), ('druck', 'season 5')]),
+    Trigger('shakshuka', Photo("shakshuka.jpg", "Bon Appetit!", reply=True),
+            all=['{bot}', 'shakshuka']),
+    Trigger('sandwich', Photo("sandwiches.jpg", "Here!", reply=True),
+            all=['{bot}', 'sandwich']),
+    Trigger('pancake', Photo("pancake.jpg", ";)", reply=True),
+            all=['{bot}', 'pancake']),
+    Trigger('cake', Photo("cake.jpg", ";)", reply=True),
+            all=['{bot}', ' cake']),
+    Trigger('muffin', Photo("muffins.jpg", ";)", reply=True),
+            all=['{bot}', 'muffin']),
+])